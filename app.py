@@ -1,31 +1,186 @@
 import os
+import re
+import io
+import csv
 import json
+import random
+import difflib
+import secrets
+import uuid
+import base64
+import gzip
+import hashlib
+import inspect
+import mimetypes
+import tempfile
+import urllib.error
+import urllib.parse
+import urllib.request
+import unicodedata
 # --- IMPORTS PARA POSTGRESQL ---
 import psycopg2
 import psycopg2.extras
+import psycopg2.pool
+import psycopg2.errors
 from psycopg2 import Error as Psycopg2Error
+import select
+import threading
+import time
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+from decimal import Decimal, InvalidOperation, ROUND_HALF_UP
 # ------------------------------------
+import httpx
 from google import genai
 from google.genai.errors import APIError
 from google.genai.types import GenerateContentConfig
-from flask import Flask, request, jsonify, send_file
+from flask import Flask, request, jsonify, Response, stream_with_context
 from twilio.twiml.messaging_response import MessagingResponse
+from twilio.request_validator import RequestValidator
 from flask_cors import CORS
+from itsdangerous import BadSignature, URLSafeTimedSerializer
+
+# Dependências opcionais do pipeline de estáticos: sem elas os arquivos saem sem brotli / sem WebP e AVIF
+try:
+    import brotli
+except ImportError:
+    brotli = None
+try:
+    from PIL import Image, features as pil_features
+except ImportError:
+    Image = None
 
 # --- VARIÁVEIS DE CONFIGURAÇÃO E CHAVE API ---
 API_KEY_GEMINI = os.environ.get('GEMINI_API_KEY')
 # Variável de ambiente fornecida pelo serviço de DBaaS (Railway, ElephantSQL, etc.)
 DATABASE_URL = os.environ.get('DATABASE_URL') or os.environ.get('DATABASE_PUBLIC_URL')
 
-# --- FLAG GLOBAL DE ESTABILIDADE (NOVO) ---
-DB_INITIALIZED = False
+# --- CONFIGURAÇÃO DO POOL DE CONEXÕES ---
+DB_POOL_MIN = int(os.environ.get('DB_POOL_MIN', 1))
+DB_POOL_MAX = int(os.environ.get('DB_POOL_MAX', 10))
+# Tempo máximo (s) que uma requisição espera por uma conexão livre antes de falhar
+DB_POOL_TIMEOUT = float(os.environ.get('DB_POOL_TIMEOUT', 10))
+# Executa 'SELECT 1' ao retirar uma conexão do pool que ficou ociosa por mais de DB_POOL_PING_OCIOSA segundos
+# (detecta conexões derrubadas pelo servidor). As demais só passam pela verificação local do estado.
+DB_POOL_HEALTHCHECK = os.environ.get('DB_POOL_HEALTHCHECK', '1') == '1'
+DB_POOL_PING_OCIOSA = float(os.environ.get('DB_POOL_PING_OCIOSA', 30))
+
+# --- CONFIGURAÇÃO DO CACHE DE MATERIAL DE ESTUDO ---
+MATERIAL_CACHE_TTL = int(os.environ.get('MATERIAL_CACHE_TTL', 7 * 24 * 3600)) # Validade em segundos (padrão: 7 dias)
+MATERIAL_CACHE_MAX_MEMORIA = int(os.environ.get('MATERIAL_CACHE_MAX_MEMORIA', 256)) # Itens no LRU em memória
+MATERIAL_CACHE_MAX_DB = int(os.environ.get('MATERIAL_CACHE_MAX_DB', 2000)) # Itens na tabela Cache_Material_Estudo
+# '1' gera em segundo plano o material de todas as disciplinas após a inicialização do DB
+MATERIAL_CACHE_PREWARM = os.environ.get('MATERIAL_CACHE_PREWARM', '0') == '1'
+
+# --- CONFIGURAÇÃO DA FILA DE GERAÇÃO DE MATERIAL (processo 'worker' do Procfile) ---
+# '0' volta a gerar o material dentro da requisição do chat (sem fila)
+MATERIAL_FILA = os.environ.get('MATERIAL_FILA', '1') == '1'
+MATERIAL_WORKERS = int(os.environ.get('MATERIAL_WORKERS', 4)) # Threads de geração por processo worker
+MATERIAL_MAX_CONCORRENTES = int(os.environ.get('MATERIAL_MAX_CONCORRENTES', 4)) # Gerações simultâneas somando todos os workers
+MATERIAL_MAX_TENTATIVAS = int(os.environ.get('MATERIAL_MAX_TENTATIVAS', 3))
+MATERIAL_JOB_TIMEOUT = int(os.environ.get('MATERIAL_JOB_TIMEOUT', 300)) # Job 'executando' há mais tempo volta para a fila
+MATERIAL_BACKOFF_BASE = float(os.environ.get('MATERIAL_BACKOFF_BASE', 10)) # Espera (s) antes da 2ª tentativa; dobra a cada falha
+MATERIAL_POLL_INTERVALO = float(os.environ.get('MATERIAL_POLL_INTERVALO', 5)) # Espera máxima (s) entre verificações da fila
+MATERIAL_JOB_RETENCAO = int(os.environ.get('MATERIAL_JOB_RETENCAO', 24 * 3600)) # Idade (s) em que jobs finalizados são apagados
+# Canais LISTEN/NOTIFY: job novo (acorda os workers) e mudança de status (payload = id do job)
+CANAL_FILA_MATERIAL = 'fila_material'
+CANAL_JOBS_MATERIAL = 'job_material'
+
+# --- CONFIGURAÇÃO DO CACHE DE HISTÓRICO ---
+HISTORICO_CACHE_TTL = int(os.environ.get('HISTORICO_CACHE_TTL', 300)) # Validade em segundos
+HISTORICO_CACHE_MAX = int(os.environ.get('HISTORICO_CACHE_MAX', 1000)) # Históricos (RAs) em memória
+# Canal LISTEN/NOTIFY usado para invalidar o cache em todos os workers
+CANAL_INVALIDACAO_HISTORICO = 'historico_invalidado'
+
+# --- CONFIGURAÇÃO DAS SESSÕES DE CONVERSA ---
+SESSAO_TTL = int(os.environ.get('SESSAO_TTL', 2 * 3600)) # Inatividade (s) até a sessão expirar
+SESSAO_MAX = int(os.environ.get('SESSAO_MAX', 5000)) # Sessões simultâneas em memória (LRU)
+SESSAO_MAX_TURNOS = int(os.environ.get('SESSAO_MAX_TURNOS', 6)) # Turnos completos no histórico recente
+SESSAO_RESUMO_MAX_CHARS = int(os.environ.get('SESSAO_RESUMO_MAX_CHARS', 600)) # Tamanho do resumo dos turnos antigos
+# Chave HMAC dos tokens de sessão: defina a mesma em todas as instâncias. Sem ela, cada boot gera uma
+# (os workers do gunicorn a herdam do mestre), os tokens emitidos antes de um restart deixam de valer
+# e o boot avisa no log.
+SESSAO_TOKEN_SEGREDO = os.environ.get('SESSAO_TOKEN_SEGREDO') or secrets.token_urlsafe(32)
+SESSAO_TOKEN_TTL = int(os.environ.get('SESSAO_TOKEN_TTL', 12 * 3600)) # Validade (s) do token emitido no /login
+IDS_ALUNOS_MAX = int(os.environ.get('IDS_ALUNOS_MAX', 50000)) # RA -> id_aluno resolvidos mantidos em memória
+
+# --- CONFIGURAÇÃO DO CACHE DE CONTEXTO DO GEMINI ---
+# '1' registra a persona e as instruções de ferramentas de cada perfil como conteúdo em cache no Gemini
+GEMINI_CONTEXT_CACHE = os.environ.get('GEMINI_CONTEXT_CACHE', '1') == '1'
+GEMINI_CONTEXT_CACHE_TTL = int(os.environ.get('GEMINI_CONTEXT_CACHE_TTL', 3600)) # Validade do cache no Gemini (s)
+# Espera (s) antes de tentar criar o cache de novo após uma falha (ex.: prefixo abaixo do mínimo de tokens)
+GEMINI_CONTEXT_CACHE_RETRY = int(os.environ.get('GEMINI_CONTEXT_CACHE_RETRY', 600))
+# Timeout (s) da chamada que cria o cache; estourado, conta como falha de criação
+GEMINI_CONTEXT_CACHE_TIMEOUT = float(os.environ.get('GEMINI_CONTEXT_CACHE_TIMEOUT', 10))
+
+# --- CONFIGURAÇÃO DO GATEWAY DO GEMINI (limites de taxa e retentativas) ---
+GEMINI_RPS_GLOBAL = float(os.environ.get('GEMINI_RPS_GLOBAL', 8)) # Chamadas/s ao Gemini por processo
+GEMINI_BURST_GLOBAL = int(os.environ.get('GEMINI_BURST_GLOBAL', 16))
+GEMINI_RPS_USUARIO = float(os.environ.get('GEMINI_RPS_USUARIO', 0.5)) # Pedidos/s que cada usuário pode fazer
+GEMINI_BURST_USUARIO = int(os.environ.get('GEMINI_BURST_USUARIO', 5))
+# Tempo máximo (s) que uma chamada espera por vaga no limite global antes de ser recusada
+GEMINI_ESPERA_MAX = float(os.environ.get('GEMINI_ESPERA_MAX', 3))
+GEMINI_MAX_TENTATIVAS = int(os.environ.get('GEMINI_MAX_TENTATIVAS', 3)) # Inclui a primeira chamada
+GEMINI_BACKOFF_BASE = float(os.environ.get('GEMINI_BACKOFF_BASE', 0.5)) # Backoff exponencial com jitter (s)
+GEMINI_BACKOFF_MAX = float(os.environ.get('GEMINI_BACKOFF_MAX', 8))
+if GEMINI_MAX_TENTATIVAS < 1:
+    raise Exception(f"ERRO CRÍTICO: GEMINI_MAX_TENTATIVAS deve ser pelo menos 1 (a primeira chamada conta como tentativa); recebido {GEMINI_MAX_TENTATIVAS}.")
+
+# --- CONFIGURAÇÃO DA POLÍTICA DE MODELOS (nível por tarefa, orçamento de latência e fallback) ---
+GEMINI_MODELO_LEVE = os.environ.get('GEMINI_MODELO_LEVE', 'gemini-2.5-flash-lite') # Roteamento e formatação curta
+GEMINI_MODELO_FORTE = os.environ.get('GEMINI_MODELO_FORTE', 'gemini-2.5-flash') # Geração longa (material de estudo)
+# Modelos de cada tarefa em ordem de preferência (separados por vírgula): os seguintes são o fallback
+GEMINI_MODELOS_ROTEAMENTO = os.environ.get('GEMINI_MODELOS_ROTEAMENTO', f"{GEMINI_MODELO_LEVE},{GEMINI_MODELO_FORTE}")
+GEMINI_MODELOS_FORMATACAO = os.environ.get('GEMINI_MODELOS_FORMATACAO', f"{GEMINI_MODELO_LEVE},{GEMINI_MODELO_FORTE}")
+GEMINI_MODELOS_MATERIAL = os.environ.get('GEMINI_MODELOS_MATERIAL', f"{GEMINI_MODELO_FORTE},{GEMINI_MODELO_LEVE}")
+# Orçamento de latência (s) de cada tarefa, somando as tentativas em todos os modelos
+GEMINI_ORCAMENTO_ROTEAMENTO = float(os.environ.get('GEMINI_ORCAMENTO_ROTEAMENTO', 15))
+GEMINI_ORCAMENTO_FORMATACAO = float(os.environ.get('GEMINI_ORCAMENTO_FORMATACAO', 15))
+GEMINI_ORCAMENTO_MATERIAL = float(os.environ.get('GEMINI_ORCAMENTO_MATERIAL', 120))
+# Fração do orçamento restante que cada modelo pode usar antes de ceder ao próximo da lista
+GEMINI_FRACAO_NIVEL = float(os.environ.get('GEMINI_FRACAO_NIVEL', 0.6))
+
+# --- CONFIGURAÇÃO DAS ESTATÍSTICAS DA TURMA ---
+RESUMO_DESEMPENHO_TTL = int(os.environ.get('RESUMO_DESEMPENHO_TTL', 300)) # Idade (s) a partir da qual o resumo é recalculado
+FALTAS_LIMITE_RISCO = int(os.environ.get('FALTAS_LIMITE_RISCO', 15)) # Faltas que, sozinhas, colocam o aluno em risco
+ALUNOS_EM_RISCO_MAX = int(os.environ.get('ALUNOS_EM_RISCO_MAX', 20)) # Alunos em risco listados por disciplina/semestre
+
+# --- CONFIGURAÇÃO DO CANAL WHATSAPP/SMS (Twilio) ---
+TWILIO_ACCOUNT_SID = os.environ.get('TWILIO_ACCOUNT_SID')
+TWILIO_AUTH_TOKEN = os.environ.get('TWILIO_AUTH_TOKEN')
+# Base da API REST; aponte para um servidor local para testar sem a Twilio
+TWILIO_API_BASE = os.environ.get('TWILIO_API_BASE', 'https://api.twilio.com').rstrip('/')
+TWILIO_VALIDAR_ASSINATURA = os.environ.get('TWILIO_VALIDAR_ASSINATURA', '1') == '1'
+TWILIO_WORKERS = int(os.environ.get('TWILIO_WORKERS', 4)) # Threads que processam as mensagens recebidas
+TWILIO_FILA_MAX = int(os.environ.get('TWILIO_FILA_MAX', 200)) # Mensagens pendentes antes de recusar com aviso
+TWILIO_MAX_CHARS = int(os.environ.get('TWILIO_MAX_CHARS', 1500)) # Tamanho de cada parte (WhatsApp aceita até 1600)
+TWILIO_DEDUP_TTL = int(os.environ.get('TWILIO_DEDUP_TTL', 3600)) # Janela (s) para ignorar reentregas do mesmo MessageSid
+TWILIO_TIMEOUT = float(os.environ.get('TWILIO_TIMEOUT', 15)) # Tempo máximo (s) de cada chamada à API REST
+TWILIO_MAX_TENTATIVAS = int(os.environ.get('TWILIO_MAX_TENTATIVAS', 3)) # Inclui o primeiro envio
+TWILIO_BACKOFF_BASE = float(os.environ.get('TWILIO_BACKOFF_BASE', 0.5)) # Backoff exponencial com jitter (s)
+TWILIO_BACKOFF_MAX = float(os.environ.get('TWILIO_BACKOFF_MAX', 8))
+if TWILIO_MAX_TENTATIVAS < 1:
+    raise Exception(f"ERRO CRÍTICO: TWILIO_MAX_TENTATIVAS deve ser pelo menos 1 (o primeiro envio conta como tentativa); recebido {TWILIO_MAX_TENTATIVAS}.")
+
+# --- CONFIGURAÇÃO DOS ARQUIVOS ESTÁTICOS ---
+ASSETS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'static')
+ASSETS_PAGINA = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'joker_bot.html')
+# Variantes WebP/AVIF já codificadas (por hash do original), para não recodificar a cada deploy/worker
+ASSETS_CACHE_DIR = os.environ.get('ASSETS_CACHE_DIR', os.path.join(tempfile.gettempdir(), 'joker-assets'))
+ASSETS_MAX_AGE_SEM_HASH = int(os.environ.get('ASSETS_MAX_AGE_SEM_HASH', 300)) # Cache (s) das URLs antigas, sem hash
+ASSETS_QUALIDADE_WEBP = int(os.environ.get('ASSETS_QUALIDADE_WEBP', 80))
+ASSETS_QUALIDADE_AVIF = int(os.environ.get('ASSETS_QUALIDADE_AVIF', 60))
+
 # --- VARIÁVEL GLOBAL DE NOTA DE CORTE ---
 NOTA_CORTE_APROVACAO = 7.0 # Nota de corte final: 7.0
 
-# --- 1. SCRIPT SQL COMPLETO ---
-# CRUCIAL: Mantém a inicialização das EDs com uma nota (Media_Final = 6.0), mas o status de "Completa"
-# será fixo na função de leitura.
-SQL_SCRIPT_CONTENT = """
+# --- 1. MIGRAÇÕES DO BANCO DE DADOS (versionadas) ---
+# Cada migração roda UMA vez por banco, na ordem da versão, e fica registrada em Schema_Migracoes.
+# Aplicadas no boot do gunicorn (ver gunicorn.conf.py) ou manualmente com: flask --app app migrate
+# Os comandos continuam idempotentes (IF NOT EXISTS / ON CONFLICT) para bancos criados antes do versionamento.
+# Nunca altere uma migração já publicada: crie uma nova versão.
+
+SQL_MIGRACAO_001_TABELAS = """
 -- CRIAÇÃO DAS TABELAS
 CREATE TABLE IF NOT EXISTS Alunos (
     id_aluno SERIAL PRIMARY KEY, -- SERIAL para autoincremento no PostgreSQL
@@ -57,7 +212,11 @@ CREATE TABLE IF NOT EXISTS Historico_Academico (
     FOREIGN KEY (fk_id_disciplina) REFERENCES Disciplinas(id_disciplina),
     UNIQUE (fk_id_aluno, fk_id_disciplina)
 );
+"""
 
+# CRUCIAL: Mantém a inicialização das EDs com uma nota (Media_Final = 6.0), mas o status de "Completa"
+# será fixo na função de leitura.
+SQL_MIGRACAO_002_SEED = """
 -- POPULANDO A TABELA DISCIPLINAS
 INSERT INTO Disciplinas (Nome_Disciplina, Semestre, Tipo_Avaliacao) VALUES
 ('Introdução à Programação', 1, 'TEORICA'),
@@ -109,8 +268,111 @@ CROSS JOIN Disciplinas D
 ON CONFLICT (fk_id_aluno, fk_id_disciplina) DO NOTHING;
 """
 
+SQL_MIGRACAO_003_CACHE_MATERIAL = """
+-- CACHE PERSISTENTE DO MATERIAL DE ESTUDO GERADO PELO GEMINI (chave = tópico normalizado)
+CREATE TABLE IF NOT EXISTS Cache_Material_Estudo (
+    Chave VARCHAR(200) PRIMARY KEY,
+    Topico VARCHAR(200) NOT NULL,
+    Conteudo TEXT NOT NULL,
+    Criado_Em TIMESTAMPTZ NOT NULL DEFAULT NOW()
+);
+"""
+
+SQL_MIGRACAO_004_HISTORICO_EXIBICAO = """
+-- HISTÓRICO PRONTO PARA EXIBIÇÃO (materializado): uma linha por aluno/disciplina não-PIM, com PIM,
+-- média e status já calculados. Atualizado pelas escritas apenas para o aluno afetado.
+CREATE TABLE IF NOT EXISTS Historico_Exibicao (
+    fk_id_aluno INT NOT NULL,
+    fk_id_disciplina INT NOT NULL,
+    RA VARCHAR(10) NOT NULL,
+    Nome_Completo VARCHAR(100) NOT NULL,
+    Semestre INT NOT NULL,
+    Nome_Disciplina VARCHAR(100) NOT NULL,
+    Tipo_Avaliacao VARCHAR(10) NOT NULL,
+    NP1 VARCHAR(10) NOT NULL,
+    NP2 VARCHAR(10) NOT NULL,
+    PIM_Nota VARCHAR(10) NOT NULL,
+    Media_Final VARCHAR(10) NOT NULL,
+    Faltas INT NULL,
+    Status_Conclusao VARCHAR(20) NOT NULL,
+    PRIMARY KEY (fk_id_aluno, fk_id_disciplina)
+);
+CREATE INDEX IF NOT EXISTS idx_historico_exibicao_ra ON Historico_Exibicao (RA);
+"""
+
+SQL_MIGRACAO_008_RESUMO_DESEMPENHO = """
+-- RESUMO DE DESEMPENHO (materializado): estatísticas por disciplina e por semestre para os painéis.
+-- fk_id_disciplina = 0 é a linha do semestre inteiro. Recalculado por SQL_ATUALIZAR_RESUMO_DESEMPENHO.
+CREATE TABLE IF NOT EXISTS Resumo_Desempenho (
+    Semestre INT NOT NULL,
+    fk_id_disciplina INT NOT NULL,
+    Nome_Disciplina VARCHAR(100) NOT NULL,
+    Tipo_Avaliacao VARCHAR(10) NOT NULL,
+    Total_Alunos INT NOT NULL,
+    Alunos_Com_Media INT NOT NULL,
+    Media_Geral NUMERIC(4, 2) NULL,
+    Aprovados INT NOT NULL,
+    Reprovados INT NOT NULL,
+    Taxa_Aprovacao NUMERIC(5, 2) NULL, -- % dos alunos com média calculada
+    Faltas_Media NUMERIC(6, 2) NULL,
+    Faltas_Mediana NUMERIC(6, 2) NULL,
+    Faltas_P90 NUMERIC(6, 2) NULL,
+    Faltas_Max INT NULL,
+    Faixas_Faltas JSONB NOT NULL,
+    Total_Em_Risco INT NOT NULL,
+    Alunos_Em_Risco JSONB NOT NULL, -- Até ALUNOS_EM_RISCO_MAX, piores médias primeiro
+    Atualizado_Em TIMESTAMPTZ NOT NULL DEFAULT NOW(),
+    PRIMARY KEY (Semestre, fk_id_disciplina)
+);
+"""
+
+SQL_MIGRACAO_010_FILA_MATERIAL = """
+-- FILA DE GERAÇÃO DE MATERIAL DE ESTUDO: consumida pelos workers com FOR UPDATE SKIP LOCKED.
+-- Status: pendente -> executando -> concluido | falhou | cancelado (falhas voltam a 'pendente' até Max_Tentativas).
+CREATE TABLE IF NOT EXISTS Fila_Material (
+    id_job BIGSERIAL PRIMARY KEY,
+    Chave VARCHAR(200) NOT NULL, -- Tópico normalizado (mesma chave do Cache_Material_Estudo)
+    Topico VARCHAR(200) NOT NULL,
+    Solicitante VARCHAR(100) NOT NULL, -- RA/funcional/telefone: limite de taxa do Gemini por usuário
+    Status VARCHAR(12) NOT NULL DEFAULT 'pendente',
+    Tentativas INT NOT NULL DEFAULT 0,
+    Max_Tentativas INT NOT NULL,
+    Disponivel_Em TIMESTAMPTZ NOT NULL DEFAULT NOW(), -- Backoff entre tentativas
+    Lease_Ate TIMESTAMPTZ NULL, -- Prazo do worker que pegou o job; vencido, o job volta para a fila
+    Resultado TEXT NULL,
+    Erro TEXT NULL,
+    Criado_Em TIMESTAMPTZ NOT NULL DEFAULT NOW(),
+    Atualizado_Em TIMESTAMPTZ NOT NULL DEFAULT NOW()
+);
+-- Um job ativo por tópico: pedidos repetidos reaproveitam o job em andamento
+CREATE UNIQUE INDEX IF NOT EXISTS idx_fila_material_ativo
+    ON Fila_Material (Chave) WHERE Status IN ('pendente', 'executando');
+CREATE INDEX IF NOT EXISTS idx_fila_material_proximos
+    ON Fila_Material (Disponivel_Em, id_job) WHERE Status IN ('pendente', 'executando');
+"""
+
+# Número de WhatsApp/SMS vinculado pelo próprio aluno logado no site (POST /telefone): o canal da Twilio
+# só mostra notas para números vinculados
+SQL_MIGRACAO_012_TELEFONE = """
+ALTER TABLE Alunos ADD COLUMN IF NOT EXISTS Telefone VARCHAR(20) NULL;
+CREATE UNIQUE INDEX IF NOT EXISTS idx_alunos_telefone
+    ON Alunos (Telefone) INCLUDE (id_aluno, RA) WHERE Telefone IS NOT NULL;
+"""
+
+# Pedidos de material feitos pelo WhatsApp/SMS: o worker envia o material ao terminar o job
+SQL_MIGRACAO_013_ENTREGAS_MATERIAL = """
+CREATE TABLE IF NOT EXISTS Entregas_Material (
+    fk_id_job BIGINT NOT NULL REFERENCES Fila_Material (id_job) ON DELETE CASCADE,
+    Destino VARCHAR(64) NOT NULL, -- Quem pediu ('whatsapp:+55...' ou '+55...')
+    Origem VARCHAR(64) NOT NULL, -- Número da Twilio que recebeu o pedido (remetente da resposta)
+    Criado_Em TIMESTAMPTZ NOT NULL DEFAULT NOW(),
+    PRIMARY KEY (fk_id_job, Destino)
+);
+"""
+
 # --- INICIALIZAÇÃO DO FLASK E GEMINI ---
-app = Flask(__name__)
+# Os estáticos passam pelo pipeline de assets (seção 6), não pela rota /static padrão do Flask
+app = Flask(__name__, static_folder=None)
 CORS(app)
 client = None
 
@@ -123,578 +385,4064 @@ if API_KEY_GEMINI:
 else:
     print("⚠️ Chave API do Gemini ausente. A Op. 2 e o roteador não funcionarão.")
 
+if not os.environ.get('SESSAO_TOKEN_SEGREDO'):
+    print(
+        "⚠️ SESSAO_TOKEN_SEGREDO ausente: os tokens de sessão usam uma chave aleatória deste boot. "
+        "Todo restart/deploy desloga os usuários e outras instâncias recusam os tokens desta."
+    )
 
-# --- 2. FUNÇÕES DE SUPORTE AO BANCO DE DADOS E CÁLCULOS ---
-
-def init_db():
-    """Cria e popula o banco de dados. Chamado apenas uma vez, na primeira requisição."""
-    if not DATABASE_URL:
-        print("❌ ERRO CRÍTICO: VARIÁVEL DATABASE_URL AUSENTE. O banco de dados PostgreSQL não pode ser inicializado.")
-        return False
-        
-    conn = None
-    try:
-        print("⏳ Tentando conectar e inicializar o banco de dados PostgreSQL...")
-        conn = psycopg2.connect(DATABASE_URL)
-        cursor = conn.cursor()
-        cursor.execute(SQL_SCRIPT_CONTENT)
-        conn.commit()
-        print("✅ Banco de dados PostgreSQL verificado e pronto para uso.")
-        return True
-    except Psycopg2Error as e:
-        print(f"❌ ERRO GRAVE na inicialização do banco de dados (PostgreSQL): {e}")
-        return False    
-    finally:
-        if conn:
-            conn.close()
 
-def get_db_connection():
-    """Retorna uma nova conexão ao banco de dados."""
-    if not DATABASE_URL:
-        raise Exception("ERRO: DATABASE_URL não configurada. Conexão ao DB falhou.")
-        
-    try:
-        conn = psycopg2.connect(DATABASE_URL)
-        # Usamos o RealDictCursor para retornar resultados como dicionários (keys são nomes das colunas)
-        return conn, conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor) 
-    except Psycopg2Error as e:
-        raise Exception(f"ERRO DE CONEXÃO AO POSTGRESQL: Não foi possível conectar ao DB. Detalhe: {e}")
-    except Exception as e:
-        raise Exception(f"ERRO DESCONHECIDO NA CONEXÃO AO DB: {e}")
+# --- OBSERVABILIDADE (métricas no formato Prometheus e logs JSON por requisição) ---
 
+# Limites (s) dos buckets: do acesso ao pool (ms) até chamadas longas ao Gemini
+BUCKETS_DURACAO = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
 
-def formatar_valor(valor):
-    """Auxiliar para formatar números ou retornar None."""
-    if valor is None:
-        return None
-    try:
-        # Garante a formatação para 2 casas decimais, mesmo para valores inteiros
-        return f"{float(valor):.2f}"
-    except (ValueError, TypeError):
-        return None
 
-def calcular_media_final(np1, np2, pim_nota):
-    """Calcula a média final usando a fórmula: (NP1*4 + NP2*4 + PIM*2) / 10"""
-    if np1 is None or np2 is None or pim_nota is None:
-        return None    
-    try:
-        np1 = float(np1)
-        np2 = float(np2)
-        pim_nota = float(pim_nota)
-        # Nota: O cálculo usa a fórmula unificada para EDs e TEÓRICAS
-        media = (np1 * 4 + np2 * 4 + pim_nota * 2) / 10
-        return round(media, 2)
-    except (ValueError, TypeError):
-        return None
-        
-def _get_pim_nota(conn, cursor, id_aluno, semestre):
-    """Busca a nota PIM de um aluno para um semestre específico."""
-    pim_sql = """
-    SELECT H.Media_Final 
-    FROM Historico_Academico H
-    JOIN Disciplinas D ON H.fk_id_disciplina = D.id_disciplina
-    WHERE H.fk_id_aluno = %s AND D.Semestre = %s AND D.Tipo_Avaliacao = 'PIM'
-    """
-    cursor.execute(pim_sql, (id_aluno, semestre))
-    pim_result = cursor.fetchone()
-    # Retorna o valor float do campo 'media_final' ou None
-    return float(pim_result['media_final']) if pim_result and pim_result['media_final'] is not None else None
+class Histograma:
+    """Histograma cumulativo por combinação de labels, exportado no formato de texto do Prometheus."""
 
-def _get_all_pim_notas(conn, cursor, id_aluno):
-    """Busca todas as notas PIM de um aluno e retorna um dicionário {semestre: nota_pim}."""
-    pim_sql = """
-    SELECT D.Semestre, H.Media_Final 
-    FROM Historico_Academico H
-    JOIN Disciplinas D ON H.fk_id_disciplina = D.id_disciplina
-    WHERE H.fk_id_aluno = %s AND D.Tipo_Avaliacao = 'PIM'
-    """
-    cursor.execute(pim_sql, (id_aluno,))
-    results = cursor.fetchall()
-    
-    pim_notas = {}
-    for res in results:
-        # Store as float or None
-        pim_notas[res['semestre']] = float(res['media_final']) if res['media_final'] is not None else None
-    return pim_notas
-
-def _recalcular_e_salvar_media_geral(conn, cursor, id_aluno, nome_disciplina):
-    """Recalcula e salva a Media_Final para QUALQUER disciplina que não seja PIM."""
-    sql_dados = """
-    SELECT 
-        H.id_registro, H.NP1, H.NP2, D.Semestre, D.Tipo_Avaliacao
-    FROM Historico_Academico H
-    JOIN Disciplinas D ON H.fk_id_disciplina = D.id_disciplina
-    WHERE H.fk_id_aluno = %s AND D.Nome_Disciplina = %s AND D.Tipo_Avaliacao != 'PIM';
-    """
-    cursor.execute(sql_dados, (id_aluno, nome_disciplina))
-    reg = cursor.fetchone()
+    def __init__(self, nome: str, descricao: str, labels: tuple, buckets=BUCKETS_DURACAO):
+        self.nome = nome
+        self.descricao = descricao
+        self.labels = labels
+        self.buckets = buckets
+        self._series = {}  # valores dos labels -> [contagens por bucket, soma, total]
+        self._lock = threading.Lock()
 
-    if not reg:
-        return False, "Disciplina não encontrada ou é PIM."
+    def observar(self, valor: float, *valores_labels):
+        with self._lock:
+            serie = self._series.setdefault(valores_labels, [[0] * len(self.buckets), 0.0, 0])
+            for i, limite in enumerate(self.buckets):
+                if valor <= limite:
+                    serie[0][i] += 1
+            serie[1] += valor
+            serie[2] += 1
 
-    # Nota PIM é buscada como float
-    pim_nota = _get_pim_nota(conn, cursor, id_aluno, reg['semestre'])
-    # np1 e np2 são numéricos, serão convertidos para float dentro da função
-    media = calcular_media_final(reg['np1'], reg['np2'], pim_nota)
-    
-    sql_update = """
-    UPDATE Historico_Academico SET Media_Final = %s WHERE id_registro = %s
-    """
-    # Salva a média como NUMERIC no DB
-    cursor.execute(sql_update, (media, reg['id_registro']))
-    conn.commit()
-    
-    return True, media
+    def exportar(self) -> list:
+        linhas = [f"# HELP {self.nome} {self.descricao}", f"# TYPE {self.nome} histogram"]
+        with self._lock:
+            series = {k: (list(v[0]), v[1], v[2]) for k, v in self._series.items()}
+        for valores_labels, (contagens, soma, total) in sorted(series.items()):
+            base = _formatar_labels(self.labels, valores_labels)
+            for limite, contagem in zip(self.buckets, contagens):
+                linhas.append(f'{self.nome}_bucket{{{base}{"," if base else ""}le="{limite}"}} {contagem}')
+            linhas.append(f'{self.nome}_bucket{{{base}{"," if base else ""}le="+Inf"}} {total}')
+            linhas.append(f"{self.nome}_sum{{{base}}} {soma}")
+            linhas.append(f"{self.nome}_count{{{base}}} {total}")
+        return linhas
 
 
-def _recalcular_todas_medias_do_semestre(conn, cursor, id_aluno, semestre):
-    """Recalcula a média de TODAS as disciplinas (que não são PIM) de um semestre, usando a nova nota PIM."""
-    # Nota PIM é buscada como float
-    pim_nota = _get_pim_nota(conn, cursor, id_aluno, semestre)
-    
-    sql_disciplinas_calculo = """
-    SELECT 
-        H.id_registro, H.NP1, H.NP2, D.Nome_Disciplina
-    FROM Historico_Academico H
-    JOIN Disciplinas D ON H.fk_id_disciplina = D.id_disciplina
-    WHERE H.fk_id_aluno = %s AND D.Semestre = %s AND D.Tipo_Avaliacao != 'PIM';
-    """
-    cursor.execute(sql_disciplinas_calculo, (id_aluno, semestre))
-    registros_calculo = cursor.fetchall()
-    
-    if not registros_calculo:
-        return 0
-        
-    for reg in registros_calculo:
-        # np1 e np2 são numéricos, serão convertidos para float dentro da função
-        media = calcular_media_final(reg['np1'], reg['np2'], pim_nota)
-        
-        sql_update = """
-        UPDATE Historico_Academico SET Media_Final = %s WHERE id_registro = %s
-        """
-        # Salva a média como NUMERIC no DB
-        cursor.execute(sql_update, (media, reg['id_registro']))
-        
-    conn.commit()
-    return len(registros_calculo)
+class Contador:
+    """Contador monotônico por combinação de labels."""
 
+    def __init__(self, nome: str, descricao: str, labels: tuple):
+        self.nome = nome
+        self.descricao = descricao
+        self.labels = labels
+        self._series = {}
+        self._lock = threading.Lock()
 
-# --- 3. FUNÇÕES DE OPERAÇÃO (LÓGICA CORE: Leitura e Escrita) ---
+    def incrementar(self, *valores_labels, valor=1):
+        with self._lock:
+            self._series[valores_labels] = self._series.get(valores_labels, 0) + valor
 
-# --- OPERAÇÕES DE ESCRITA (Professor Tools) ---
+    def exportar(self) -> list:
+        linhas = [f"# HELP {self.nome} {self.descricao}", f"# TYPE {self.nome} counter"]
+        with self._lock:
+            series = dict(self._series)
+        for valores_labels, valor in sorted(series.items()):
+            linhas.append(f"{self.nome}{{{_formatar_labels(self.labels, valores_labels)}}} {valor}")
+        return linhas
 
-def lancar_nota_np_api(ra_aluno: str, nome_disciplina: str, np_qual: str, nota: float) -> dict:
-    """Lança a nota NP1 ou NP2 e recalcula a Média Final se possível."""
-    ra_aluno = ra_aluno.upper().strip()
-    nome_disciplina = nome_disciplina.strip()
-    np_qual = np_qual.upper().strip()
 
-    if np_qual not in ['NP1', 'NP2'] or not (0.0 <= nota <= 10.0):
-        return {"status": "error", "message": "Parâmetros inválidos. Use NP1 ou NP2 com nota entre 0.0 e 10.0."}
-    
-    conn, cursor = get_db_connection()
-    
-    try:
-        sql_info = """
-        SELECT A.id_aluno, D.Tipo_Avaliacao 
-        FROM Alunos A
-        JOIN Historico_Academico H ON A.id_aluno = H.fk_id_aluno
-        JOIN Disciplinas D ON H.fk_id_disciplina = D.id_disciplina
-        WHERE A.RA = %s AND D.Nome_Disciplina = %s;
-        """
-        cursor.execute(sql_info, (ra_aluno, nome_disciplina))
-        info = cursor.fetchone()
+def _formatar_labels(nomes: tuple, valores: tuple) -> str:
+    def escapar(v):
+        return str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+    return ",".join(f'{n}="{escapar(v)}"' for n, v in zip(nomes, valores))
 
-        if not info:
-            conn.close()
-            return {"status": "error", "message": f"Aluno/Disciplina '{ra_aluno}'/'{nome_disciplina}' não encontrados."}
-        
-        if info['tipo_avaliacao'] == 'PIM':
-            conn.close()
-            return {"status": "error", "message": f"Lançamento de NP1/NP2 não permitido para disciplinas do tipo PIM. Use a função de lançamento PIM."}
 
-        sql_update_np = f"""
-        UPDATE Historico_Academico 
-        SET {np_qual} = %s
-        WHERE fk_id_aluno = %s 
-        AND fk_id_disciplina = (SELECT id_disciplina FROM Disciplinas WHERE Nome_Disciplina = %s);
-        """
-        cursor.execute(sql_update_np, (nota, info['id_aluno'], nome_disciplina))
+METRICA_ETAPAS = Histograma(
+    'joker_etapa_duracao_segundos',
+    'Duração de cada etapa de um turno do chat (roteador/formatação no Gemini, ferramentas, DB e pool).',
+    ('etapa', 'nome')
+)
+METRICA_ERROS_ETAPAS = Contador('joker_etapa_erros_total', 'Etapas que terminaram com exceção.', ('etapa', 'nome'))
+METRICA_REQUISICOES = Histograma(
+    'joker_requisicao_duracao_segundos', 'Duração das requisições HTTP por rota.', ('rota', 'metodo')
+)
+METRICA_RESPOSTAS = Contador('joker_requisicoes_total', 'Requisições HTTP por rota e status.', ('rota', 'metodo', 'status'))
 
-        sucesso, media = _recalcular_e_salvar_media_geral(conn, cursor, info['id_aluno'], nome_disciplina)
-        
-        conn.close()
+# Request ID e etapas medidas na requisição atual (uma requisição por thread no gthread)
+_contexto_requisicao = threading.local()
 
-        status_media = f"Média Final calculada e salva: {media:.2f}" if media is not None else "Média Final pendente (PIM ou outra NP faltando)."
-        return {"status": "success", "message": f"Nota {np_qual} ({nota:.2f}) lançada para {nome_disciplina} ({ra_aluno}). {status_media}"}
 
-    except Psycopg2Error as e:
-        conn.close()
-        return {"status": "error", "message": f"Erro no lançamento da nota NP: {e}"}
+class medir:
+    """
+    Context manager que cronometra uma etapa: alimenta METRICA_ETAPAS e anota a duração na requisição
+    atual para o log JSON. Ex.: 'with medir("db_query", "login_aluno"): ...'.
+    """
 
-def lancar_nota_pim_api(ra_aluno: str, nome_disciplina_pim: str, nota: float) -> dict:
-    """Lança a nota PIM e recalcula a Média Final de todas as disciplinas do semestre."""
-    ra_aluno = ra_aluno.upper().strip()
-    nome_disciplina_pim = nome_disciplina_pim.strip()
+    def __init__(self, etapa: str, nome: str = ''):
+        self.etapa = etapa
+        self.nome = nome
 
-    if not (0.0 <= nota <= 10.0):
-        return {"status": "error", "message": "Nota PIM inválida. Deve estar entre 0.0 e 10.0."}
-    
-    conn, cursor = get_db_connection()
-    
-    try:
-        sql_info = """
-        SELECT A.id_aluno, D.Tipo_Avaliacao, D.Semestre
-        FROM Alunos A
-        JOIN Historico_Academico H ON A.id_aluno = H.fk_id_aluno
-        JOIN Disciplinas D ON H.fk_id_disciplina = D.id_disciplina
-        WHERE A.RA = %s AND D.Nome_Disciplina = %s;
-        """
-        cursor.execute(sql_info, (ra_aluno, nome_disciplina_pim))
-        info = cursor.fetchone()
+    def __enter__(self):
+        self.inicio = time.perf_counter()
+        return self
 
-        if not info:
-            conn.close()
-            return {"status": "error", "message": f"Aluno/Disciplina PIM '{ra_aluno}'/'{nome_disciplina_pim}' não encontrados."}
-        
-        if info['tipo_avaliacao'] != 'PIM':
-            conn.close()
-            return {"status": "error", "message": f"'{nome_disciplina_pim}' não é uma disciplina PIM. - Joker."}
+    def __exit__(self, tipo_excecao, excecao, tb):
+        duracao = time.perf_counter() - self.inicio
+        METRICA_ETAPAS.observar(duracao, self.etapa, self.nome)
+        if tipo_excecao is not None:
+            METRICA_ERROS_ETAPAS.incrementar(self.etapa, self.nome)
+        etapas = getattr(_contexto_requisicao, 'etapas', None)
+        if etapas is not None:
+            etapas.append({"etapa": self.etapa, "nome": self.nome, "ms": round(duracao * 1000, 2), "erro": tipo_excecao is not None})
+        return False
 
-        sql_update_pim = """
-        UPDATE Historico_Academico 
-        SET Media_Final = %s
-        WHERE fk_id_aluno = %s
-        AND fk_id_disciplina = (SELECT id_disciplina FROM Disciplinas WHERE Nome_Disciplina = %s);
-        """
-        cursor.execute(sql_update_pim, (nota, info['id_aluno'], nome_disciplina_pim))
 
-        count_calculadas = _recalcular_todas_medias_do_semestre(conn, cursor, info['id_aluno'], info['semestre'])
-        
-        conn.close()
+def log_json(evento: str, **campos):
+    """Imprime uma linha de log JSON com o request ID da requisição atual (quando houver)."""
+    registro = {"ts": round(time.time(), 3), "evento": evento}
+    request_id = getattr(_contexto_requisicao, 'request_id', None)
+    if request_id:
+        registro["request_id"] = request_id
+    registro.update(campos)
+    print(json.dumps(registro, ensure_ascii=False, default=str), flush=True)
 
-        return {"status": "success", "message": f"Nota PIM ({nota:.2f}) lançada para o semestre {info['semestre']} ({ra_aluno}). {count_calculadas} Média(s) Final(is) recalculada(s). (Incluindo EDs)."}
 
-    except Psycopg2Error as e:
-        conn.close()
-        return {"status": "error", "message": f"Erro no lançamento da nota PIM: {e}"}
+@app.before_request
+def _iniciar_contexto_requisicao():
+    _contexto_requisicao.request_id = request.headers.get('X-Request-ID') or uuid.uuid4().hex
+    _contexto_requisicao.etapas = []
+    _contexto_requisicao.inicio = time.perf_counter()
+    _contexto_requisicao.usuario = None
+    _contexto_requisicao.jobs_material = []
 
-def lancar_faltas_api(ra_aluno: str, nome_disciplina: str, faltas: int) -> dict:
-    """Lança o número de faltas para uma disciplina."""
-    ra_aluno = ra_aluno.upper().strip()
-    nome_disciplina = nome_disciplina.strip()
 
-    if faltas < 0:
-        return {"status": "error", "message": "Número de faltas inválido."}
-    
-    conn, cursor = get_db_connection()
+@app.after_request
+def _finalizar_contexto_requisicao(response):
+    inicio = getattr(_contexto_requisicao, 'inicio', None)
+    if inicio is None:
+        return response
+    duracao = time.perf_counter() - inicio
+    # Rota do url_map (ex.: '/<path:filename>') para não criar uma série por arquivo
+    rota = request.url_rule.rule if request.url_rule else 'desconhecida'
+    METRICA_REQUISICOES.observar(duracao, rota, request.method)
+    METRICA_RESPOSTAS.incrementar(rota, request.method, str(response.status_code))
+    response.headers['X-Request-ID'] = _contexto_requisicao.request_id
+    if rota != '/metrics':
+        # Em respostas SSE o corpo ainda será gerado; as etapas do stream ficam só nas métricas
+        log_json(
+            "requisicao", rota=rota, metodo=request.method, status=response.status_code,
+            duracao_ms=round(duracao * 1000, 2), etapas=_contexto_requisicao.etapas
+        )
+    _contexto_requisicao.inicio = None
+    return response
 
-    try:
-        sql_info = """
-        SELECT A.id_aluno, D.Tipo_Avaliacao 
-        FROM Alunos A
-        JOIN Historico_Academico H ON A.id_aluno = H.fk_id_aluno
-        JOIN Disciplinas D ON H.fk_id_disciplina = D.id_disciplina
-        WHERE A.RA = %s AND D.Nome_Disciplina = %s;
-        """
-        cursor.execute(sql_info, (ra_aluno, nome_disciplina))
-        info = cursor.fetchone()
 
-        if not info:
-            conn.close()
-            return {"status": "error", "message": f"Aluno/Disciplina '{ra_aluno}'/'{nome_disciplina}' não encontrados."}
-        
-        sql_update_faltas = """
-        UPDATE Historico_Academico 
-        SET Faltas = %s
-        WHERE fk_id_aluno = %s
-        AND fk_id_disciplina = (SELECT id_disciplina FROM Disciplinas WHERE Nome_Disciplina = %s);
-        """
-        cursor.execute(sql_update_faltas, (faltas, info['id_aluno'], nome_disciplina))
-        conn.commit()
-        conn.close()
-        
-        aviso = ""
-        if info['tipo_avaliacao'] == 'PIM':
-             aviso = f" (AVISO: '{nome_disciplina}' é PIM e pode não ter controle de faltas.)"
+# --- GATEWAY DO GEMINI (single-flight, limites de taxa, retentativas e descarte de carga) ---
 
-        return {"status": "success", "message": f"Lançadas {faltas} faltas para '{nome_disciplina}' ({ra_aluno}).{aviso}"}
+# Resposta do Joker quando o Gemini está saturado (sem o prefixo "Joker:", que cada chamador acrescenta)
+MENSAGEM_SOBRECARGA = (
+    "O Palácio está lotado agora — muita gente pedindo ao mesmo tempo. "
+    "Take your time: respire fundo e tente de novo em alguns segundos."
+)
 
-    except Psycopg2Error as e:
-        conn.close()
-        return {"status": "error", "message": f"Erro no lançamento de faltas: {e}"}
+METRICA_GATEWAY = Contador(
+    'joker_gemini_gateway_total',
+    'Chamadas ao gateway do Gemini por desfecho (lider, seguidor, retentativa, recusada_usuario, recusada_global, esgotada, cota, tempo_esgotado).',
+    ('desfecho',)
+)
 
 
-# --- OPERAÇÃO DE LEITURA (Consulta) ---
+class GeminiSobrecarregado(Exception):
+    """Chamada recusada pelos limites de taxa ou com 429/5xx persistentes: o chamador responde MENSAGEM_SOBRECARGA."""
 
-def verificar_dados_curso_api(ra_aluno: str) -> dict:
-    """Busca o histórico ajustado com a nova regra de corte (7.0)."""
-    global NOTA_CORTE_APROVACAO
-    ra_aluno = ra_aluno.upper().strip()
 
-    comando_sql_join = """
-    SELECT
-    A.Nome_Completo, A.id_aluno, D.Nome_Disciplina, D.Semestre, D.Tipo_Avaliacao,
-    H.NP1, H.NP2, H.Media_Final, H.Faltas
-    FROM Historico_Academico H
-    JOIN Alunos A ON H.fk_id_aluno = A.id_aluno
-    JOIN Disciplinas D ON H.fk_id_disciplina = D.id_disciplina
-    WHERE A.RA = %s
-    ORDER BY D.Semestre, D.Tipo_Avaliacao DESC, D.Nome_Disciplina;
+class GeminiIndisponivel(GeminiSobrecarregado):
+    """
+    O modelo não respondeu: tempo esgotado, cota (429) ou 429/5xx persistentes. A PoliticaModelos tenta o
+    próximo modelo da tarefa; sem fallback, o chamador trata como GeminiSobrecarregado.
     """
 
-    conn, cursor = get_db_connection()
+    def __init__(self, mensagem: str, motivo: str):
+        super().__init__(mensagem)
+        self.motivo = motivo  # 'tempo_esgotado', 'cota' ou 'esgotada'
 
-    try:
-        cursor.execute(comando_sql_join, (ra_aluno,))
-        registros = cursor.fetchall()
 
-        if not registros:
-            cursor.execute("SELECT Nome_Completo, Tipo_Usuario FROM Alunos WHERE RA = %s", (ra_aluno,))
-            info_user = cursor.fetchone()
-            
-            conn.close()
-            
-            if info_user:
-                return {"status": "error", "message": f"O usuário '{info_user['nome_completo']}' ({ra_aluno}) não possui histórico acadêmico registrado."}
-            
-            return {"status": "error", "message": f"A credencial '{ra_aluno}' não foi encontrada."}
+class TokenBucket:
+    """Token bucket clássico: 'taxa' fichas/s, acumulando até 'capacidade'."""
 
-        historico = []
-        id_aluno = registros[0]['id_aluno']
-        
-        # OTIMIZAÇÃO: Pré-busca de todas as notas PIM por semestre
-        pim_notas_por_semestre = _get_all_pim_notas(conn, cursor, id_aluno)
+    def __init__(self, taxa: float, capacidade: int):
+        self.taxa = taxa
+        self.capacidade = capacidade
+        self._fichas = float(capacidade)
+        self._atualizado_em = time.monotonic()
+        self._lock = threading.Lock()
 
-        for reg in registros:
-            tipo = reg['tipo_avaliacao'].upper()
-            semestre_atual = reg['semestre']
-            
-            # **MUDANÇA CRÍTICA:** Ignora o PIM da exibição, ele só é um valor de cálculo.
-            if tipo == 'PIM':
-                continue # Pula a disciplina PIM da lista de exibição
+    def consumir(self, espera_max: float = 0.0) -> bool:
+        """Consome uma ficha, esperando até 'espera_max' segundos por ela. Retorna False se não houver."""
+        limite = time.monotonic() + espera_max
+        while True:
+            with self._lock:
+                agora = time.monotonic()
+                self._fichas = min(self.capacidade, self._fichas + (agora - self._atualizado_em) * self.taxa)
+                self._atualizado_em = agora
+                if self._fichas >= 1:
+                    self._fichas -= 1
+                    return True
+                espera = (1 - self._fichas) / self.taxa
+            if agora + espera > limite:
+                return False
+            time.sleep(espera)
 
-            # Busca a nota PIM no dicionário pré-buscado
-            pim_nota_semestre = pim_notas_por_semestre.get(semestre_atual)
 
-            np1_val = formatar_valor(reg['np1'])
-            np2_val = formatar_valor(reg['np2'])
-            faltas_val = reg['faltas'] if reg['faltas'] is not None else None
-            
-            # Recalcula a média (o comportamento desejado é sempre usar a NP1/NP2/PIM, se disponíveis)
-            calculated_media = calcular_media_final(reg['np1'], reg['np2'], pim_nota_semestre)
-            media_display = formatar_valor(calculated_media) if calculated_media is not None else "Indefinida"
-            
-            faltas_exibicao = faltas_val if faltas_val is not None else "N/A"
-            
-            # Estrutura base para o JSON de retorno
-            disciplina_info = {
-                "semestre": reg['semestre'],
-                "disciplina": reg['nome_disciplina'],
-                "tipo": tipo,
-            }
-            
-            # Lógica de Status
-            media_float = float(media_display) if media_display and media_display != "Indefinida" else None
-            status_aprovacao = "Indefinido"
-
-            if media_float is not None:
-                if media_float >= NOTA_CORTE_APROVACAO:
-                    status_aprovacao = "Aprovado"
-                else:
-                    status_aprovacao = "Reprovado"
-            
-            # Campos de notas para TEORICA/ED
-            disciplina_info.update({
-                "np1": np1_val if np1_val is not None else "Indefinida",
-                "np2": np2_val if np2_val is not None else "Indefinida",
-                "pim_nota": formatar_valor(pim_nota_semestre) if pim_nota_semestre is not None else "Indefinida",
-                "media_final": media_display,
-                "faltas": faltas_exibicao,
-            })
-
-            if tipo == 'ED':
-                # EDs não possuem status de aprovação, pois são concluídas com presença.
-                disciplina_info['status_conclusao'] = "ED CONCLUIDO" 
-            else: # TEORICA
-                disciplina_info['status_conclusao'] = status_aprovacao
-            
-            historico.append(disciplina_info)
+class _Voo:
+    """Chamada em andamento: os seguidores esperam o evento e reaproveitam o resultado (ou a exceção) do líder."""
 
-        conn.close()
-        
-        # **INSTRUÇÃO DE FORMATAÇÃO DO GEMINI**
-        message_for_gemini = (
-            "**Instrução de Formatação:** Formate os dados do histórico a seguir em uma lista simples e objetiva, "
-            "separando as informações de cada disciplina com um traço (`-`). Use o formato: "
-            "**Disciplina: NP1: X / NP2: Y / PIM: Z / Média final: M / Status: S**."
-            f"Aluno(a): {registros[0]['nome_completo']} (RA: {ra_aluno})."
-        )
+    def __init__(self):
+        self.evento = threading.Event()
+        self.resultado = None
+        self.erro = None
 
-        return {
-            "status": "success",
-            "aluno": registros[0]['nome_completo'],
-            "ra": ra_aluno,
-            "historico": historico,
-            "message_for_gemini": message_for_gemini # Nova chave de instrução
-        }
 
-    except Psycopg2Error as e:
-        conn.close()
-        return {"status": "error", "message": f"Erro na consulta ao banco de dados (PostgreSQL): {e}"}
+class GeminiGateway:
+    """
+    Ponto único de saída para o Gemini:
+    - single-flight: chamadas idênticas simultâneas (mesmo modelo, conteúdo e config) viram uma só;
+    - token bucket por usuário (recusa imediata) e global (espera até GEMINI_ESPERA_MAX);
+    - retentativas com backoff exponencial e jitter em 429/5xx;
+    - GeminiSobrecarregado quando não há vaga ou as retentativas se esgotam, em vez de um erro 500;
+    - 'prazo' (time.monotonic) vira o timeout HTTP de cada tentativa e corta o backoff que não caberia nele.
+    O usuário vem de '_contexto_requisicao.usuario' (definido pelas rotas do chat).
+    """
 
+    MAX_BUCKETS_USUARIO = 10000
 
-def buscar_material_estudo_api(topico: str) -> dict:
-    """Gera material usando o Gemini e retorna a resposta."""
-    if not client:
-        return {"status": "error", "message": "A API do Gemini não está configurada corretamente."}
+    def __init__(self):
+        self.bucket_global = TokenBucket(GEMINI_RPS_GLOBAL, GEMINI_BURST_GLOBAL)
+        self._buckets_usuario = OrderedDict()
+        self._em_voo = {}
+        self._lock = threading.Lock()
 
-    prompt = (
-        f"Gere um material de estudo conciso e focado para o tópico '{topico}'. "
-        "Inclua:\n"
-        "1. Breve resumo.\n"
-        "2. Três pontos chave.\n"
-        "3. Um exercício prático (com resposta).\n"
-        "4. **Busque na web** e adicione **2 sugestões de links relevantes (vídeo-aulas ou artigos) sobre o tópico, formatados como links Markdown [Título](URL)**. "
-        "Responda em português. Mantenha o tom acadêmico-informal."
-        "Encaminhe todo o material gerado sob as especificações acima para o usuário para que ele possa vizualizar tudo e estudar."
-    )
+    def _bucket_do_usuario(self, usuario: str) -> TokenBucket:
+        with self._lock:
+            bucket = self._buckets_usuario.get(usuario)
+            if bucket is None:
+                bucket = self._buckets_usuario[usuario] = TokenBucket(GEMINI_RPS_USUARIO, GEMINI_BURST_USUARIO)
+                while len(self._buckets_usuario) > self.MAX_BUCKETS_USUARIO:
+                    self._buckets_usuario.popitem(last=False)
+            self._buckets_usuario.move_to_end(usuario)
+            return bucket
 
-    try:
-        # Nota: O prompt de busca é forte o suficiente para que o Gemini use o Grounding.
-        response = client.models.generate_content(
-            model='gemini-2.5-flash',
-            contents=prompt,
-        )
+    def _admitir_usuario(self, cobrar: bool = True):
+        if not cobrar:
+            return
+        usuario = getattr(_contexto_requisicao, 'usuario', None)
+        if usuario and not self._bucket_do_usuario(usuario).consumir():
+            METRICA_GATEWAY.incrementar('recusada_usuario')
+            raise GeminiSobrecarregado(f"Limite de pedidos do usuário {usuario} atingido.")
 
-        return {
-            "status": "success",
-            "topico": topico,
-            "resultado": response.text # <--- Retorna a chave 'resultado'
-        }
+    def _admitir_global(self):
+        if not self.bucket_global.consumir(GEMINI_ESPERA_MAX):
+            METRICA_GATEWAY.incrementar('recusada_global')
+            raise GeminiSobrecarregado("Limite global de chamadas ao Gemini atingido.")
 
-    except APIError as e:
-        return {"status": "error", "message": f"Erro na API do Gemini: {e}"}
-    except Exception as e:
-        return {"status": "error", "message": f"Ocorreu um erro inesperado ao gerar o conteúdo: {e}"}
+    @staticmethod
+    def _chave(model, contents, config) -> str:
+        if config is None:
+            config_repr = ''
+        else:
+            try:
+                config_repr = config.model_dump_json(exclude_none=True, exclude={'http_options'})
+            except Exception:
+                # Config com callables (tools) não serializa em JSON: o repr identifica as mesmas funções
+                config_repr = repr(config)
+        return f"{model}|{contents!r}|{config_repr}"
 
-# --- 4. CONFIGURAÇÃO DE FUNÇÕES (TOOLS) E ROUTER DE CONTEÚDO ---
+    @staticmethod
+    def _retentavel(erro: APIError) -> bool:
+        codigo = getattr(erro, 'code', None) or 0
+        return codigo == 429 or codigo >= 500
 
-# Mapeamento das ferramentas
-TOOLS = {
-    'verificar_historico_academico': verificar_dados_curso_api,
-    'gerar_material_estudo': buscar_material_estudo_api,
-    'lancar_nota_np': lancar_nota_np_api, 
+    @staticmethod
+    def _com_timeout(config, prazo):
+        """Config da tentativa com o tempo que resta até o prazo como timeout HTTP (em ms, como o SDK espera)."""
+        if prazo is None:
+            return config
+        restante = prazo - time.monotonic()
+        if restante <= 0:
+            METRICA_GATEWAY.incrementar('tempo_esgotado')
+            raise GeminiIndisponivel("Prazo da chamada ao Gemini esgotado antes da tentativa.", 'tempo_esgotado')
+        http_options = genai.types.HttpOptions(timeout=max(int(restante * 1000), 1))
+        if config is None:
+            return GenerateContentConfig(http_options=http_options)
+        return config.model_copy(update={'http_options': http_options})
+
+    def _tratar_erro(self, erro: Exception, model: str, tentativa: int, prazo, retentar_429: bool):
+        """Decide o que fazer com a falha de uma tentativa: espera o backoff ou levanta a exceção adequada."""
+        if isinstance(erro, httpx.TimeoutException):
+            METRICA_GATEWAY.incrementar('tempo_esgotado')
+            raise GeminiIndisponivel(f"{model} não respondeu dentro do prazo.", 'tempo_esgotado') from erro
+        if not self._retentavel(erro):
+            raise erro
+        if erro.code == 429 and not retentar_429:
+            # Cota do modelo: o próximo nível da política responde antes que o backoff terminaria
+            METRICA_GATEWAY.incrementar('cota')
+            raise GeminiIndisponivel(f"Cota de {model} esgotada: {erro}", 'cota') from erro
+        espera = random.uniform(0, min(GEMINI_BACKOFF_MAX, GEMINI_BACKOFF_BASE * 2 ** tentativa))
+        if tentativa == GEMINI_MAX_TENTATIVAS - 1 or (prazo is not None and time.monotonic() + espera >= prazo):
+            METRICA_GATEWAY.incrementar('esgotada')
+            raise GeminiIndisponivel(f"Gemini indisponível após {tentativa + 1} tentativa(s): {erro}", 'esgotada') from erro
+        print(f"⚠️ Gemini respondeu {erro.code}; nova tentativa ({tentativa + 2}/{GEMINI_MAX_TENTATIVAS}).")
+        METRICA_GATEWAY.incrementar('retentativa')
+        time.sleep(espera)
+
+    def _chamar_com_retentativas(self, model, contents, config, prazo, retentar_429):
+        for tentativa in range(GEMINI_MAX_TENTATIVAS):
+            try:
+                return client.models.generate_content(model=model, contents=contents, config=self._com_timeout(config, prazo))
+            except (APIError, httpx.TimeoutException) as e:
+                self._tratar_erro(e, model, tentativa, prazo, retentar_429)
+
+    def gerar(self, model: str, contents, config=None, prazo: float = None, retentar_429: bool = True, cobrar_usuario: bool = True):
+        """
+        Equivalente a 'client.models.generate_content' passando pelo gateway. 'retentar_429=False' devolve a
+        cota esgotada na hora (há outro modelo para tentar) e 'cobrar_usuario=False' não desconta de novo o
+        limite do usuário quando é o fallback de uma chamada já admitida.
+        """
+        self._admitir_usuario(cobrar_usuario)
+
+        chave = self._chave(model, contents, config)
+        with self._lock:
+            voo = self._em_voo.get(chave)
+            lider = voo is None
+            if lider:
+                voo = self._em_voo[chave] = _Voo()
+
+        if not lider:
+            METRICA_GATEWAY.incrementar('seguidor')
+            voo.evento.wait()
+            if voo.erro is not None:
+                raise voo.erro
+            return voo.resultado
+
+        METRICA_GATEWAY.incrementar('lider')
+        try:
+            self._admitir_global()
+            voo.resultado = self._chamar_com_retentativas(model, contents, config, prazo, retentar_429)
+            return voo.resultado
+        except Exception as e:
+            voo.erro = e
+            raise
+        finally:
+            with self._lock:
+                self._em_voo.pop(chave, None)
+            voo.evento.set()
+
+    def gerar_stream(self, model: str, contents, config=None, prazo: float = None, retentar_429: bool = True, cobrar_usuario: bool = True):
+        """
+        Equivalente a 'client.models.generate_content_stream'. Sem single-flight (cada cliente consome o
+        próprio stream); as retentativas só acontecem antes do primeiro pedaço ser entregue. O timeout
+        derivado de 'prazo' vale para a espera de cada pedaço.
+        """
+        self._admitir_usuario(cobrar_usuario)
+        self._admitir_global()
+        for tentativa in range(GEMINI_MAX_TENTATIVAS):
+            entregou = False
+            try:
+                for chunk in client.models.generate_content_stream(
+                    model=model, contents=contents, config=self._com_timeout(config, prazo)
+                ):
+                    entregou = True
+                    yield chunk
+                return
+            except (APIError, httpx.TimeoutException) as e:
+                if entregou and not isinstance(e, httpx.TimeoutException):
+                    raise
+                self._tratar_erro(e, model, tentativa, prazo, retentar_429)
+
+
+gemini_gateway = GeminiGateway()
+
+
+# --- POLÍTICA DE MODELOS (modelo leve/forte por tarefa, orçamento de latência e fallback) ---
+
+METRICA_GEMINI_DURACAO = Histograma(
+    'joker_gemini_duracao_segundos',
+    'Latência das chamadas ao Gemini por tarefa, modelo e desfecho (ok ou o motivo do fallback).',
+    ('tarefa', 'modelo', 'desfecho')
+)
+METRICA_GEMINI_TOKENS = Contador(
+    'joker_gemini_tokens_total',
+    'Tokens consumidos por tarefa, modelo e tipo (entrada, entrada_cache, saida, raciocinio).',
+    ('tarefa', 'modelo', 'tipo')
+)
+
+# Campos de 'usage_metadata' somados em METRICA_GEMINI_TOKENS
+CAMPOS_USO_TOKENS = {
+    'entrada': 'prompt_token_count',
+    'entrada_cache': 'cached_content_token_count',
+    'saida': 'candidates_token_count',
+    'raciocinio': 'thoughts_token_count',
+}
+
+
+class PoliticaModelos:
+    """
+    Escolhe o modelo de cada chamada ao Gemini pela tarefa (ver POLITICA_GEMINI):
+    - cada tarefa tem uma lista de modelos em ordem de preferência e um orçamento de latência total;
+    - cada modelo pode usar GEMINI_FRACAO_NIVEL do orçamento que resta (o último usa tudo), como timeout HTTP;
+    - em tempo esgotado, cota (429) ou 429/5xx persistentes, o próximo modelo da lista assume;
+    - latência e tokens de cada chamada vão para METRICA_GEMINI_DURACAO e METRICA_GEMINI_TOKENS.
+    Erros que não são de disponibilidade (ex.: 400, conteúdo em cache inexistente) sobem sem fallback.
+    """
+
+    # Menos que isso (s) não vale uma nova tentativa em outro modelo
+    ORCAMENTO_MINIMO = 1.0
+
+    def __init__(self, politica: dict, fracao_nivel: float):
+        self.politica = politica  # tarefa -> (modelos, orçamento em s)
+        self.fracao_nivel = fracao_nivel
+
+    def modelos(self, tarefa: str) -> tuple:
+        return self.politica[tarefa][0]
+
+    def _niveis(self, tarefa: str):
+        """Produz (modelo, prazo, é_o_primeiro, é_o_último) enquanto houver orçamento."""
+        modelos, orcamento = self.politica[tarefa]
+        prazo_final = time.monotonic() + orcamento
+        for i, modelo in enumerate(modelos):
+            agora = time.monotonic()
+            restante = prazo_final - agora
+            if i > 0 and restante < self.ORCAMENTO_MINIMO:
+                return
+            ultimo = i == len(modelos) - 1
+            yield modelo, prazo_final if ultimo else agora + restante * self.fracao_nivel, i == 0, ultimo
+
+    def _registrar(self, tarefa: str, modelo: str, duracao: float, desfecho: str, uso=None):
+        METRICA_GEMINI_DURACAO.observar(duracao, tarefa, modelo, desfecho)
+        for tipo, campo in CAMPOS_USO_TOKENS.items():
+            valor = getattr(uso, campo, None) if uso is not None else None
+            if valor:
+                METRICA_GEMINI_TOKENS.incrementar(tarefa, modelo, tipo, valor=valor)
+
+    def _fallback(self, tarefa: str, modelo: str, duracao: float, erro: GeminiIndisponivel):
+        self._registrar(tarefa, modelo, duracao, erro.motivo)
+        log_json("gemini_fallback", tarefa=tarefa, modelo=modelo, motivo=erro.motivo, ms=round(duracao * 1000, 2))
+
+    def gerar(self, tarefa: str, contents, config=None):
+        """
+        'gemini_gateway.gerar' com o modelo escolhido pela política. 'config' pode ser uma função
+        modelo -> config, para quando a config depende do modelo (ex.: conteúdo em cache do roteador).
+        """
+        erro = None
+        for modelo, prazo, primeiro, ultimo in self._niveis(tarefa):
+            inicio = time.perf_counter()
+            try:
+                resposta = gemini_gateway.gerar(
+                    modelo, contents, config(modelo) if callable(config) else config,
+                    prazo=prazo, retentar_429=ultimo, cobrar_usuario=primeiro
+                )
+            except GeminiIndisponivel as e:
+                self._fallback(tarefa, modelo, time.perf_counter() - inicio, e)
+                erro = e
+                continue
+            self._registrar(tarefa, modelo, time.perf_counter() - inicio, 'ok', getattr(resposta, 'usage_metadata', None))
+            return resposta
+        raise erro
+
+    def gerar_stream(self, tarefa: str, contents, config=None):
+        """Versão em streaming: só troca de modelo se a falha vier antes do primeiro pedaço."""
+        erro = None
+        for modelo, prazo, primeiro, ultimo in self._niveis(tarefa):
+            inicio = time.perf_counter()
+            entregou, uso = False, None
+            try:
+                for chunk in gemini_gateway.gerar_stream(
+                    modelo, contents, config(modelo) if callable(config) else config,
+                    prazo=prazo, retentar_429=ultimo, cobrar_usuario=primeiro
+                ):
+                    entregou = True
+                    # O uso de tokens vem acumulado no último pedaço que o traz
+                    uso = getattr(chunk, 'usage_metadata', None) or uso
+                    yield chunk
+            except GeminiIndisponivel as e:
+                self._fallback(tarefa, modelo, time.perf_counter() - inicio, e)
+                if entregou:
+                    raise
+                erro = e
+                continue
+            self._registrar(tarefa, modelo, time.perf_counter() - inicio, 'ok', uso)
+            return
+        raise erro
+
+
+def _lista_modelos(valor: str) -> tuple:
+    return tuple(m.strip() for m in valor.split(',') if m.strip())
+
+
+# roteamento: decisão de ferramenta/resposta direta; formatacao: texto curto a partir do resultado de uma
+# ferramenta; material: material de estudo com várias seções (a única geração longa)
+POLITICA_GEMINI = {
+    'roteamento': (_lista_modelos(GEMINI_MODELOS_ROTEAMENTO), GEMINI_ORCAMENTO_ROTEAMENTO),
+    'formatacao': (_lista_modelos(GEMINI_MODELOS_FORMATACAO), GEMINI_ORCAMENTO_FORMATACAO),
+    'material': (_lista_modelos(GEMINI_MODELOS_MATERIAL), GEMINI_ORCAMENTO_MATERIAL),
+}
+for _tarefa, (_modelos, _) in POLITICA_GEMINI.items():
+    if not _modelos:
+        raise Exception(f"ERRO CRÍTICO: GEMINI_MODELOS_{_tarefa.upper()} não lista nenhum modelo para a tarefa '{_tarefa}'.")
+
+politica_modelos = PoliticaModelos(POLITICA_GEMINI, GEMINI_FRACAO_NIVEL)
+
+
+# --- 2. FUNÇÕES DE SUPORTE AO BANCO DE DADOS E CÁLCULOS ---
+
+# Chave do pg_advisory_lock que serializa migrações concorrentes (vários workers/instâncias no boot)
+MIGRACOES_LOCK_ID = 487_0001
+
+# As migrações de dados e de funções guardam o SQL da versão em que foram publicadas (valores de
+# configuração inclusos), e não as constantes usadas pelo app em tempo de execução: mudar uma dessas
+# constantes não altera o que um banco novo recebe nessas versões. Para mudar o banco, crie uma nova versão.
+
+# Carga completa de Historico_Exibicao (SQL_ATUALIZAR_HISTORICO_EXIBICAO com todos os alunos e corte 7.0)
+SQL_MIGRACAO_005_CARGA_HISTORICO_EXIBICAO = """
+DELETE FROM Historico_Exibicao;
+
+WITH pim AS (
+    SELECT HP.fk_id_aluno, DP.Semestre, HP.Media_Final AS Nota_PIM
+    FROM Historico_Academico HP
+    JOIN Disciplinas DP ON HP.fk_id_disciplina = DP.id_disciplina
+    WHERE DP.Tipo_Avaliacao = 'PIM'
+)
+INSERT INTO Historico_Exibicao (
+    fk_id_aluno, fk_id_disciplina, RA, Nome_Completo, Semestre, Nome_Disciplina, Tipo_Avaliacao,
+    NP1, NP2, PIM_Nota, Media_Final, Faltas, Status_Conclusao
+)
+SELECT
+    A.id_aluno, D.id_disciplina, A.RA, A.Nome_Completo, D.Semestre, D.Nome_Disciplina, UPPER(D.Tipo_Avaliacao),
+    COALESCE(to_char(H.NP1, 'FM990.00'), 'Indefinida'),
+    COALESCE(to_char(H.NP2, 'FM990.00'), 'Indefinida'),
+    COALESCE(to_char(pim.Nota_PIM, 'FM990.00'), 'Indefinida'),
+    COALESCE(to_char(M.Media, 'FM990.00'), 'Indefinida'),
+    H.Faltas,
+    CASE
+        WHEN UPPER(D.Tipo_Avaliacao) = 'ED' THEN 'ED CONCLUIDO'
+        WHEN M.Media IS NULL THEN 'Indefinido'
+        WHEN M.Media >= 7.0 THEN 'Aprovado'
+        ELSE 'Reprovado'
+    END
+FROM Historico_Academico H
+JOIN Alunos A ON H.fk_id_aluno = A.id_aluno
+JOIN Disciplinas D ON H.fk_id_disciplina = D.id_disciplina
+LEFT JOIN pim ON pim.fk_id_aluno = H.fk_id_aluno AND pim.Semestre = D.Semestre
+CROSS JOIN LATERAL (SELECT ROUND((H.NP1 * 4 + H.NP2 * 4 + pim.Nota_PIM * 2) / 10, 2) AS Media) M
+WHERE UPPER(D.Tipo_Avaliacao) != 'PIM';
+
+SELECT pg_notify('historico_invalidado', '*');
+"""
+
+# Índices para as buscas quentes. Os UNIQUE já indexam Alunos(RA), Disciplinas(Nome_Disciplina, Semestre)
+# e Historico_Academico(fk_id_aluno, fk_id_disciplina); os índices abaixo são de COBERTURA (INCLUDE), para
+# que essas buscas sejam index-only scans, mais os que faltavam (PIM por semestre e a FK de disciplina).
+SQL_MIGRACAO_006_INDICES = """
+CREATE INDEX IF NOT EXISTS idx_alunos_ra_cobertura
+    ON Alunos (RA) INCLUDE (id_aluno);
+CREATE INDEX IF NOT EXISTS idx_disciplinas_nome_cobertura
+    ON Disciplinas (Nome_Disciplina) INCLUDE (id_disciplina, Semestre, Tipo_Avaliacao);
+CREATE INDEX IF NOT EXISTS idx_disciplinas_semestre_tipo
+    ON Disciplinas (Semestre, Tipo_Avaliacao) INCLUDE (id_disciplina);
+CREATE INDEX IF NOT EXISTS idx_historico_aluno_cobertura
+    ON Historico_Academico (fk_id_aluno, fk_id_disciplina) INCLUDE (id_registro, NP1, NP2, Media_Final, Faltas);
+CREATE INDEX IF NOT EXISTS idx_historico_disciplina
+    ON Historico_Academico (fk_id_disciplina);
+ANALYZE Alunos;
+ANALYZE Disciplinas;
+ANALYZE Historico_Academico;
+"""
+
+# Funções PL/pgSQL de lançamento, como publicadas (fn_atualizar_historico_exibicao embute o texto de
+# SQL_ATUALIZAR_HISTORICO_EXIBICAO daquela versão)
+SQL_MIGRACAO_007_FUNCOES_DE_ESCRITA = """
+CREATE OR REPLACE FUNCTION fn_atualizar_historico_exibicao(ids_alunos INT[], nota_corte NUMERIC)
+RETURNS VOID LANGUAGE sql AS $fn$
+
+DELETE FROM Historico_Exibicao
+WHERE ids_alunos::INT[] IS NULL OR fk_id_aluno = ANY(ids_alunos::INT[]);
+
+WITH pim AS (
+    SELECT HP.fk_id_aluno, DP.Semestre, HP.Media_Final AS Nota_PIM
+    FROM Historico_Academico HP
+    JOIN Disciplinas DP ON HP.fk_id_disciplina = DP.id_disciplina
+    WHERE DP.Tipo_Avaliacao = 'PIM'
+)
+INSERT INTO Historico_Exibicao (
+    fk_id_aluno, fk_id_disciplina, RA, Nome_Completo, Semestre, Nome_Disciplina, Tipo_Avaliacao,
+    NP1, NP2, PIM_Nota, Media_Final, Faltas, Status_Conclusao
+)
+SELECT
+    A.id_aluno, D.id_disciplina, A.RA, A.Nome_Completo, D.Semestre, D.Nome_Disciplina, UPPER(D.Tipo_Avaliacao),
+    COALESCE(to_char(H.NP1, 'FM990.00'), 'Indefinida'),
+    COALESCE(to_char(H.NP2, 'FM990.00'), 'Indefinida'),
+    COALESCE(to_char(pim.Nota_PIM, 'FM990.00'), 'Indefinida'),
+    COALESCE(to_char(M.Media, 'FM990.00'), 'Indefinida'),
+    H.Faltas,
+    CASE
+        WHEN UPPER(D.Tipo_Avaliacao) = 'ED' THEN 'ED CONCLUIDO'
+        WHEN M.Media IS NULL THEN 'Indefinido'
+        WHEN M.Media >= nota_corte THEN 'Aprovado'
+        ELSE 'Reprovado'
+    END
+FROM Historico_Academico H
+JOIN Alunos A ON H.fk_id_aluno = A.id_aluno
+JOIN Disciplinas D ON H.fk_id_disciplina = D.id_disciplina
+LEFT JOIN pim ON pim.fk_id_aluno = H.fk_id_aluno AND pim.Semestre = D.Semestre
+CROSS JOIN LATERAL (SELECT ROUND((H.NP1 * 4 + H.NP2 * 4 + pim.Nota_PIM * 2) / 10, 2) AS Media) M
+WHERE UPPER(D.Tipo_Avaliacao) != 'PIM'
+AND (ids_alunos::INT[] IS NULL OR A.id_aluno = ANY(ids_alunos::INT[]));
+
+-- count(): funções SQL que não retornam SETOF só processam a primeira linha do último comando
+SELECT count(pg_notify('historico_invalidado', '*')) WHERE ids_alunos IS NULL;
+SELECT count(pg_notify('historico_invalidado', RA)) FROM Alunos WHERE id_aluno = ANY(ids_alunos);
+$fn$;
+
+CREATE OR REPLACE FUNCTION fn_lancar_nota_np(p_ra VARCHAR, p_disciplina VARCHAR, p_np VARCHAR, p_nota NUMERIC, p_nota_corte NUMERIC)
+RETURNS TABLE (resultado VARCHAR, media NUMERIC) LANGUAGE plpgsql AS $fn$
+DECLARE
+    v_id_aluno INT;
+    v_id_disciplina INT;
+    v_tipo VARCHAR;
+    v_semestre INT;
+    v_media NUMERIC;
+BEGIN
+    SELECT A.id_aluno, D.id_disciplina, D.Tipo_Avaliacao, D.Semestre
+    INTO v_id_aluno, v_id_disciplina, v_tipo, v_semestre
+    FROM Alunos A
+    JOIN Historico_Academico H ON A.id_aluno = H.fk_id_aluno
+    JOIN Disciplinas D ON H.fk_id_disciplina = D.id_disciplina
+    WHERE A.RA = p_ra AND D.Nome_Disciplina = p_disciplina
+    LIMIT 1;
+
+    IF NOT FOUND THEN
+        RETURN QUERY SELECT 'NAO_ENCONTRADO'::VARCHAR, NULL::NUMERIC;
+        RETURN;
+    END IF;
+    IF v_tipo = 'PIM' THEN
+        RETURN QUERY SELECT 'TIPO_PIM'::VARCHAR, NULL::NUMERIC;
+        RETURN;
+    END IF;
+
+    UPDATE Historico_Academico H
+    SET NP1 = CASE WHEN p_np = 'NP1' THEN p_nota ELSE H.NP1 END,
+        NP2 = CASE WHEN p_np = 'NP2' THEN p_nota ELSE H.NP2 END
+    WHERE H.fk_id_aluno = v_id_aluno AND H.fk_id_disciplina = v_id_disciplina;
+
+    UPDATE Historico_Academico H
+    SET Media_Final = ROUND((H.NP1 * 4 + H.NP2 * 4 + (
+        SELECT HP.Media_Final
+        FROM Historico_Academico HP
+        JOIN Disciplinas DP ON HP.fk_id_disciplina = DP.id_disciplina
+        WHERE HP.fk_id_aluno = v_id_aluno AND DP.Semestre = v_semestre AND DP.Tipo_Avaliacao = 'PIM'
+        LIMIT 1
+    ) * 2) / 10, 2)
+    WHERE H.fk_id_aluno = v_id_aluno AND H.fk_id_disciplina = v_id_disciplina
+    RETURNING H.Media_Final INTO v_media;
+
+    PERFORM fn_atualizar_historico_exibicao(ARRAY[v_id_aluno], p_nota_corte);
+    RETURN QUERY SELECT 'OK'::VARCHAR, v_media;
+END;
+$fn$;
+
+CREATE OR REPLACE FUNCTION fn_lancar_nota_pim(p_ra VARCHAR, p_disciplina VARCHAR, p_nota NUMERIC, p_nota_corte NUMERIC)
+RETURNS TABLE (resultado VARCHAR, semestre_pim INT, recalculadas INT) LANGUAGE plpgsql AS $fn$
+DECLARE
+    v_id_aluno INT;
+    v_id_disciplina INT;
+    v_tipo VARCHAR;
+    v_semestre INT;
+    v_recalculadas INT;
+BEGIN
+    SELECT A.id_aluno, D.id_disciplina, D.Tipo_Avaliacao, D.Semestre
+    INTO v_id_aluno, v_id_disciplina, v_tipo, v_semestre
+    FROM Alunos A
+    JOIN Historico_Academico H ON A.id_aluno = H.fk_id_aluno
+    JOIN Disciplinas D ON H.fk_id_disciplina = D.id_disciplina
+    WHERE A.RA = p_ra AND D.Nome_Disciplina = p_disciplina
+    LIMIT 1;
+
+    IF NOT FOUND THEN
+        RETURN QUERY SELECT 'NAO_ENCONTRADO'::VARCHAR, NULL::INT, NULL::INT;
+        RETURN;
+    END IF;
+    IF v_tipo != 'PIM' THEN
+        RETURN QUERY SELECT 'NAO_PIM'::VARCHAR, NULL::INT, NULL::INT;
+        RETURN;
+    END IF;
+
+    UPDATE Historico_Academico H
+    SET Media_Final = p_nota
+    WHERE H.fk_id_aluno = v_id_aluno AND H.fk_id_disciplina = v_id_disciplina;
+
+    -- Recalcula todas as disciplinas não-PIM do semestre (inclusive EDs) com a nova nota PIM
+    UPDATE Historico_Academico H
+    SET Media_Final = ROUND((H.NP1 * 4 + H.NP2 * 4 + p_nota * 2) / 10, 2)
+    FROM Disciplinas D
+    WHERE H.fk_id_disciplina = D.id_disciplina
+    AND H.fk_id_aluno = v_id_aluno AND D.Semestre = v_semestre AND D.Tipo_Avaliacao != 'PIM';
+    GET DIAGNOSTICS v_recalculadas = ROW_COUNT;
+
+    PERFORM fn_atualizar_historico_exibicao(ARRAY[v_id_aluno], p_nota_corte);
+    RETURN QUERY SELECT 'OK'::VARCHAR, v_semestre, v_recalculadas;
+END;
+$fn$;
+
+CREATE OR REPLACE FUNCTION fn_lancar_faltas(p_ra VARCHAR, p_disciplina VARCHAR, p_faltas INT, p_nota_corte NUMERIC)
+RETURNS TABLE (resultado VARCHAR, tipo_disciplina VARCHAR) LANGUAGE plpgsql AS $fn$
+DECLARE
+    v_id_aluno INT;
+    v_id_disciplina INT;
+    v_tipo VARCHAR;
+BEGIN
+    SELECT A.id_aluno, D.id_disciplina, D.Tipo_Avaliacao
+    INTO v_id_aluno, v_id_disciplina, v_tipo
+    FROM Alunos A
+    JOIN Historico_Academico H ON A.id_aluno = H.fk_id_aluno
+    JOIN Disciplinas D ON H.fk_id_disciplina = D.id_disciplina
+    WHERE A.RA = p_ra AND D.Nome_Disciplina = p_disciplina
+    LIMIT 1;
+
+    IF NOT FOUND THEN
+        RETURN QUERY SELECT 'NAO_ENCONTRADO'::VARCHAR, NULL::VARCHAR;
+        RETURN;
+    END IF;
+
+    UPDATE Historico_Academico H
+    SET Faltas = p_faltas
+    WHERE H.fk_id_aluno = v_id_aluno AND H.fk_id_disciplina = v_id_disciplina;
+
+    PERFORM fn_atualizar_historico_exibicao(ARRAY[v_id_aluno], p_nota_corte);
+    RETURN QUERY SELECT 'OK'::VARCHAR, v_tipo;
+END;
+$fn$;
+"""
+
+# Carga de Resumo_Desempenho (SQL_ATUALIZAR_RESUMO_DESEMPENHO com corte 7.0, 15 faltas e 20 alunos em risco)
+SQL_MIGRACAO_009_CARGA_RESUMO_DESEMPENHO = """
+DELETE FROM Resumo_Desempenho;
+
+WITH pim AS (
+    SELECT HP.fk_id_aluno, DP.Semestre, HP.Media_Final AS Nota_PIM
+    FROM Historico_Academico HP
+    JOIN Disciplinas DP ON HP.fk_id_disciplina = DP.id_disciplina
+    WHERE DP.Tipo_Avaliacao = 'PIM'
+),
+base AS (
+    SELECT
+        D.Semestre, D.id_disciplina, D.Nome_Disciplina, UPPER(D.Tipo_Avaliacao) AS Tipo,
+        A.RA, A.Nome_Completo, H.Faltas, M.Media,
+        COALESCE(
+            COALESCE(M.Media, LEAST(H.NP1, H.NP2)) < 7.0 OR H.Faltas >= 15, FALSE
+        ) AS Em_Risco
+    FROM Historico_Academico H
+    JOIN Alunos A ON H.fk_id_aluno = A.id_aluno AND A.Tipo_Usuario = 'Aluno'
+    JOIN Disciplinas D ON H.fk_id_disciplina = D.id_disciplina
+    LEFT JOIN pim ON pim.fk_id_aluno = H.fk_id_aluno AND pim.Semestre = D.Semestre
+    CROSS JOIN LATERAL (SELECT ROUND((H.NP1 * 4 + H.NP2 * 4 + pim.Nota_PIM * 2) / 10, 2) AS Media) M
+    WHERE UPPER(D.Tipo_Avaliacao) != 'PIM'
+)
+INSERT INTO Resumo_Desempenho (
+    Semestre, fk_id_disciplina, Nome_Disciplina, Tipo_Avaliacao, Total_Alunos, Alunos_Com_Media, Media_Geral,
+    Aprovados, Reprovados, Taxa_Aprovacao, Faltas_Media, Faltas_Mediana, Faltas_P90, Faltas_Max,
+    Faixas_Faltas, Total_Em_Risco, Alunos_Em_Risco
+)
+SELECT
+    Semestre,
+    CASE WHEN GROUPING(id_disciplina) = 1 THEN 0 ELSE id_disciplina END,
+    CASE WHEN GROUPING(id_disciplina) = 1 THEN 'Todas' ELSE Nome_Disciplina END,
+    CASE WHEN GROUPING(id_disciplina) = 1 THEN 'SEMESTRE' ELSE Tipo END,
+    COUNT(DISTINCT RA),
+    COUNT(Media),
+    ROUND(AVG(Media), 2),
+    COUNT(*) FILTER (WHERE Media >= 7.0),
+    COUNT(*) FILTER (WHERE Media < 7.0),
+    ROUND(100.0 * COUNT(*) FILTER (WHERE Media >= 7.0) / NULLIF(COUNT(Media), 0), 2),
+    ROUND(AVG(Faltas), 2),
+    (percentile_cont(0.5) WITHIN GROUP (ORDER BY Faltas))::NUMERIC(6, 2),
+    (percentile_cont(0.9) WITHIN GROUP (ORDER BY Faltas))::NUMERIC(6, 2),
+    MAX(Faltas),
+    jsonb_build_object(
+        '0-4', COUNT(*) FILTER (WHERE Faltas < 5),
+        '5-9', COUNT(*) FILTER (WHERE Faltas BETWEEN 5 AND 9),
+        '10-14', COUNT(*) FILTER (WHERE Faltas BETWEEN 10 AND 14),
+        '15+', COUNT(*) FILTER (WHERE Faltas >= 15),
+        'sem_registro', COUNT(*) FILTER (WHERE Faltas IS NULL)
+    ),
+    COUNT(DISTINCT RA) FILTER (WHERE Em_Risco),
+    COALESCE(jsonb_path_query_array(
+        jsonb_agg(
+            jsonb_build_object('ra', RA, 'nome', Nome_Completo, 'disciplina', Nome_Disciplina, 'media', Media, 'faltas', Faltas)
+            ORDER BY Media NULLS LAST, Faltas DESC NULLS LAST
+        ) FILTER (WHERE Em_Risco),
+        ('$[0 to ' || (20 - 1) || ']')::jsonpath
+    ), '[]'::jsonb)
+FROM base
+GROUP BY GROUPING SETS ((Semestre, id_disciplina, Nome_Disciplina, Tipo), (Semestre));
+"""
+
+# Funções de lançamento que aceitam o id_aluno já resolvido pelo app (fn_localizar_matricula)
+SQL_MIGRACAO_011_FUNCOES_POR_ID = """
+-- As assinaturas ganharam p_id_aluno (e o retorno, id_aluno): remove as versões da migração 7 antes de recriar
+DROP FUNCTION IF EXISTS fn_lancar_nota_np(VARCHAR, VARCHAR, VARCHAR, NUMERIC, NUMERIC);
+DROP FUNCTION IF EXISTS fn_lancar_nota_pim(VARCHAR, VARCHAR, NUMERIC, NUMERIC);
+DROP FUNCTION IF EXISTS fn_lancar_faltas(VARCHAR, VARCHAR, INT, NUMERIC);
+
+-- Matrícula do aluno na disciplina. Com p_id_aluno (já resolvido pelo app) a busca por RA em Alunos não roda.
+CREATE OR REPLACE FUNCTION fn_localizar_matricula(p_ra VARCHAR, p_id_aluno INT, p_disciplina VARCHAR)
+RETURNS TABLE (id_aluno INT, id_disciplina INT, tipo_avaliacao VARCHAR, semestre INT) LANGUAGE sql STABLE AS $fn$
+    SELECT H.fk_id_aluno, D.id_disciplina, D.Tipo_Avaliacao, D.Semestre
+    FROM Historico_Academico H
+    JOIN Disciplinas D ON H.fk_id_disciplina = D.id_disciplina
+    WHERE D.Nome_Disciplina = p_disciplina
+    AND H.fk_id_aluno = COALESCE(p_id_aluno, (SELECT A.id_aluno FROM Alunos A WHERE A.RA = p_ra))
+    LIMIT 1;
+$fn$;
+
+CREATE OR REPLACE FUNCTION fn_lancar_nota_np(p_ra VARCHAR, p_id_aluno INT, p_disciplina VARCHAR, p_np VARCHAR, p_nota NUMERIC, p_nota_corte NUMERIC)
+RETURNS TABLE (resultado VARCHAR, media NUMERIC, id_aluno INT) LANGUAGE plpgsql AS $fn$
+DECLARE
+    v_id_aluno INT;
+    v_id_disciplina INT;
+    v_tipo VARCHAR;
+    v_semestre INT;
+    v_media NUMERIC;
+BEGIN
+    SELECT M.id_aluno, M.id_disciplina, M.tipo_avaliacao, M.semestre
+    INTO v_id_aluno, v_id_disciplina, v_tipo, v_semestre
+    FROM fn_localizar_matricula(p_ra, p_id_aluno, p_disciplina) M;
+
+    IF NOT FOUND THEN
+        RETURN QUERY SELECT 'NAO_ENCONTRADO'::VARCHAR, NULL::NUMERIC, NULL::INT;
+        RETURN;
+    END IF;
+    IF v_tipo = 'PIM' THEN
+        RETURN QUERY SELECT 'TIPO_PIM'::VARCHAR, NULL::NUMERIC, v_id_aluno;
+        RETURN;
+    END IF;
+
+    UPDATE Historico_Academico H
+    SET NP1 = CASE WHEN p_np = 'NP1' THEN p_nota ELSE H.NP1 END,
+        NP2 = CASE WHEN p_np = 'NP2' THEN p_nota ELSE H.NP2 END
+    WHERE H.fk_id_aluno = v_id_aluno AND H.fk_id_disciplina = v_id_disciplina;
+
+    UPDATE Historico_Academico H
+    SET Media_Final = ROUND((H.NP1 * 4 + H.NP2 * 4 + (
+        SELECT HP.Media_Final
+        FROM Historico_Academico HP
+        JOIN Disciplinas DP ON HP.fk_id_disciplina = DP.id_disciplina
+        WHERE HP.fk_id_aluno = v_id_aluno AND DP.Semestre = v_semestre AND DP.Tipo_Avaliacao = 'PIM'
+        LIMIT 1
+    ) * 2) / 10, 2)
+    WHERE H.fk_id_aluno = v_id_aluno AND H.fk_id_disciplina = v_id_disciplina
+    RETURNING H.Media_Final INTO v_media;
+
+    PERFORM fn_atualizar_historico_exibicao(ARRAY[v_id_aluno], p_nota_corte);
+    RETURN QUERY SELECT 'OK'::VARCHAR, v_media, v_id_aluno;
+END;
+$fn$;
+
+CREATE OR REPLACE FUNCTION fn_lancar_nota_pim(p_ra VARCHAR, p_id_aluno INT, p_disciplina VARCHAR, p_nota NUMERIC, p_nota_corte NUMERIC)
+RETURNS TABLE (resultado VARCHAR, semestre_pim INT, recalculadas INT, id_aluno INT) LANGUAGE plpgsql AS $fn$
+DECLARE
+    v_id_aluno INT;
+    v_id_disciplina INT;
+    v_tipo VARCHAR;
+    v_semestre INT;
+    v_recalculadas INT;
+BEGIN
+    SELECT M.id_aluno, M.id_disciplina, M.tipo_avaliacao, M.semestre
+    INTO v_id_aluno, v_id_disciplina, v_tipo, v_semestre
+    FROM fn_localizar_matricula(p_ra, p_id_aluno, p_disciplina) M;
+
+    IF NOT FOUND THEN
+        RETURN QUERY SELECT 'NAO_ENCONTRADO'::VARCHAR, NULL::INT, NULL::INT, NULL::INT;
+        RETURN;
+    END IF;
+    IF v_tipo != 'PIM' THEN
+        RETURN QUERY SELECT 'NAO_PIM'::VARCHAR, NULL::INT, NULL::INT, v_id_aluno;
+        RETURN;
+    END IF;
+
+    UPDATE Historico_Academico H
+    SET Media_Final = p_nota
+    WHERE H.fk_id_aluno = v_id_aluno AND H.fk_id_disciplina = v_id_disciplina;
+
+    -- Recalcula todas as disciplinas não-PIM do semestre (inclusive EDs) com a nova nota PIM
+    UPDATE Historico_Academico H
+    SET Media_Final = ROUND((H.NP1 * 4 + H.NP2 * 4 + p_nota * 2) / 10, 2)
+    FROM Disciplinas D
+    WHERE H.fk_id_disciplina = D.id_disciplina
+    AND H.fk_id_aluno = v_id_aluno AND D.Semestre = v_semestre AND D.Tipo_Avaliacao != 'PIM';
+    GET DIAGNOSTICS v_recalculadas = ROW_COUNT;
+
+    PERFORM fn_atualizar_historico_exibicao(ARRAY[v_id_aluno], p_nota_corte);
+    RETURN QUERY SELECT 'OK'::VARCHAR, v_semestre, v_recalculadas, v_id_aluno;
+END;
+$fn$;
+
+CREATE OR REPLACE FUNCTION fn_lancar_faltas(p_ra VARCHAR, p_id_aluno INT, p_disciplina VARCHAR, p_faltas INT, p_nota_corte NUMERIC)
+RETURNS TABLE (resultado VARCHAR, tipo_disciplina VARCHAR, id_aluno INT) LANGUAGE plpgsql AS $fn$
+DECLARE
+    v_id_aluno INT;
+    v_id_disciplina INT;
+    v_tipo VARCHAR;
+BEGIN
+    SELECT M.id_aluno, M.id_disciplina, M.tipo_avaliacao
+    INTO v_id_aluno, v_id_disciplina, v_tipo
+    FROM fn_localizar_matricula(p_ra, p_id_aluno, p_disciplina) M;
+
+    IF NOT FOUND THEN
+        RETURN QUERY SELECT 'NAO_ENCONTRADO'::VARCHAR, NULL::VARCHAR, NULL::INT;
+        RETURN;
+    END IF;
+
+    UPDATE Historico_Academico H
+    SET Faltas = p_faltas
+    WHERE H.fk_id_aluno = v_id_aluno AND H.fk_id_disciplina = v_id_disciplina;
+
+    PERFORM fn_atualizar_historico_exibicao(ARRAY[v_id_aluno], p_nota_corte);
+    RETURN QUERY SELECT 'OK'::VARCHAR, v_tipo, v_id_aluno;
+END;
+$fn$;
+"""
+
+# (versão, descrição, SQL ou função que recebe o cursor)
+MIGRACOES = [
+    (1, "Tabelas Alunos, Disciplinas e Historico_Academico", SQL_MIGRACAO_001_TABELAS),
+    (2, "Seed de disciplinas, usuários e histórico", SQL_MIGRACAO_002_SEED),
+    (3, "Cache persistente de material de estudo", SQL_MIGRACAO_003_CACHE_MATERIAL),
+    (4, "Tabela Historico_Exibicao", SQL_MIGRACAO_004_HISTORICO_EXIBICAO),
+    (5, "Carga inicial de Historico_Exibicao", SQL_MIGRACAO_005_CARGA_HISTORICO_EXIBICAO),
+    (6, "Índices de cobertura para as buscas por RA, disciplina e PIM", SQL_MIGRACAO_006_INDICES),
+    (7, "Funções PL/pgSQL de lançamento (NP, PIM e faltas)", SQL_MIGRACAO_007_FUNCOES_DE_ESCRITA),
+    (8, "Tabela Resumo_Desempenho (estatísticas da turma)", SQL_MIGRACAO_008_RESUMO_DESEMPENHO),
+    (9, "Carga inicial de Resumo_Desempenho", SQL_MIGRACAO_009_CARGA_RESUMO_DESEMPENHO),
+    (10, "Tabela Fila_Material (jobs de geração de material)", SQL_MIGRACAO_010_FILA_MATERIAL),
+    (11, "Funções de lançamento aceitam o id_aluno já resolvido", SQL_MIGRACAO_011_FUNCOES_POR_ID),
+    (12, "Telefone vinculado ao aluno (canal WhatsApp/SMS)", SQL_MIGRACAO_012_TELEFONE),
+    (13, "Tabela Entregas_Material (material pedido pelo WhatsApp/SMS)", SQL_MIGRACAO_013_ENTREGAS_MATERIAL),
+]
+
+def aplicar_migracoes() -> list:
+    """Aplica as migrações pendentes, cada uma em sua transação. Retorna [(versão, segundos)] aplicadas."""
+    if not DATABASE_URL:
+        raise Exception("ERRO CRÍTICO: VARIÁVEL DATABASE_URL AUSENTE. O banco de dados PostgreSQL não pode ser inicializado.")
+
+    conn = psycopg2.connect(DATABASE_URL)
+    aplicadas = []
+    try:
+        cursor = conn.cursor()
+        cursor.execute("SELECT pg_advisory_lock(%s)", (MIGRACOES_LOCK_ID,))
+        cursor.execute("""
+        CREATE TABLE IF NOT EXISTS Schema_Migracoes (
+            Versao INT PRIMARY KEY,
+            Descricao VARCHAR(200) NOT NULL,
+            Aplicada_Em TIMESTAMPTZ NOT NULL DEFAULT NOW(),
+            Duracao_ms NUMERIC(10, 1) NOT NULL
+        );
+        """)
+        conn.commit()
+        cursor.execute("SELECT Versao FROM Schema_Migracoes")
+        ja_aplicadas = {row[0] for row in cursor.fetchall()}
+
+        for versao, descricao, passo in MIGRACOES:
+            if versao in ja_aplicadas:
+                continue
+            inicio = time.perf_counter()
+            if callable(passo):
+                passo(cursor)
+            else:
+                cursor.execute(passo)
+            duracao = time.perf_counter() - inicio
+            cursor.execute(
+                "INSERT INTO Schema_Migracoes (Versao, Descricao, Duracao_ms) VALUES (%s, %s, %s)",
+                (versao, descricao, round(duracao * 1000, 1))
+            )
+            conn.commit()
+            aplicadas.append((versao, duracao))
+            print(f"✅ Migração {versao:03d} aplicada em {duracao * 1000:.1f} ms: {descricao}")
+        return aplicadas
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        try:
+            conn.cursor().execute("SELECT pg_advisory_unlock(%s)", (MIGRACOES_LOCK_ID,))
+        finally:
+            conn.close()
+
+
+@app.cli.command('migrate')
+def migrate_command():
+    """Aplica as migrações pendentes do banco de dados."""
+    inicio = time.perf_counter()
+    aplicadas = aplicar_migracoes()
+    print(f"✅ {len(aplicadas)} migração(ões) aplicada(s) em {time.perf_counter() - inicio:.2f}s. Banco atualizado.")
+
+
+class _ConexaoPreparada(psycopg2.extensions.connection):
+    """Conexão que lembra quais comandos já preparou (um PREPARE vale para a sessão inteira)."""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.preparadas = set()
+        self.devolvida_em = time.monotonic() # Última devolução ao pool (ver DB_POOL_PING_OCIOSA)
+
+
+# Consultas quentes preparadas uma vez por conexão do pool: nome -> (tipos dos parâmetros, SQL com $n)
+CONSULTAS_PREPARADAS = {
+    'lancar_nota_np': ("VARCHAR, INT, VARCHAR, VARCHAR, NUMERIC, NUMERIC", """
+        SELECT * FROM fn_lancar_nota_np($1, $2, $3, $4, $5, $6)
+    """),
+    'lancar_nota_pim': ("VARCHAR, INT, VARCHAR, NUMERIC, NUMERIC", """
+        SELECT * FROM fn_lancar_nota_pim($1, $2, $3, $4, $5)
+    """),
+    'lancar_faltas': ("VARCHAR, INT, VARCHAR, INT, NUMERIC", """
+        SELECT * FROM fn_lancar_faltas($1, $2, $3, $4, $5)
+    """),
+    # Lida com cursor de tuplas: a ordem das colunas é a desempacotada em _montar_historico
+    'historico_exibicao_por_ra': ("VARCHAR", """
+        SELECT Nome_Completo, Nome_Disciplina, Semestre, Tipo_Avaliacao,
+        NP1, NP2, PIM_Nota, Media_Final, Faltas, Status_Conclusao
+        FROM Historico_Exibicao
+        WHERE RA = $1
+        ORDER BY Semestre, Tipo_Avaliacao DESC, Nome_Disciplina
+    """),
+    # Mesmas colunas, pela chave primária: usado quando o id_aluno já veio resolvido (token da sessão)
+    'historico_exibicao_por_id': ("INT", """
+        SELECT Nome_Completo, Nome_Disciplina, Semestre, Tipo_Avaliacao,
+        NP1, NP2, PIM_Nota, Media_Final, Faltas, Status_Conclusao
+        FROM Historico_Exibicao
+        WHERE fk_id_aluno = $1
+        ORDER BY Semestre, Tipo_Avaliacao DESC, Nome_Disciplina
+    """),
+    'aluno_por_telefone': ("VARCHAR", """
+        SELECT id_aluno, RA, Nome_Completo FROM Alunos WHERE Telefone = $1 AND Tipo_Usuario = 'Aluno'
+    """),
+    'login_aluno': ("VARCHAR, VARCHAR", """
+        SELECT id_aluno, Nome_Completo FROM Alunos WHERE RA = $1 AND Senha = $2 AND Tipo_Usuario = 'Aluno'
+    """),
+    'login_professor': ("VARCHAR, VARCHAR, VARCHAR", """
+        SELECT id_aluno, Nome_Completo FROM Alunos
+        WHERE RA = $1 AND Senha = $2 AND Codigo_Seguranca = $3 AND Tipo_Usuario = 'Professor'
+    """),
+}
+
+def executar_preparada(cursor, nome, params):
+    """Executa uma consulta de CONSULTAS_PREPARADAS, preparando-a na conexão no primeiro uso."""
+    conn = cursor.connection
+    if nome not in conn.preparadas:
+        tipos, sql = CONSULTAS_PREPARADAS[nome]
+        cursor.execute(f"PREPARE {nome} ({tipos}) AS {sql}")
+        conn.preparadas.add(nome)
+    marcadores = ", ".join(["%s"] * len(params))
+    with medir('db_query', nome):
+        cursor.execute(f"EXECUTE {nome} ({marcadores})", params)
+
+
+class _PooledConnection:
+    """Proxy de uma conexão do pool: 'close()' devolve a conexão ao pool em vez de encerrá-la."""
+
+    def __init__(self, pool, conn):
+        self._pool = pool
+        self._conn = conn
+
+    def __getattr__(self, name):
+        return getattr(self._conn, name)
+
+    def close(self):
+        if self._conn is not None:
+            self._pool.putconn(self._conn)
+            self._conn = None
+
+
+class DBConnectionPool:
+    """Pool de conexões PostgreSQL do processo, com health check, reconexão e métricas."""
+
+    def __init__(self, dsn, minconn, maxconn, timeout, healthcheck=True, ping_ociosa=30.0):
+        self._pool = psycopg2.pool.ThreadedConnectionPool(minconn, maxconn, dsn, connection_factory=_ConexaoPreparada)
+        # O ThreadedConnectionPool falha imediatamente quando esgotado; o semáforo faz a requisição esperar
+        self._slots = threading.BoundedSemaphore(maxconn)
+        self._lock = threading.Lock()
+        self.timeout = timeout
+        self.healthcheck = healthcheck
+        self.ping_ociosa = ping_ociosa
+        self.minconn = minconn
+        self.maxconn = maxconn
+        self.metrics = {
+            "checkouts": 0,
+            "in_use": 0,
+            "reconnects": 0,
+            "pings": 0,
+            "timeouts": 0,
+            "wait_time_total_s": 0.0,
+            "wait_time_max_s": 0.0,
+        }
+
+    def _conexao_saudavel(self, conn):
+        """
+        Verificação local (sem ida ao servidor): conexão aberta e fora de transação. Só as que ficaram
+        ociosas por mais de 'ping_ociosa' segundos recebem um 'SELECT 1', já que são as que o servidor
+        ou um proxy costumam derrubar.
+        """
+        if conn.closed or conn.info.transaction_status != psycopg2.extensions.TRANSACTION_STATUS_IDLE:
+            return False
+        if not self.healthcheck or time.monotonic() - conn.devolvida_em < self.ping_ociosa:
+            return True
+        with self._lock:
+            self.metrics["pings"] += 1
+        try:
+            with conn.cursor() as cur:
+                cur.execute("SELECT 1")
+            conn.rollback()
+            return True
+        except Psycopg2Error:
+            return False
+
+    def getconn(self):
+        inicio = time.perf_counter()
+        if not self._slots.acquire(timeout=self.timeout):
+            with self._lock:
+                self.metrics["timeouts"] += 1
+            raise Exception(f"ERRO: Pool de conexões esgotado ({self.maxconn} conexões em uso por mais de {self.timeout}s).")
+
+        try:
+            conn = self._pool.getconn()
+            # Reconexão: descarta conexões quebradas e pede uma nova ao pool (uma nova tentativa)
+            if not self._conexao_saudavel(conn):
+                self._pool.putconn(conn, close=True)
+                conn = self._pool.getconn()
+                with self._lock:
+                    self.metrics["reconnects"] += 1
+        except Exception:
+            self._slots.release()
+            raise
+
+        espera = time.perf_counter() - inicio
+        with self._lock:
+            self.metrics["checkouts"] += 1
+            self.metrics["in_use"] += 1
+            self.metrics["wait_time_total_s"] += espera
+            self.metrics["wait_time_max_s"] = max(self.metrics["wait_time_max_s"], espera)
+        return _PooledConnection(self, conn)
+
+    def putconn(self, conn):
+        descartar = bool(conn.closed)
+        if not descartar and conn.status != psycopg2.extensions.STATUS_READY:
+            # Transação pendente (ex.: erro sem commit): desfaz antes de devolver ao pool
+            try:
+                conn.rollback()
+            except Psycopg2Error:
+                descartar = True
+        conn.devolvida_em = time.monotonic()
+        try:
+            self._pool.putconn(conn, close=descartar)
+        finally:
+            with self._lock:
+                self.metrics["in_use"] -= 1
+            self._slots.release()
+
+    def stats(self):
+        """Retorna um snapshot das métricas do pool (tamanho, uso e tempo de espera)."""
+        with self._lock:
+            snapshot = dict(self.metrics)
+        snapshot["min_size"] = self.minconn
+        snapshot["max_size"] = self.maxconn
+        snapshot["wait_time_avg_s"] = (
+            snapshot["wait_time_total_s"] / snapshot["checkouts"] if snapshot["checkouts"] else 0.0
+        )
+        return snapshot
+
+
+_db_pool = None
+_db_pool_lock = threading.Lock()
+
+def get_db_pool():
+    """Retorna o pool de conexões do processo, criando-o na primeira chamada."""
+    global _db_pool
+    if _db_pool is None:
+        with _db_pool_lock:
+            if _db_pool is None:
+                _db_pool = DBConnectionPool(
+                    DATABASE_URL, DB_POOL_MIN, DB_POOL_MAX, DB_POOL_TIMEOUT, DB_POOL_HEALTHCHECK, DB_POOL_PING_OCIOSA
+                )
+                print(f"✅ Pool de conexões PostgreSQL criado (min={DB_POOL_MIN}, max={DB_POOL_MAX}).")
+    return _db_pool
+
+def get_db_connection():
+    """Retorna uma conexão do pool ao banco de dados. 'conn.close()' devolve a conexão ao pool."""
+    if not DATABASE_URL:
+        raise Exception("ERRO: DATABASE_URL não configurada. Conexão ao DB falhou.")
+        
+    try:
+        with medir('db_conexao'):
+            conn = get_db_pool().getconn()
+        # Usamos o RealDictCursor para retornar resultados como dicionários (keys são nomes das colunas)
+        return conn, conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor) 
+    except Psycopg2Error as e:
+        raise Exception(f"ERRO DE CONEXÃO AO POSTGRESQL: Não foi possível conectar ao DB. Detalhe: {e}")
+    except Exception as e:
+        raise Exception(f"ERRO DESCONHECIDO NA CONEXÃO AO DB: {e}")
+
+
+def normalizar_texto(texto: str) -> str:
+    """Normaliza texto para comparação: minúsculas, sem acentos e com espaços colapsados."""
+    sem_acento = unicodedata.normalize('NFKD', texto).encode('ascii', 'ignore').decode('ascii')
+    return ' '.join(sem_acento.casefold().split())
+
+def calcular_media_final(np1, np2, pim_nota):
+    """Calcula a média final usando a fórmula: (NP1*4 + NP2*4 + PIM*2) / 10"""
+    if np1 is None or np2 is None or pim_nota is None:
+        return None    
+    try:
+        np1 = Decimal(str(np1))
+        np2 = Decimal(str(np2))
+        pim_nota = Decimal(str(pim_nota))
+        # Nota: O cálculo usa a fórmula unificada para EDs e TEÓRICAS
+        media = (np1 * 4 + np2 * 4 + pim_nota * 2) / 10
+        # Aritmética decimal com arredondamento "meio para cima", idêntico ao ROUND() NUMERIC do PostgreSQL
+        # (ver SQL_RECALCULO_MEDIAS). Com float, 2.675 viraria 2.67 aqui e 2.68 no banco.
+        return float(media.quantize(Decimal('0.01'), rounding=ROUND_HALF_UP))
+    except (ValueError, TypeError, InvalidOperation):
+        return None
+        
+# Recalcula no próprio banco, em UM comando, a Media_Final das disciplinas não-PIM selecionadas pelo filtro.
+# Mesma fórmula de 'calcular_media_final': qualquer nota NULL (inclusive PIM ausente) resulta em NULL.
+SQL_RECALCULO_MEDIAS = """
+WITH pim AS (
+    SELECT HP.fk_id_aluno, DP.Semestre, HP.Media_Final AS Nota_PIM
+    FROM Historico_Academico HP
+    JOIN Disciplinas DP ON HP.fk_id_disciplina = DP.id_disciplina
+    WHERE DP.Tipo_Avaliacao = 'PIM'
+)
+UPDATE Historico_Academico H
+SET Media_Final = ROUND((C.NP1 * 4 + C.NP2 * 4 + C.Nota_PIM * 2) / 10, 2)
+FROM (
+    SELECT H2.id_registro, H2.NP1, H2.NP2, pim.Nota_PIM
+    FROM Historico_Academico H2
+    JOIN Disciplinas D2 ON H2.fk_id_disciplina = D2.id_disciplina
+    LEFT JOIN pim ON pim.fk_id_aluno = H2.fk_id_aluno AND pim.Semestre = D2.Semestre
+    WHERE D2.Tipo_Avaliacao != 'PIM'
+    AND (%(ids_alunos)s::INT[] IS NULL OR H2.fk_id_aluno = ANY(%(ids_alunos)s::INT[]))
+    AND (%(semestre)s::INT IS NULL OR D2.Semestre = %(semestre)s::INT)
+    AND (%(nome_disciplina)s::VARCHAR IS NULL OR D2.Nome_Disciplina = %(nome_disciplina)s::VARCHAR)
+) C
+WHERE H.id_registro = C.id_registro
+RETURNING H.id_registro, H.Media_Final;
+"""
+
+def _recalcular_medias(cursor, id_aluno=None, semestre=None, nome_disciplina=None, ids_alunos=None):
+    """Executa SQL_RECALCULO_MEDIAS com os filtros informados (None = sem filtro). Não faz commit."""
+    if id_aluno is not None:
+        ids_alunos = [id_aluno]
+    with medir('db_query', 'recalcular_medias'):
+        cursor.execute(SQL_RECALCULO_MEDIAS, {
+            "ids_alunos": list(ids_alunos) if ids_alunos is not None else None,
+            "semestre": semestre,
+            "nome_disciplina": nome_disciplina,
+        })
+        return cursor.fetchall()
+
+# Reconstrói Historico_Exibicao para os alunos do filtro (NULL = todos), no formato de 'verificar_dados_curso_api':
+# notas com 2 casas ('Indefinida' se ausentes), média recalculada pela fórmula oficial e status pela nota de corte.
+SQL_ATUALIZAR_HISTORICO_EXIBICAO = """
+DELETE FROM Historico_Exibicao
+WHERE %(ids_alunos)s::INT[] IS NULL OR fk_id_aluno = ANY(%(ids_alunos)s::INT[]);
+
+WITH pim AS (
+    SELECT HP.fk_id_aluno, DP.Semestre, HP.Media_Final AS Nota_PIM
+    FROM Historico_Academico HP
+    JOIN Disciplinas DP ON HP.fk_id_disciplina = DP.id_disciplina
+    WHERE DP.Tipo_Avaliacao = 'PIM'
+)
+INSERT INTO Historico_Exibicao (
+    fk_id_aluno, fk_id_disciplina, RA, Nome_Completo, Semestre, Nome_Disciplina, Tipo_Avaliacao,
+    NP1, NP2, PIM_Nota, Media_Final, Faltas, Status_Conclusao
+)
+SELECT
+    A.id_aluno, D.id_disciplina, A.RA, A.Nome_Completo, D.Semestre, D.Nome_Disciplina, UPPER(D.Tipo_Avaliacao),
+    COALESCE(to_char(H.NP1, 'FM990.00'), 'Indefinida'),
+    COALESCE(to_char(H.NP2, 'FM990.00'), 'Indefinida'),
+    COALESCE(to_char(pim.Nota_PIM, 'FM990.00'), 'Indefinida'),
+    COALESCE(to_char(M.Media, 'FM990.00'), 'Indefinida'),
+    H.Faltas,
+    CASE
+        WHEN UPPER(D.Tipo_Avaliacao) = 'ED' THEN 'ED CONCLUIDO'
+        WHEN M.Media IS NULL THEN 'Indefinido'
+        WHEN M.Media >= %(nota_corte)s THEN 'Aprovado'
+        ELSE 'Reprovado'
+    END
+FROM Historico_Academico H
+JOIN Alunos A ON H.fk_id_aluno = A.id_aluno
+JOIN Disciplinas D ON H.fk_id_disciplina = D.id_disciplina
+LEFT JOIN pim ON pim.fk_id_aluno = H.fk_id_aluno AND pim.Semestre = D.Semestre
+CROSS JOIN LATERAL (SELECT ROUND((H.NP1 * 4 + H.NP2 * 4 + pim.Nota_PIM * 2) / 10, 2) AS Media) M
+WHERE UPPER(D.Tipo_Avaliacao) != 'PIM'
+AND (%(ids_alunos)s::INT[] IS NULL OR A.id_aluno = ANY(%(ids_alunos)s::INT[]));
+"""
+
+# Recalcula Resumo_Desempenho inteiro em UMA consulta agrupada (GROUPING SETS: disciplina e semestre).
+# Média e status seguem a mesma fórmula de SQL_ATUALIZAR_HISTORICO_EXIBICAO. Em risco: média (ou, sem média,
+# a menor NP lançada) abaixo da nota de corte, ou faltas a partir de FALTAS_LIMITE_RISCO.
+SQL_ATUALIZAR_RESUMO_DESEMPENHO = """
+DELETE FROM Resumo_Desempenho;
+
+WITH pim AS (
+    SELECT HP.fk_id_aluno, DP.Semestre, HP.Media_Final AS Nota_PIM
+    FROM Historico_Academico HP
+    JOIN Disciplinas DP ON HP.fk_id_disciplina = DP.id_disciplina
+    WHERE DP.Tipo_Avaliacao = 'PIM'
+),
+base AS (
+    SELECT
+        D.Semestre, D.id_disciplina, D.Nome_Disciplina, UPPER(D.Tipo_Avaliacao) AS Tipo,
+        A.RA, A.Nome_Completo, H.Faltas, M.Media,
+        COALESCE(
+            COALESCE(M.Media, LEAST(H.NP1, H.NP2)) < %(nota_corte)s OR H.Faltas >= %(faltas_risco)s, FALSE
+        ) AS Em_Risco
+    FROM Historico_Academico H
+    JOIN Alunos A ON H.fk_id_aluno = A.id_aluno AND A.Tipo_Usuario = 'Aluno'
+    JOIN Disciplinas D ON H.fk_id_disciplina = D.id_disciplina
+    LEFT JOIN pim ON pim.fk_id_aluno = H.fk_id_aluno AND pim.Semestre = D.Semestre
+    CROSS JOIN LATERAL (SELECT ROUND((H.NP1 * 4 + H.NP2 * 4 + pim.Nota_PIM * 2) / 10, 2) AS Media) M
+    WHERE UPPER(D.Tipo_Avaliacao) != 'PIM'
+)
+INSERT INTO Resumo_Desempenho (
+    Semestre, fk_id_disciplina, Nome_Disciplina, Tipo_Avaliacao, Total_Alunos, Alunos_Com_Media, Media_Geral,
+    Aprovados, Reprovados, Taxa_Aprovacao, Faltas_Media, Faltas_Mediana, Faltas_P90, Faltas_Max,
+    Faixas_Faltas, Total_Em_Risco, Alunos_Em_Risco
+)
+SELECT
+    Semestre,
+    CASE WHEN GROUPING(id_disciplina) = 1 THEN 0 ELSE id_disciplina END,
+    CASE WHEN GROUPING(id_disciplina) = 1 THEN 'Todas' ELSE Nome_Disciplina END,
+    CASE WHEN GROUPING(id_disciplina) = 1 THEN 'SEMESTRE' ELSE Tipo END,
+    COUNT(DISTINCT RA),
+    COUNT(Media),
+    ROUND(AVG(Media), 2),
+    COUNT(*) FILTER (WHERE Media >= %(nota_corte)s),
+    COUNT(*) FILTER (WHERE Media < %(nota_corte)s),
+    ROUND(100.0 * COUNT(*) FILTER (WHERE Media >= %(nota_corte)s) / NULLIF(COUNT(Media), 0), 2),
+    ROUND(AVG(Faltas), 2),
+    (percentile_cont(0.5) WITHIN GROUP (ORDER BY Faltas))::NUMERIC(6, 2),
+    (percentile_cont(0.9) WITHIN GROUP (ORDER BY Faltas))::NUMERIC(6, 2),
+    MAX(Faltas),
+    jsonb_build_object(
+        '0-4', COUNT(*) FILTER (WHERE Faltas < 5),
+        '5-9', COUNT(*) FILTER (WHERE Faltas BETWEEN 5 AND 9),
+        '10-14', COUNT(*) FILTER (WHERE Faltas BETWEEN 10 AND 14),
+        '15+', COUNT(*) FILTER (WHERE Faltas >= 15),
+        'sem_registro', COUNT(*) FILTER (WHERE Faltas IS NULL)
+    ),
+    COUNT(DISTINCT RA) FILTER (WHERE Em_Risco),
+    COALESCE(jsonb_path_query_array(
+        jsonb_agg(
+            jsonb_build_object('ra', RA, 'nome', Nome_Completo, 'disciplina', Nome_Disciplina, 'media', Media, 'faltas', Faltas)
+            ORDER BY Media NULLS LAST, Faltas DESC NULLS LAST
+        ) FILTER (WHERE Em_Risco),
+        ('$[0 to ' || (%(max_em_risco)s - 1) || ']')::jsonpath
+    ), '[]'::jsonb)
+FROM base
+GROUP BY GROUPING SETS ((Semestre, id_disciplina, Nome_Disciplina, Tipo), (Semestre));
+"""
+
+def _atualizar_resumo_desempenho(cursor):
+    """Executa SQL_ATUALIZAR_RESUMO_DESEMPENHO. Não faz commit."""
+    with medir('db_query', 'atualizar_resumo_desempenho'):
+        cursor.execute(SQL_ATUALIZAR_RESUMO_DESEMPENHO, {
+            "nota_corte": NOTA_CORTE_APROVACAO,
+            "faltas_risco": FALTAS_LIMITE_RISCO,
+            "max_em_risco": max(ALUNOS_EM_RISCO_MAX, 1),
+        })
+
+def _atualizar_historico_exibicao(cursor, ids_alunos=None):
+    """
+    Atualiza o histórico materializado dos alunos informados (None = todos) e invalida o cache de
+    históricos: localmente agora e, via NOTIFY (entregue no commit), em todos os workers. Não faz commit.
+    """
+    with medir('db_query', 'atualizar_historico_exibicao'):
+        cursor.execute(SQL_ATUALIZAR_HISTORICO_EXIBICAO, {
+            "ids_alunos": list(ids_alunos) if ids_alunos is not None else None,
+            "nota_corte": NOTA_CORTE_APROVACAO,
+        })
+
+    if ids_alunos is None:
+        cursor.execute("SELECT pg_notify(%s, '*')", (CANAL_INVALIDACAO_HISTORICO,))
+        historico_cache.invalidar('*')
+        return
+    cursor.execute(
+        "SELECT RA, pg_notify(%s, RA) FROM Alunos WHERE id_aluno = ANY(%s)",
+        (CANAL_INVALIDACAO_HISTORICO, list(ids_alunos))
+    )
+    for row in cursor.fetchall():
+        historico_cache.invalidar(row['ra'] if isinstance(row, dict) else row[0])
+
+def recalcular_medias_turma(semestre=None) -> int:
+    """Recalcula a Media_Final de todos os alunos (opcionalmente só de um semestre) em um único comando."""
+    conn, cursor = get_db_connection()
+    try:
+        registros = _recalcular_medias(cursor, semestre=semestre)
+        _atualizar_historico_exibicao(cursor)
+        _atualizar_resumo_desempenho(cursor)
+        conn.commit()
+        return len(registros)
+    finally:
+        conn.close()
+
+
+# --- FUNÇÕES DE ESCRITA NO SERVIDOR (uma ida ao banco por lançamento) ---
+# Cada lançamento é UMA chamada de função PL/pgSQL que valida, atualiza, recalcula a Media_Final (mesma
+# fórmula e arredondamento de 'calcular_media_final'), atualiza Historico_Exibicao e dispara o NOTIFY do
+# cache. O 'resultado' indica o desfecho ('OK', 'NAO_ENCONTRADO', 'TIPO_PIM', 'NAO_PIM') e as mensagens
+# de erro continuam sendo montadas em Python, como antes.
+# Criadas pela migração 7 e recriadas com p_id_aluno pela 11 (SQL_MIGRACAO_007_FUNCOES_DE_ESCRITA e
+# SQL_MIGRACAO_011_FUNCOES_POR_ID). fn_atualizar_historico_exibicao embute o texto de
+# SQL_ATUALIZAR_HISTORICO_EXIBICAO: alterar essa constante exige uma nova migração para a função.
+
+# --- 3. FUNÇÕES DE OPERAÇÃO (LÓGICA CORE: Leitura e Escrita) ---
+
+# --- OPERAÇÕES DE ESCRITA (Professor Tools) ---
+
+class CacheIdsAlunos:
+    """
+    RA -> id_aluno já resolvidos (token do login e retorno dos lançamentos), em LRU. O RA é único e não
+    muda, então não há invalidação: com o id em mãos as ferramentas pulam a busca do aluno por RA.
+    """
+
+    def __init__(self, max_itens: int):
+        self.max_itens = max_itens
+        self._ids = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, ra: str):
+        with self._lock:
+            id_aluno = self._ids.get(ra)
+            if id_aluno is not None:
+                self._ids.move_to_end(ra)
+            return id_aluno
+
+    def set(self, ra: str, id_aluno):
+        if not ra or id_aluno is None:
+            return
+        with self._lock:
+            self._ids[ra] = id_aluno
+            self._ids.move_to_end(ra)
+            while len(self._ids) > self.max_itens:
+                self._ids.popitem(last=False)
+
+
+ids_alunos = CacheIdsAlunos(IDS_ALUNOS_MAX)
+
+
+def lancar_nota_np_api(ra_aluno: str, nome_disciplina: str, np_qual: str, nota: float, id_aluno: int = None) -> dict:
+    """Lança a nota NP1 ou NP2 e recalcula a Média Final se possível."""
+    ra_aluno = ra_aluno.upper().strip()
+    nome_disciplina = nome_disciplina.strip()
+    np_qual = np_qual.upper().strip()
+
+    if np_qual not in ['NP1', 'NP2'] or not (0.0 <= nota <= 10.0):
+        return {"status": "error", "message": "Parâmetros inválidos. Use NP1 ou NP2 com nota entre 0.0 e 10.0."}
+    
+    conn, cursor = get_db_connection()
+    
+    try:
+        executar_preparada(cursor, 'lancar_nota_np', (ra_aluno, id_aluno, nome_disciplina, np_qual, nota, NOTA_CORTE_APROVACAO))
+        resultado = cursor.fetchone()
+        conn.commit()
+        conn.close()
+        ids_alunos.set(ra_aluno, resultado['id_aluno'])
+
+        if resultado['resultado'] == 'NAO_ENCONTRADO':
+            return {"status": "error", "message": f"Aluno/Disciplina '{ra_aluno}'/'{nome_disciplina}' não encontrados."}
+        
+        if resultado['resultado'] == 'TIPO_PIM':
+            return {"status": "error", "message": f"Lançamento de NP1/NP2 não permitido para disciplinas do tipo PIM. Use a função de lançamento PIM."}
+
+        historico_cache.invalidar(ra_aluno)
+        media = float(resultado['media']) if resultado['media'] is not None else None
+        status_media = f"Média Final calculada e salva: {media:.2f}" if media is not None else "Média Final pendente (PIM ou outra NP faltando)."
+        return {"status": "success", "message": f"Nota {np_qual} ({nota:.2f}) lançada para {nome_disciplina} ({ra_aluno}). {status_media}"}
+
+    except Psycopg2Error as e:
+        conn.close()
+        return {"status": "error", "message": f"Erro no lançamento da nota NP: {e}"}
+
+def lancar_nota_pim_api(ra_aluno: str, nome_disciplina_pim: str, nota: float, id_aluno: int = None) -> dict:
+    """Lança a nota PIM e recalcula a Média Final de todas as disciplinas do semestre."""
+    ra_aluno = ra_aluno.upper().strip()
+    nome_disciplina_pim = nome_disciplina_pim.strip()
+
+    if not (0.0 <= nota <= 10.0):
+        return {"status": "error", "message": "Nota PIM inválida. Deve estar entre 0.0 e 10.0."}
+    
+    conn, cursor = get_db_connection()
+    
+    try:
+        executar_preparada(cursor, 'lancar_nota_pim', (ra_aluno, id_aluno, nome_disciplina_pim, nota, NOTA_CORTE_APROVACAO))
+        resultado = cursor.fetchone()
+        conn.commit()
+        conn.close()
+        ids_alunos.set(ra_aluno, resultado['id_aluno'])
+
+        if resultado['resultado'] == 'NAO_ENCONTRADO':
+            return {"status": "error", "message": f"Aluno/Disciplina PIM '{ra_aluno}'/'{nome_disciplina_pim}' não encontrados."}
+        
+        if resultado['resultado'] == 'NAO_PIM':
+            return {"status": "error", "message": f"'{nome_disciplina_pim}' não é uma disciplina PIM. - Joker."}
+
+        historico_cache.invalidar(ra_aluno)
+        return {"status": "success", "message": f"Nota PIM ({nota:.2f}) lançada para o semestre {resultado['semestre_pim']} ({ra_aluno}). {resultado['recalculadas']} Média(s) Final(is) recalculada(s). (Incluindo EDs)."}
+
+    except Psycopg2Error as e:
+        conn.close()
+        return {"status": "error", "message": f"Erro no lançamento da nota PIM: {e}"}
+
+def lancar_faltas_api(ra_aluno: str, nome_disciplina: str, faltas: int, id_aluno: int = None) -> dict:
+    """Lança o número de faltas para uma disciplina."""
+    ra_aluno = ra_aluno.upper().strip()
+    nome_disciplina = nome_disciplina.strip()
+
+    if faltas < 0:
+        return {"status": "error", "message": "Número de faltas inválido."}
+    
+    conn, cursor = get_db_connection()
+
+    try:
+        executar_preparada(cursor, 'lancar_faltas', (ra_aluno, id_aluno, nome_disciplina, faltas, NOTA_CORTE_APROVACAO))
+        resultado = cursor.fetchone()
+        conn.commit()
+        conn.close()
+        ids_alunos.set(ra_aluno, resultado['id_aluno'])
+
+        if resultado['resultado'] == 'NAO_ENCONTRADO':
+            return {"status": "error", "message": f"Aluno/Disciplina '{ra_aluno}'/'{nome_disciplina}' não encontrados."}
+
+        historico_cache.invalidar(ra_aluno)
+        aviso = ""
+        if resultado['tipo_disciplina'] == 'PIM':
+             aviso = f" (AVISO: '{nome_disciplina}' é PIM e pode não ter controle de faltas.)"
+
+        return {"status": "success", "message": f"Lançadas {faltas} faltas para '{nome_disciplina}' ({ra_aluno}).{aviso}"}
+
+    except Psycopg2Error as e:
+        conn.close()
+        return {"status": "error", "message": f"Erro no lançamento de faltas: {e}"}
+
+
+# --- IMPORTAÇÃO EM LOTE (Professor: turma inteira de uma vez) ---
+
+IMPORTACAO_MAX_LINHAS = int(os.environ.get('IMPORTACAO_MAX_LINHAS', 5000))
+COLUNAS_IMPORTACAO = ('ra', 'disciplina', 'np1', 'np2', 'pim', 'faltas')
+
+
+def _autenticar_professor(cursor, funcional, senha, codigo_seguranca) -> bool:
+    """Confere as credenciais de professor (mesma regra do /login)."""
+    sql = "SELECT 1 FROM Alunos WHERE RA = %s AND Senha = %s AND Codigo_Seguranca = %s AND Tipo_Usuario = 'Professor'"
+    cursor.execute(sql, ((funcional or '').upper().strip(), senha, (codigo_seguranca or '').strip()))
+    return cursor.fetchone() is not None
+
+
+def _ler_numero_importacao(valor):
+    """Converte um campo do CSV/JSON em float ('8,5' aceito). Vazio vira None."""
+    if valor is None or (isinstance(valor, str) and not valor.strip()):
+        return None
+    return float(str(valor).strip().replace(',', '.'))
+
+
+def _validar_linha_importacao(linha: dict, alunos: dict, disciplinas: dict):
+    """
+    Valida uma linha com as mesmas regras de 'lancar_nota_np_api', 'lancar_nota_pim_api' e
+    'lancar_faltas_api'. Retorna (id_aluno, disciplina, valores) ou lança ValueError com a mensagem.
+    """
+    ra_aluno = str(linha.get('ra') or '').upper().strip()
+    nome_disciplina = str(linha.get('disciplina') or '').strip()
+
+    try:
+        np1 = _ler_numero_importacao(linha.get('np1'))
+        np2 = _ler_numero_importacao(linha.get('np2'))
+        pim = _ler_numero_importacao(linha.get('pim'))
+        faltas = _ler_numero_importacao(linha.get('faltas'))
+    except ValueError:
+        raise ValueError("Valor não numérico em NP1/NP2/PIM/Faltas.")
+
+    id_aluno = alunos.get(ra_aluno)
+    disciplina = disciplinas.get(nome_disciplina)
+    if id_aluno is None or disciplina is None:
+        raise ValueError(f"Aluno/Disciplina '{ra_aluno}'/'{nome_disciplina}' não encontrados.")
+
+    if all(v is None for v in (np1, np2, pim, faltas)):
+        raise ValueError("Nenhum valor (NP1, NP2, PIM ou Faltas) informado.")
+    for nome, nota in (('NP1', np1), ('NP2', np2), ('PIM', pim)):
+        if nota is not None and not (0.0 <= nota <= 10.0):
+            raise ValueError(f"Nota {nome} inválida. Deve estar entre 0.0 e 10.0.")
+    if faltas is not None and (faltas < 0 or not faltas.is_integer()):
+        raise ValueError("Número de faltas inválido.")
+    if disciplina['tipo'] == 'PIM' and (np1 is not None or np2 is not None):
+        raise ValueError("Lançamento de NP1/NP2 não permitido para disciplinas do tipo PIM. Use a coluna PIM.")
+
+    valores = {"np1": np1, "np2": np2, "pim": pim, "faltas": int(faltas) if faltas is not None else None}
+    return id_aluno, disciplina, valores
+
+
+def importar_notas_lote_api(linhas) -> dict:
+    """
+    Importa notas e faltas de uma turma inteira: valida as linhas, grava tudo em uma tabela de staging
+    (execute_values), aplica um único UPDATE de merge e recalcula as médias dos alunos afetados em
+    um único comando. Linhas inválidas não interrompem a importação e voltam no relatório 'erros'.
+
+    A coluna PIM lança a nota do PIM do semestre da disciplina informada (ou da própria disciplina PIM).
+    Erros ao ler 'linhas' (ex.: UnicodeDecodeError ou csv.Error de um upload) sobem para quem chamou.
+    """
+    conn, cursor = get_db_connection()
+
+    try:
+        cursor.execute("SELECT id_disciplina, Nome_Disciplina, Semestre, Tipo_Avaliacao FROM Disciplinas")
+        disciplinas = {
+            r['nome_disciplina']: {"id": r['id_disciplina'], "semestre": r['semestre'], "tipo": r['tipo_avaliacao'].upper()}
+            for r in cursor.fetchall()
+        }
+        pim_por_semestre = {d['semestre']: d['id'] for d in disciplinas.values() if d['tipo'] == 'PIM'}
+        nomes_disciplinas = {d['id']: nome for nome, d in disciplinas.items()}
+
+        erros = []
+        validas = [] # (numero_linha, ra, id_aluno, disciplina, valores)
+        ras_pendentes = set()
+        total = 0
+        for numero, linha in enumerate(linhas, start=1):
+            total = numero
+            if numero > IMPORTACAO_MAX_LINHAS:
+                erros.append({"linha": numero, "ra": None, "message": f"Limite de {IMPORTACAO_MAX_LINHAS} linhas por importação excedido."})
+                break
+            linha = {str(k).strip().lower(): v for k, v in linha.items() if k is not None}
+            validas.append((numero, linha))
+            ras_pendentes.add(str(linha.get('ra') or '').upper().strip())
+
+        cursor.execute("SELECT RA, id_aluno FROM Alunos WHERE RA = ANY(%s)", (list(ras_pendentes),))
+        alunos = {r['ra']: r['id_aluno'] for r in cursor.fetchall()}
+
+        # Agrega por (aluno, disciplina): valores de linhas posteriores sobrescrevem os anteriores
+        staging = {}
+        linhas_por_chave = {} # (id_aluno, id_disciplina) -> [(linha, ra)] que alimentaram o registro
+        pim_lancado = {} # (id_aluno, semestre) -> (nota, linha) para detectar PIMs conflitantes
+        for numero, linha in validas:
+            ra_aluno = str(linha.get('ra') or '').upper().strip()
+            try:
+                id_aluno, disciplina, valores = _validar_linha_importacao(linha, alunos, disciplinas)
+                if valores['pim'] is not None:
+                    if disciplina['semestre'] not in pim_por_semestre:
+                        raise ValueError(f"O semestre {disciplina['semestre']} não possui disciplina PIM.")
+                    chave_pim = (id_aluno, disciplina['semestre'])
+                    anterior = pim_lancado.get(chave_pim)
+                    if anterior and anterior[0] != valores['pim']:
+                        raise ValueError(f"Nota PIM diferente da informada na linha {anterior[1]} para o mesmo semestre.")
+                    pim_lancado[chave_pim] = (valores['pim'], numero)
+            except ValueError as e:
+                erros.append({"linha": numero, "ra": ra_aluno or None, "message": str(e)})
+                continue
+
+            if any(valores[campo] is not None for campo in ('np1', 'np2', 'faltas')):
+                registro = staging.setdefault((id_aluno, disciplina['id']), {"np1": None, "np2": None, "faltas": None, "pim": None})
+                linhas_por_chave.setdefault((id_aluno, disciplina['id']), []).append((numero, ra_aluno))
+                for campo in ('np1', 'np2', 'faltas'):
+                    if valores[campo] is not None:
+                        registro[campo] = valores[campo]
+            if valores['pim'] is not None:
+                id_pim = pim_por_semestre.get(disciplina['semestre'])
+                staging.setdefault((id_aluno, id_pim), {"np1": None, "np2": None, "faltas": None, "pim": None})['pim'] = valores['pim']
+                linhas_por_chave.setdefault((id_aluno, id_pim), []).append((numero, ra_aluno))
+
+        aplicadas = 0
+        recalculadas = 0
+        if staging:
+            cursor.execute("""
+            CREATE TEMP TABLE Staging_Importacao (
+                fk_id_aluno INT NOT NULL,
+                fk_id_disciplina INT NOT NULL,
+                NP1 NUMERIC(4, 2) NULL,
+                NP2 NUMERIC(4, 2) NULL,
+                Nota_PIM NUMERIC(4, 2) NULL,
+                Faltas INT NULL
+            ) ON COMMIT DROP;
+            """)
+            psycopg2.extras.execute_values(
+                cursor,
+                "INSERT INTO Staging_Importacao (fk_id_aluno, fk_id_disciplina, NP1, NP2, Nota_PIM, Faltas) VALUES %s",
+                [(a, d, r['np1'], r['np2'], r['pim'], r['faltas']) for (a, d), r in staging.items()],
+                page_size=1000
+            )
+            # Merge único: só sobrescreve as colunas informadas; Nota_PIM só existe em linhas de disciplina PIM
+            cursor.execute("""
+            UPDATE Historico_Academico H
+            SET NP1 = COALESCE(S.NP1, H.NP1),
+                NP2 = COALESCE(S.NP2, H.NP2),
+                Faltas = COALESCE(S.Faltas, H.Faltas),
+                Media_Final = COALESCE(S.Nota_PIM, H.Media_Final)
+            FROM Staging_Importacao S
+            WHERE H.fk_id_aluno = S.fk_id_aluno AND H.fk_id_disciplina = S.fk_id_disciplina
+            RETURNING H.fk_id_aluno, H.fk_id_disciplina;
+            """)
+            atualizados = cursor.fetchall()
+            alunos_afetados = {r['fk_id_aluno'] for r in atualizados}
+            # Aluno e disciplina existem, mas sem registro no histórico: o UPDATE não casa e a linha seria perdida
+            chaves_atualizadas = {(r['fk_id_aluno'], r['fk_id_disciplina']) for r in atualizados}
+            for chave in staging.keys() - chaves_atualizadas:
+                for numero, ra_aluno in linhas_por_chave[chave]:
+                    erros.append({"linha": numero, "ra": ra_aluno, "message": f"Aluno/Disciplina '{ra_aluno}'/'{nomes_disciplinas[chave[1]]}' não encontrados."})
+            erros.sort(key=lambda erro: erro['linha'])
+            aplicadas = len(atualizados)
+            recalculadas = len(_recalcular_medias(cursor, ids_alunos=alunos_afetados))
+            _atualizar_historico_exibicao(cursor, alunos_afetados)
+
+        conn.commit()
+        if aplicadas:
+            agendar_atualizacao_resumo_desempenho()
+
+        return {
+            "status": "success",
+            "linhas_processadas": total,
+            "linhas_com_erro": len({erro['linha'] for erro in erros}),
+            "registros_atualizados": aplicadas,
+            "medias_recalculadas": recalculadas,
+            "erros": erros,
+        }
+
+    except Psycopg2Error as e:
+        return {"status": "error", "message": f"Erro na importação em lote: {e}"}
+    finally:
+        # Também quando a leitura das linhas falha no meio: a conexão sempre volta ao pool
+        conn.close()
+
+
+# --- OPERAÇÃO DE LEITURA (Consulta) ---
+
+class HistoricoCache:
+    """
+    Cache LRU com TTL dos históricos montados, por RA. Só é usado enquanto o listener de invalidação
+    (LISTEN/NOTIFY) estiver conectado; sem ele, outro worker poderia alterar notas sem avisar este.
+
+    Cada invalidação avança a geração do cache. Quem vai ler do banco guarda 'geracao()' antes da consulta
+    e a repassa ao 'set': se alguma invalidação chegou no meio, o resultado pode ser anterior a ela e é descartado.
+    """
+
+    def __init__(self, ttl, max_itens):
+        self.ttl = ttl
+        self.max_itens = max_itens
+        self.listener_ativo = False
+        self._itens = OrderedDict() # RA -> (expira_em, historico)
+        self._lock = threading.Lock()
+        self._geracao = 0
+        self.metrics = {"hits": 0, "misses": 0, "invalidacoes": 0, "bypass": 0, "descartados": 0}
+
+    def get(self, ra):
+        with self._lock:
+            if not self.listener_ativo:
+                self.metrics["bypass"] += 1
+                return None
+            item = self._itens.get(ra)
+            if item and item[0] > time.time():
+                self._itens.move_to_end(ra)
+                self.metrics["hits"] += 1
+                return item[1]
+            if item:
+                del self._itens[ra]
+            self.metrics["misses"] += 1
+            return None
+
+    def geracao(self):
+        with self._lock:
+            return self._geracao
+
+    def set(self, ra, historico, geracao):
+        with self._lock:
+            if not self.listener_ativo:
+                return
+            if geracao != self._geracao:
+                self.metrics["descartados"] += 1
+                return
+            self._itens[ra] = (time.time() + self.ttl, historico)
+            self._itens.move_to_end(ra)
+            while len(self._itens) > self.max_itens:
+                self._itens.popitem(last=False)
+
+    def invalidar(self, ra):
+        """Remove o histórico de um RA ('*' limpa tudo)."""
+        with self._lock:
+            self.metrics["invalidacoes"] += 1
+            self._geracao += 1
+            if ra == '*':
+                self._itens.clear()
+            else:
+                self._itens.pop(ra, None)
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self.metrics)
+            stats["itens"] = len(self._itens)
+            stats["listener_ativo"] = self.listener_ativo
+        total = stats["hits"] + stats["misses"]
+        stats["hit_rate"] = stats["hits"] / total if total else 0.0
+        return stats
+
+
+historico_cache = HistoricoCache(HISTORICO_CACHE_TTL, HISTORICO_CACHE_MAX)
+_listener_historico_iniciado = False
+_listener_historico_lock = threading.Lock()
+
+
+def _escutar_invalidacoes_historico():
+    """Loop do listener: aplica cada NOTIFY no cache local e reconecta se a conexão cair."""
+    while True:
+        conn = None
+        try:
+            conn = psycopg2.connect(DATABASE_URL)
+            conn.autocommit = True
+            conn.cursor().execute(f"LISTEN {CANAL_INVALIDACAO_HISTORICO};")
+            # Avisos perdidos enquanto estava desconectado: começa com o cache vazio
+            historico_cache.invalidar('*')
+            historico_cache.listener_ativo = True
+            print("✅ Listener de invalidação do cache de histórico conectado.")
+
+            while True:
+                if select.select([conn], [], [], 60) == ([], [], []):
+                    continue
+                conn.poll()
+                while conn.notifies:
+                    historico_cache.invalidar(conn.notifies.pop(0).payload)
+        except Exception as e:
+            print(f"⚠️ Listener do cache de histórico desconectado (cache desativado até reconectar): {e}")
+        finally:
+            historico_cache.listener_ativo = False
+            historico_cache.invalidar('*')
+            if conn:
+                conn.close()
+        time.sleep(5)
+
+
+def iniciar_listener_historico():
+    """Dispara (uma vez por processo) a thread que escuta as invalidações do cache de histórico."""
+    global _listener_historico_iniciado
+    if not DATABASE_URL or HISTORICO_CACHE_MAX <= 0:
+        return
+    with _listener_historico_lock:
+        if not _listener_historico_iniciado:
+            _listener_historico_iniciado = True
+            threading.Thread(target=_escutar_invalidacoes_historico, name="listener-historico", daemon=True).start()
+
+
+def _montar_historico(registros) -> list:
+    """
+    Monta o histórico de exibição em uma passada a partir das tuplas de 'historico_exibicao_por_ra'.
+    Os números já chegam formatados do banco; cada linha vira um único dict, sem dict intermediário.
+    """
+    return [
+        {
+            "semestre": semestre,
+            "disciplina": disciplina,
+            "tipo": tipo,
+            "np1": np1,
+            "np2": np2,
+            "pim_nota": pim_nota,
+            "media_final": media_final,
+            "faltas": "N/A" if faltas is None else faltas,
+            "status_conclusao": status,
+        }
+        for _, disciplina, semestre, tipo, np1, np2, pim_nota, media_final, faltas, status in registros
+    ]
+
+
+def verificar_dados_curso_api(ra_aluno: str, id_aluno: int = None) -> dict:
+    """Busca o histórico ajustado com a nova regra de corte (7.0)."""
+    ra_aluno = ra_aluno.upper().strip()
+
+    em_cache = historico_cache.get(ra_aluno)
+    if em_cache is not None:
+        return em_cache
+    # Antes da consulta: uma invalidação que chegue durante a leitura impede que o resultado vá para o cache
+    geracao_cache = historico_cache.geracao()
+
+    conn, _ = get_db_connection()
+    # Cursor de tuplas: evita um RealDictRow por disciplina (ver benchmarks/historico_linhas.py)
+    cursor = conn.cursor()
+
+    try:
+        # Leitura direta do histórico materializado: PIM, média e status já vêm calculados e formatados
+        # (ver SQL_ATUALIZAR_HISTORICO_EXIBICAO). O PIM não aparece na exibição, ele só é um valor de cálculo.
+        if id_aluno is not None:
+            executar_preparada(cursor, 'historico_exibicao_por_id', (id_aluno,))
+        else:
+            executar_preparada(cursor, 'historico_exibicao_por_ra', (ra_aluno,))
+        registros = cursor.fetchall()
+
+        if not registros:
+            cursor.execute("SELECT Nome_Completo, Tipo_Usuario FROM Alunos WHERE RA = %s", (ra_aluno,))
+            info_user = cursor.fetchone()
+            
+            conn.close()
+            
+            if info_user:
+                return {"status": "error", "message": f"O usuário '{info_user[0]}' ({ra_aluno}) não possui histórico acadêmico registrado."}
+            
+            return {"status": "error", "message": f"A credencial '{ra_aluno}' não foi encontrada."}
+
+        historico = _montar_historico(registros)
+        nome_aluno = registros[0][0]
+
+        conn.close()
+        
+        # **INSTRUÇÃO DE FORMATAÇÃO DO GEMINI**
+        message_for_gemini = (
+            "**Instrução de Formatação:** Formate os dados do histórico a seguir em uma lista simples e objetiva, "
+            "separando as informações de cada disciplina com um traço (`-`). Use o formato: "
+            "**Disciplina: NP1: X / NP2: Y / PIM: Z / Média final: M / Status: S**."
+            f"Aluno(a): {nome_aluno} (RA: {ra_aluno})."
+        )
+
+        resultado = {
+            "status": "success",
+            "aluno": nome_aluno,
+            "ra": ra_aluno,
+            "historico": historico,
+            "message_for_gemini": message_for_gemini # Nova chave de instrução
+        }
+        historico_cache.set(ra_aluno, resultado, geracao_cache)
+        return resultado
+
+    except Psycopg2Error as e:
+        conn.close()
+        return {"status": "error", "message": f"Erro na consulta ao banco de dados (PostgreSQL): {e}"}
+
+
+# --- OPERAÇÃO DE ANÁLISE (Professor: estatísticas da turma) ---
+
+_resumo_desempenho_lock = threading.Lock()
+
+def atualizar_resumo_desempenho() -> bool:
+    """
+    Recalcula Resumo_Desempenho e faz commit. Só um recálculo por processo por vez: se outro já estiver
+    em andamento, retorna False sem esperar (o resultado dele serve para todos).
+    """
+    if not _resumo_desempenho_lock.acquire(blocking=False):
+        return False
+    conn = None
+    try:
+        conn, cursor = get_db_connection()
+        _atualizar_resumo_desempenho(cursor)
+        conn.commit()
+        return True
+    finally:
+        if conn:
+            conn.close()
+        _resumo_desempenho_lock.release()
+
+
+def agendar_atualizacao_resumo_desempenho():
+    """Recalcula o resumo em segundo plano (ex.: após uma importação em lote ou quando ficou velho)."""
+    def _executar():
+        try:
+            atualizar_resumo_desempenho()
+        except Exception as e:
+            print(f"⚠️ Falha ao atualizar Resumo_Desempenho. Detalhe: {e}")
+
+    threading.Thread(target=_executar, name='resumo-desempenho', daemon=True).start()
+
+
+def _numero(valor):
+    return float(valor) if isinstance(valor, Decimal) else valor
+
+
+def estatisticas_turma_api(semestre: int = 0, nome_disciplina: str = '') -> dict:
+    """
+    Estatísticas da turma por disciplina e por semestre: média geral, taxa de aprovação (nota de corte 7.0),
+    distribuição de faltas e alunos em risco. semestre=0 e nome_disciplina='' retornam todos.
+    """
+    try:
+        semestre = int(semestre or 0)
+    except (TypeError, ValueError):
+        return {"status": "error", "message": f"Semestre inválido: {semestre}."}
+    if nome_disciplina:
+        encontrada = _disciplina_por_nome(nome_disciplina) or _extrair_disciplina(normalizar_texto(nome_disciplina))
+        if not encontrada:
+            return {"status": "error", "message": f"A disciplina '{nome_disciplina}' não foi encontrada."}
+        nome_disciplina = encontrada[0]
+
+    conn = None
+    try:
+        conn, cursor = get_db_connection()
+        # Leitura do resumo materializado: poucas linhas (disciplinas + semestres), qualquer que seja o nº de alunos
+        cursor.execute("""
+            SELECT *, EXTRACT(EPOCH FROM NOW() - Atualizado_Em) AS Idade_s
+            FROM Resumo_Desempenho
+            WHERE (%(semestre)s = 0 OR Semestre = %(semestre)s)
+            AND (%(disciplina)s = '' OR Nome_Disciplina = %(disciplina)s)
+            ORDER BY Semestre, fk_id_disciplina
+        """, {"semestre": semestre, "disciplina": nome_disciplina})
+        linhas = cursor.fetchall()
+    except Psycopg2Error as e:
+        return {"status": "error", "message": f"Erro na consulta ao banco de dados (PostgreSQL): {e}"}
+    finally:
+        if conn:
+            conn.close()
+
+    if not linhas:
+        return {"status": "error", "message": "Não há estatísticas para o filtro informado."}
+    if max(linha['idade_s'] for linha in linhas) > RESUMO_DESEMPENHO_TTL:
+        # Responde com o resumo atual e recalcula para as próximas leituras
+        agendar_atualizacao_resumo_desempenho()
+
+    estatisticas = [
+        {
+            "semestre": linha['semestre'],
+            "disciplina": linha['nome_disciplina'],
+            "tipo": linha['tipo_avaliacao'],
+            "total_alunos": linha['total_alunos'],
+            "alunos_com_media": linha['alunos_com_media'],
+            "media_geral": _numero(linha['media_geral']),
+            "aprovados": linha['aprovados'],
+            "reprovados": linha['reprovados'],
+            "taxa_aprovacao": _numero(linha['taxa_aprovacao']),
+            "faltas": {
+                "media": _numero(linha['faltas_media']),
+                "mediana": _numero(linha['faltas_mediana']),
+                "p90": _numero(linha['faltas_p90']),
+                "max": linha['faltas_max'],
+                "faixas": linha['faixas_faltas'],
+            },
+            "total_em_risco": linha['total_em_risco'],
+            "alunos_em_risco": linha['alunos_em_risco'],
+        }
+        for linha in linhas
+    ]
+    return {
+        "status": "success",
+        "nota_corte": NOTA_CORTE_APROVACAO,
+        "limite_faltas_risco": FALTAS_LIMITE_RISCO,
+        "atualizado_em": min(linha['atualizado_em'] for linha in linhas).isoformat(),
+        "estatisticas": estatisticas,
+    }
+
+
+class MaterialCache:
+    """Cache de material de estudo em dois níveis: LRU em memória + tabela PostgreSQL, ambos com TTL."""
+
+    def __init__(self, ttl, max_memoria, max_db):
+        self.ttl = ttl
+        self.max_memoria = max_memoria
+        self.max_db = max_db
+        self._memoria = OrderedDict() # chave -> (expira_em, resultado)
+        self._lock = threading.Lock()
+        self.metrics = {"hits_memoria": 0, "hits_db": 0, "misses": 0, "erros_db": 0}
+
+    def _contar(self, metrica):
+        with self._lock:
+            self.metrics[metrica] += 1
+
+    def _salvar_memoria(self, chave, resultado, expira_em):
+        with self._lock:
+            self._memoria[chave] = (expira_em, resultado)
+            self._memoria.move_to_end(chave)
+            while len(self._memoria) > self.max_memoria:
+                self._memoria.popitem(last=False)
+
+    def get(self, topico):
+        """Retorna o material em cache para o tópico, ou None."""
+        chave = normalizar_texto(topico)[:200]
+
+        with self._lock:
+            item = self._memoria.get(chave)
+            if item and item[0] > time.time():
+                self._memoria.move_to_end(chave)
+                self.metrics["hits_memoria"] += 1
+                return item[1]
+            if item:
+                del self._memoria[chave]
+
+        if DATABASE_URL:
+            conn = None
+            try:
+                conn, cursor = get_db_connection()
+                cursor.execute(
+                    """
+                    SELECT Conteudo, EXTRACT(EPOCH FROM Criado_Em) AS criado_em
+                    FROM Cache_Material_Estudo
+                    WHERE Chave = %s AND Criado_Em > NOW() - make_interval(secs => %s)
+                    """,
+                    (chave, self.ttl)
+                )
+                row = cursor.fetchone()
+                if row:
+                    self._salvar_memoria(chave, row['conteudo'], float(row['criado_em']) + self.ttl)
+                    self._contar("hits_db")
+                    return row['conteudo']
+            except Exception as e:
+                self._contar("erros_db")
+                print(f"⚠️ Cache de material (DB) indisponível na leitura: {e}")
+            finally:
+                if conn:
+                    conn.close()
+
+        self._contar("misses")
+        return None
+
+    def set(self, topico, resultado):
+        """Armazena o material gerado nos dois níveis e aplica o limite de tamanho da tabela."""
+        chave = normalizar_texto(topico)[:200]
+        self._salvar_memoria(chave, resultado, time.time() + self.ttl)
+
+        if not DATABASE_URL:
+            return
+        conn = None
+        try:
+            conn, cursor = get_db_connection()
+            cursor.execute(
+                """
+                INSERT INTO Cache_Material_Estudo (Chave, Topico, Conteudo, Criado_Em)
+                VALUES (%s, %s, %s, NOW())
+                ON CONFLICT (Chave) DO UPDATE
+                SET Topico = EXCLUDED.Topico, Conteudo = EXCLUDED.Conteudo, Criado_Em = EXCLUDED.Criado_Em
+                """,
+                (chave, topico[:200], resultado)
+            )
+            # Remove expirados e, acima do limite, os mais antigos
+            cursor.execute(
+                """
+                DELETE FROM Cache_Material_Estudo
+                WHERE Criado_Em <= NOW() - make_interval(secs => %s)
+                OR Chave IN (
+                    SELECT Chave FROM Cache_Material_Estudo ORDER BY Criado_Em DESC OFFSET %s
+                )
+                """,
+                (self.ttl, self.max_db)
+            )
+            conn.commit()
+        except Exception as e:
+            self._contar("erros_db")
+            print(f"⚠️ Cache de material (DB) indisponível na escrita: {e}")
+        finally:
+            if conn:
+                conn.close()
+
+    def stats(self):
+        """Snapshot dos contadores e da taxa de acerto do cache."""
+        with self._lock:
+            stats = dict(self.metrics)
+            stats["itens_memoria"] = len(self._memoria)
+        total = stats["hits_memoria"] + stats["hits_db"] + stats["misses"]
+        stats["hit_rate"] = (stats["hits_memoria"] + stats["hits_db"]) / total if total else 0.0
+        return stats
+
+
+material_cache = MaterialCache(MATERIAL_CACHE_TTL, MATERIAL_CACHE_MAX_MEMORIA, MATERIAL_CACHE_MAX_DB)
+
+
+def _prewarm_material_cache():
+    """Gera (se ainda não estiver em cache) o material de cada disciplina cadastrada."""
+    conn = None
+    try:
+        conn, cursor = get_db_connection()
+        cursor.execute("SELECT DISTINCT Nome_Disciplina FROM Disciplinas WHERE Tipo_Avaliacao != 'PIM' ORDER BY Nome_Disciplina")
+        disciplinas = [r['nome_disciplina'] for r in cursor.fetchall()]
+    except Exception as e:
+        print(f"⚠️ Pré-aquecimento do cache de material cancelado: {e}")
+        return
+    finally:
+        if conn:
+            conn.close()
+
+    geradas = 0
+    for nome in disciplinas:
+        if material_cache.get(nome) is None and buscar_material_estudo_api(nome).get('status') == 'success':
+            geradas += 1
+    print(f"✅ Cache de material pré-aquecido: {geradas} novo(s) (gerado(s) ou enfileirado(s)) de {len(disciplinas)} disciplina(s).")
+
+
+def iniciar_tarefas_de_fundo():
+    """Tarefas de segundo plano que dependem do DB migrado. Chamada uma vez em cada processo worker."""
+    iniciar_listener_historico()
+    iniciar_listener_jobs_material()
+    iniciar_prewarm_material_cache()
+
+
+def iniciar_prewarm_material_cache():
+    """Dispara o pré-aquecimento em uma thread de segundo plano (se habilitado e com Gemini disponível)."""
+    if MATERIAL_CACHE_PREWARM and client:
+        threading.Thread(target=_prewarm_material_cache, name="prewarm-material", daemon=True).start()
+
+
+def _prompt_material_estudo(topico: str) -> str:
+    return (
+        f"Gere um material de estudo conciso e focado para o tópico '{topico}'. "
+        "Inclua:\n"
+        "1. Breve resumo.\n"
+        "2. Três pontos chave.\n"
+        "3. Um exercício prático (com resposta).\n"
+        "4. **Busque na web** e adicione **2 sugestões de links relevantes (vídeo-aulas ou artigos) sobre o tópico, formatados como links Markdown [Título](URL)**. "
+        "Responda em português. Mantenha o tom acadêmico-informal."
+        "Encaminhe todo o material gerado sob as especificações acima para o usuário para que ele possa vizualizar tudo e estudar."
+    )
+
+def gerar_material_estudo(topico: str) -> str:
+    """Chamada ao Gemini que gera o material do tópico e o grava no cache. Exceções sobem para quem chamou."""
+    # Nota: O prompt de busca é forte o suficiente para que o Gemini use o Grounding.
+    response = politica_modelos.gerar('material', _prompt_material_estudo(topico))
+    if response.text:
+        material_cache.set(topico, response.text)
+    return response.text
+
+
+def buscar_material_estudo_api(topico: str) -> dict:
+    """Gera material usando o Gemini e retorna a resposta."""
+    # (A docstring acima é a descrição da ferramenta enviada ao Gemini; detalhes da fila ficam aqui.)
+    # Com a fila ativa, um tópico fora do cache vira um job: o retorno traz 'job_id' em vez de 'resultado'.
+    if not client:
+        return {"status": "error", "message": "A API do Gemini não está configurada corretamente."}
+
+    em_cache = material_cache.get(topico)
+    if em_cache is not None:
+        return {"status": "success", "topico": topico, "resultado": em_cache}
+
+    if fila_material_ativa():
+        try:
+            job_id = enfileirar_material(topico, getattr(_contexto_requisicao, 'usuario', None) or 'sistema')
+        except Exception as e:
+            return {"status": "error", "message": f"Não foi possível agendar a geração do material: {e}"}
+        jobs = getattr(_contexto_requisicao, 'jobs_material', None)
+        if jobs is not None:
+            jobs.append(job_id)
+        return {"status": "success", "topico": topico, "job_id": job_id, "resultado": None}
+
+    try:
+        return {
+            "status": "success",
+            "topico": topico,
+            "resultado": gerar_material_estudo(topico) # <--- Retorna a chave 'resultado'
+        }
+
+    except GeminiSobrecarregado:
+        return {"status": "error", "message": MENSAGEM_SOBRECARGA}
+    except APIError as e:
+        return {"status": "error", "message": f"Erro na API do Gemini: {e}"}
+    except Exception as e:
+        return {"status": "error", "message": f"Ocorreu um erro inesperado ao gerar o conteúdo: {e}"}
+
+def gerar_material_estudo_stream(topico: str):
+    """Versão em streaming de 'buscar_material_estudo_api': produz o texto em pedaços conforme o Gemini gera."""
+    if not client:
+        yield "❌ A API do Gemini não está configurada corretamente."
+        return
+
+    em_cache = material_cache.get(topico)
+    if em_cache is not None:
+        yield em_cache
+        return
+
+    partes = []
+    try:
+        for chunk in politica_modelos.gerar_stream('material', _prompt_material_estudo(topico)):
+            if chunk.text:
+                partes.append(chunk.text)
+                yield chunk.text
+    except GeminiSobrecarregado:
+        yield f"\n\nJoker: {MENSAGEM_SOBRECARGA}"
+        return
+    except APIError as e:
+        yield f"\n\nJoker: Oops! Erro na API do Gemini: {e}"
+        return
+    except Exception as e:
+        yield f"\n\nJoker: Oops! Ocorreu um erro inesperado ao gerar o conteúdo: {e}"
+        return
+
+    if partes:
+        material_cache.set(topico, "".join(partes))
+
+# --- FILA DE GERAÇÃO DE MATERIAL (jobs no PostgreSQL, consumidos pelo processo 'worker') ---
+# O chat só enfileira e devolve o id do job; o processo 'flask --app app material-worker' (Procfile) gera o
+# material com no máximo MATERIAL_MAX_CONCORRENTES chamadas simultâneas ao Gemini, somando todos os workers.
+
+STATUS_FINAIS_JOB = ('concluido', 'falhou', 'cancelado')
+# Primeira chave dos pg_try_advisory_lock(chave, vaga) que limitam as gerações simultâneas
+MATERIAL_VAGAS_LOCK_ID = 487_0002
+
+
+def fila_material_ativa() -> bool:
+    return MATERIAL_FILA and bool(DATABASE_URL)
+
+
+def enfileirar_material(topico: str, solicitante: str) -> int:
+    """Cria o job (ou reaproveita o job ativo do mesmo tópico), acorda os workers e retorna o id."""
+    conn = None
+    try:
+        conn, cursor = get_db_connection()
+        cursor.execute(
+            """
+            INSERT INTO Fila_Material (Chave, Topico, Solicitante, Max_Tentativas)
+            VALUES (%s, %s, %s, %s)
+            ON CONFLICT (Chave) WHERE Status IN ('pendente', 'executando')
+            DO UPDATE SET Atualizado_Em = Fila_Material.Atualizado_Em
+            RETURNING id_job
+            """,
+            (normalizar_texto(topico)[:200], topico[:200], solicitante[:100], MATERIAL_MAX_TENTATIVAS)
+        )
+        job_id = cursor.fetchone()['id_job']
+        cursor.execute("SELECT pg_notify(%s, '')", (CANAL_FILA_MATERIAL,))
+        conn.commit()
+        return job_id
+    except Exception:
+        if conn:
+            conn.rollback()
+        raise
+    finally:
+        if conn:
+            conn.close()
+
+
+def consultar_job_material(job_id: int):
+    """Estado do job, com o material quando concluído. None se o job não existir."""
+    conn = None
+    try:
+        conn, cursor = get_db_connection()
+        cursor.execute(
+            """
+            SELECT id_job, Topico, Status, Tentativas, Max_Tentativas, Resultado, Erro, Criado_Em, Atualizado_Em
+            FROM Fila_Material WHERE id_job = %s
+            """,
+            (job_id,)
+        )
+        row = cursor.fetchone()
+    finally:
+        if conn:
+            conn.close()
+    if row is None:
+        return None
+    return {
+        "job_id": row['id_job'],
+        "topico": row['topico'],
+        "status": row['status'],
+        "tentativas": row['tentativas'],
+        "max_tentativas": row['max_tentativas'],
+        "resultado": row['resultado'] if row['status'] == 'concluido' else None,
+        "erro": row['erro'],
+        "criado_em": row['criado_em'].isoformat(),
+        "atualizado_em": row['atualizado_em'].isoformat(),
+    }
+
+
+def cancelar_job_material(job_id: int, solicitante: str) -> bool:
+    """
+    Cancela um job pendente ou em execução do próprio solicitante. Uma geração já em andamento não é
+    interrompida no Gemini, mas o resultado não é gravado no job (só no cache de material).
+    """
+    conn = None
+    try:
+        conn, cursor = get_db_connection()
+        cursor.execute(
+            """
+            UPDATE Fila_Material SET Status = 'cancelado', Lease_Ate = NULL, Atualizado_Em = NOW()
+            WHERE id_job = %s AND Solicitante = %s AND Status IN ('pendente', 'executando')
+            RETURNING id_job
+            """,
+            (job_id, solicitante)
+        )
+        cancelado = cursor.fetchone() is not None
+        if cancelado:
+            cursor.execute("SELECT pg_notify(%s, %s)", (CANAL_JOBS_MATERIAL, str(job_id)))
+        conn.commit()
+        return cancelado
+    except Exception:
+        if conn:
+            conn.rollback()
+        raise
+    finally:
+        if conn:
+            conn.close()
+
+
+def fila_material_stats():
+    """Jobs por status (snapshot do /metrics). Vazio se o banco estiver indisponível."""
+    if not fila_material_ativa():
+        return {}
+    conn = None
+    try:
+        conn, cursor = get_db_connection()
+        cursor.execute("SELECT Status, COUNT(*) AS total FROM Fila_Material GROUP BY Status")
+        stats = {status: 0 for status in ('pendente', 'executando') + STATUS_FINAIS_JOB}
+        stats.update({row['status']: row['total'] for row in cursor.fetchall()})
+        return stats
+    except Exception as e:
+        print(f"⚠️ Fila de material indisponível para as métricas: {e}")
+        return {}
+    finally:
+        if conn:
+            conn.close()
+
+
+class AssinaturasJobs:
+    """
+    Quem espera por um job (SSE do chat, canal WhatsApp) registra um Event aqui; o listener do processo
+    web o dispara a cada NOTIFY de mudança de status. Sem listener, a espera vira polling curto.
+    """
+
+    def __init__(self):
+        self.listener_ativo = False
+        self._eventos = {}  # id do job -> set de threading.Event
+        self._lock = threading.Lock()
+
+    def assinar(self, job_id: int) -> threading.Event:
+        evento = threading.Event()
+        with self._lock:
+            self._eventos.setdefault(job_id, set()).add(evento)
+        return evento
+
+    def cancelar(self, job_id: int, evento: threading.Event):
+        with self._lock:
+            eventos = self._eventos.get(job_id)
+            if eventos is not None:
+                eventos.discard(evento)
+                if not eventos:
+                    del self._eventos[job_id]
+
+    def notificar(self, job_id: int):
+        with self._lock:
+            for evento in self._eventos.get(job_id, ()):
+                evento.set()
+
+    def notificar_todos(self):
+        with self._lock:
+            for eventos in self._eventos.values():
+                for evento in eventos:
+                    evento.set()
+
+
+assinaturas_jobs = AssinaturasJobs()
+_listener_jobs_iniciado = False
+_listener_jobs_lock = threading.Lock()
+
+
+def acompanhar_job_material(job_id: int, espera_max: float):
+    """Gera o estado do job a cada mudança, até ele terminar ou 'espera_max' segundos se passarem."""
+    evento = assinaturas_jobs.assinar(job_id)
+    try:
+        limite = time.monotonic() + espera_max
+        anterior = None
+        while True:
+            # Limpa antes de consultar: um NOTIFY que chegue durante a consulta não se perde
+            evento.clear()
+            job = consultar_job_material(job_id)
+            if job is None:
+                return
+            if job != anterior:
+                yield job
+                anterior = job
+            restante = limite - time.monotonic()
+            if job['status'] in STATUS_FINAIS_JOB or restante <= 0:
+                return
+            evento.wait(min(restante, 30 if assinaturas_jobs.listener_ativo else MATERIAL_POLL_INTERVALO))
+    finally:
+        assinaturas_jobs.cancelar(job_id, evento)
+
+
+def _escutar_jobs_material():
+    """Loop do listener do processo web: repassa cada NOTIFY de job aos assinantes e reconecta se cair."""
+    while True:
+        conn = None
+        try:
+            conn = psycopg2.connect(DATABASE_URL)
+            conn.autocommit = True
+            conn.cursor().execute(f"LISTEN {CANAL_JOBS_MATERIAL};")
+            assinaturas_jobs.listener_ativo = True
+            # Avisos perdidos enquanto estava desconectado: todos os assinantes reconsultam
+            assinaturas_jobs.notificar_todos()
+
+            while True:
+                if select.select([conn], [], [], 60) == ([], [], []):
+                    continue
+                conn.poll()
+                while conn.notifies:
+                    assinaturas_jobs.notificar(int(conn.notifies.pop(0).payload))
+        except Exception as e:
+            print(f"⚠️ Listener dos jobs de material desconectado (acompanhamento por polling até reconectar): {e}")
+        finally:
+            assinaturas_jobs.listener_ativo = False
+            if conn:
+                conn.close()
+        time.sleep(5)
+
+
+def iniciar_listener_jobs_material():
+    """Dispara (uma vez por processo) a thread que escuta as mudanças de status dos jobs."""
+    global _listener_jobs_iniciado
+    if not fila_material_ativa():
+        return
+    with _listener_jobs_lock:
+        if not _listener_jobs_iniciado:
+            _listener_jobs_iniciado = True
+            threading.Thread(target=_escutar_jobs_material, name="listener-jobs-material", daemon=True).start()
+
+
+class WorkerMaterial:
+    """
+    Consumidor da fila: 'threads' threads, cada uma com a própria conexão, pegam jobs com FOR UPDATE
+    SKIP LOCKED. Antes de pegar um job a thread ocupa uma das MATERIAL_MAX_CONCORRENTES vagas (advisory
+    locks de sessão), o que limita as gerações simultâneas entre todos os processos worker.
+    """
+
+    def __init__(self, threads: int):
+        self.threads = threads
+        self._condicao = threading.Condition()
+        self._parar = threading.Event()
+
+    def executar(self):
+        """Bloqueia: inicia as threads e escuta CANAL_FILA_MATERIAL para acordá-las quando chega um job."""
+        if not fila_material_ativa():
+            raise Exception("Fila de material desativada (MATERIAL_FILA=0 ou DATABASE_URL ausente).")
+        for indice in range(self.threads):
+            threading.Thread(target=self._consumir, name=f"worker-material-{indice}", daemon=True).start()
+        print(f"✅ Worker de material: {self.threads} thread(s), até {MATERIAL_MAX_CONCORRENTES} geração(ões) simultânea(s).")
+
+        proxima_limpeza = 0.0
+        while not self._parar.is_set():
+            conn = None
+            try:
+                conn = psycopg2.connect(DATABASE_URL)
+                conn.autocommit = True
+                conn.cursor().execute(f"LISTEN {CANAL_FILA_MATERIAL};")
+                self._acordar()
+                while not self._parar.is_set():
+                    if time.monotonic() >= proxima_limpeza:
+                        self._limpar(conn.cursor())
+                        proxima_limpeza = time.monotonic() + 600
+                    if select.select([conn], [], [], MATERIAL_POLL_INTERVALO) == ([], [], []):
+                        continue
+                    conn.poll()
+                    if conn.notifies:
+                        conn.notifies.clear()
+                        self._acordar()
+            except Exception as e:
+                print(f"⚠️ Worker de material sem o LISTEN da fila (threads seguem por polling): {e}")
+            finally:
+                if conn:
+                    conn.close()
+            self._parar.wait(5)
+
+    def parar(self):
+        self._parar.set()
+        self._acordar()
+
+    def _acordar(self):
+        with self._condicao:
+            self._condicao.notify_all()
+
+    def _limpar(self, cursor):
+        cursor.execute(
+            """
+            DELETE FROM Fila_Material
+            WHERE Status IN ('concluido', 'falhou', 'cancelado') AND Atualizado_Em < NOW() - make_interval(secs => %s)
+            """,
+            (MATERIAL_JOB_RETENCAO,)
+        )
+
+    def _consumir(self):
+        conn = None
+        while not self._parar.is_set():
+            try:
+                if conn is None:
+                    conn = psycopg2.connect(DATABASE_URL)
+                    conn.autocommit = True
+                cursor = conn.cursor()
+                vaga = self._ocupar_vaga(cursor)
+                job = None
+                try:
+                    if vaga is not None:
+                        job = self._pegar_job(cursor)
+                        if job is not None:
+                            self._executar_job(cursor, job)
+                finally:
+                    if vaga is not None:
+                        cursor.execute("SELECT pg_advisory_unlock(%s, %s)", (MATERIAL_VAGAS_LOCK_ID, vaga))
+                if job is not None:
+                    # Pedidos do WhatsApp/SMS: o material sai daqui, sem thread nenhuma esperando o job
+                    entregar_material_pronto(job[0])
+                if job is None:
+                    with self._condicao:
+                        self._condicao.wait(MATERIAL_POLL_INTERVALO)
+            except Exception as e:
+                print(f"⚠️ Thread do worker de material reiniciando após erro: {e}")
+                if conn:
+                    conn.close()
+                conn = None
+                self._parar.wait(5)
+        if conn:
+            conn.close()
+
+    def _ocupar_vaga(self, cursor):
+        for vaga in range(MATERIAL_MAX_CONCORRENTES):
+            cursor.execute("SELECT pg_try_advisory_lock(%s, %s)", (MATERIAL_VAGAS_LOCK_ID, vaga))
+            if cursor.fetchone()[0]:
+                return vaga
+        return None
+
+    def _pegar_job(self, cursor):
+        # Também retoma jobs 'executando' com o lease vencido (worker que caiu no meio da geração)
+        cursor.execute(
+            """
+            UPDATE Fila_Material
+            SET Status = 'executando', Tentativas = Tentativas + 1,
+                Lease_Ate = NOW() + make_interval(secs => %s), Atualizado_Em = NOW()
+            WHERE id_job = (
+                SELECT id_job FROM Fila_Material
+                WHERE (Status = 'pendente' AND Disponivel_Em <= NOW())
+                   OR (Status = 'executando' AND Lease_Ate < NOW())
+                ORDER BY Disponivel_Em, id_job
+                LIMIT 1
+                FOR UPDATE SKIP LOCKED
+            )
+            RETURNING id_job, Topico, Solicitante, Tentativas, Max_Tentativas
+            """,
+            (MATERIAL_JOB_TIMEOUT,)
+        )
+        return cursor.fetchone()
+
+    def _executar_job(self, cursor, job):
+        job_id, topico, solicitante, tentativa, max_tentativas = job
+        # Mesmo contexto de uma requisição: spans, logs e o limite de taxa do Gemini de quem pediu
+        _contexto_requisicao.request_id = f"job-material-{job_id}"
+        _contexto_requisicao.etapas = []
+        _contexto_requisicao.usuario = solicitante
+
+        resultado, erro = None, None
+        if tentativa > max_tentativas:
+            erro = "Tempo esgotado na última tentativa."
+        else:
+            try:
+                with medir('job_material'):
+                    resultado = material_cache.get(topico) or gerar_material_estudo(topico)
+                if not resultado:
+                    erro = "O Gemini devolveu um material vazio."
+            except GeminiSobrecarregado:
+                erro = MENSAGEM_SOBRECARGA
+            except Exception as e:
+                erro = f"{type(e).__name__}: {e}"
+
+        if erro is None:
+            status, espera = 'concluido', 0
+        elif tentativa >= max_tentativas:
+            status, espera = 'falhou', 0
+        else:
+            status = 'pendente'
+            espera = random.uniform(0, MATERIAL_BACKOFF_BASE * 2 ** (tentativa - 1)) + MATERIAL_BACKOFF_BASE
+        # 'AND Status = executando': um job cancelado durante a geração continua cancelado
+        cursor.execute(
+            """
+            UPDATE Fila_Material
+            SET Status = %s, Resultado = %s, Erro = %s, Lease_Ate = NULL,
+                Disponivel_Em = NOW() + make_interval(secs => %s), Atualizado_Em = NOW()
+            WHERE id_job = %s AND Status = 'executando'
+            """,
+            (status, resultado, erro, espera, job_id)
+        )
+        atualizado = cursor.rowcount > 0
+        if atualizado:
+            cursor.execute("SELECT pg_notify(%s, %s)", (CANAL_JOBS_MATERIAL, str(job_id)))
+        log_json(
+            "job_material", job_id=job_id, topico=topico, status=status if atualizado else 'cancelado',
+            tentativa=tentativa, erro=erro, etapas=_contexto_requisicao.etapas
+        )
+
+
+@app.cli.command('material-worker')
+def material_worker_command():
+    """Consome a fila de geração de material de estudo (processo 'worker' do Procfile)."""
+    WorkerMaterial(MATERIAL_WORKERS).executar()
+
+# --- 4. CONFIGURAÇÃO DE FUNÇÕES (TOOLS) E ROUTER DE CONTEÚDO ---
+
+# Mapeamento das ferramentas
+TOOLS = {
+    'verificar_historico_academico': verificar_dados_curso_api,
+    'gerar_material_estudo': buscar_material_estudo_api,
+    'lancar_nota_np': lancar_nota_np_api, 
     'lancar_nota_pim': lancar_nota_pim_api, 
-    'lancar_faltas': lancar_faltas_api 
+    'lancar_faltas': lancar_faltas_api,
+    'estatisticas_turma': estatisticas_turma_api
+}
+
+# --- 4.1 FAST-PATH DE INTENÇÕES (Classificador local antes do Gemini) ---
+
+# Confiança mínima para executar a ferramenta sem consultar o roteador do Gemini
+INTENT_FASTPATH_MIN_CONFIDENCE = float(os.environ.get('INTENT_FASTPATH_MIN_CONFIDENCE', 0.85))
+# Similaridade mínima (difflib) para aceitar um nome de disciplina digitado com erro
+INTENT_FUZZY_MIN_RATIO = float(os.environ.get('INTENT_FUZZY_MIN_RATIO', 0.85))
+
+_RE_RA = re.compile(r'\b(?=(?:[A-Z]*\d){5})[A-Z0-9]{6,10}\b')
+_RE_NP = re.compile(r'\bNP\s?([12])\b')
+_RE_NUMERO = re.compile(r'(?<![\w.,])(\d{1,2}(?:[.,]\d{1,2})?)(?![\w]|[.,]\d)')
+# Formas verbais inteiras (texto normalizado): prefixos pegariam 'colocação', 'registro', 'atributo'...
+_RE_VERBO_LANCAR = re.compile(
+    r'\b(lanc(?:a|e|ar|ou|ei|em|ando)|registr(?:a|e|ar|ou|ei|em|ando)|coloc(?:a|ar|ou|ando)|coloqu(?:e|ei|em)'
+    r'|atribu(?:a|i|ir|iu|am|indo))\b'
+)
+_RE_HISTORICO = re.compile(r'\b(notas?|hist[oó]rico|boletim|m[eé]dias?)\b')
+# Aplicado ao texto normalizado (sem acentos)
+_RE_ESTATISTICAS = re.compile(
+    r'\b(estatisticas?|desempenho|taxa de aprovacao|aprovacao da turma|em risco|media da turma|panorama)\b'
+)
+_RE_SEMESTRE = re.compile(r'\b(?:([1-9])\s*o?\s*semestre|semestre\s*([1-9]))\b')
+_RE_MATERIAL = re.compile(
+    r'\b(?:material(?:\s+de\s+estudo)?|resumo|explica[cç][aã]o|explique|explica)\s+(?:sobre|de|da|do)\s+(?P<topico>.+)$'
+)
+# Pedido de estudo sem o formato de _RE_MATERIAL ("me explica notas musicais"): não é consulta ao histórico
+_RE_PEDIDO_ESTUDO = re.compile(r'\b(material|resumo|resuma|explica|explique|explicacao|ensina|ensine|sobre)\b')
+
+_disciplinas_cache = None
+_disciplinas_lock = threading.Lock()
+
+INTENT_FASTPATH_METRICS = {
+    "hits": 0,
+    "misses": 0,
+    "hits_por_ferramenta": {},
+    "router_llm_calls": 0,
+    "router_llm_time_total_s": 0.0,
+}
+_intent_metrics_lock = threading.Lock()
+
+
+def _carregar_disciplinas():
+    """Lista (nome, nome_normalizado, tipo) das disciplinas, lida do DB uma vez por processo."""
+    global _disciplinas_cache
+    if _disciplinas_cache is None:
+        with _disciplinas_lock:
+            if _disciplinas_cache is None:
+                conn, cursor = get_db_connection()
+                try:
+                    cursor.execute("SELECT Nome_Disciplina, Tipo_Avaliacao FROM Disciplinas")
+                    _disciplinas_cache = [
+                        (r['nome_disciplina'], normalizar_texto(r['nome_disciplina']), r['tipo_avaliacao'].upper())
+                        for r in cursor.fetchall()
+                    ]
+                finally:
+                    conn.close()
+    return _disciplinas_cache
+
+
+def _extrair_disciplina(mensagem_norm: str):
+    """Retorna (nome, tipo, score) da disciplina citada na mensagem, ou None."""
+    disciplinas = _carregar_disciplinas()
+
+    # 1. Correspondência exata (delimitada por palavras); a mais longa vence ('PIM II' antes de 'PIM I')
+    exatas = [d for d in disciplinas if re.search(rf'(?<!\w){re.escape(d[1])}(?!\w)', mensagem_norm)]
+    if exatas:
+        nome, _, tipo = max(exatas, key=lambda d: len(d[1]))
+        return nome, tipo, 1.0
+
+    # 2. Correspondência aproximada: compara cada nome com janelas de mesmo número de palavras
+    palavras = mensagem_norm.split()
+    melhor = None
+    for nome, nome_norm, tipo in disciplinas:
+        n = len(nome_norm.split())
+        for i in range(max(len(palavras) - n + 1, 0)):
+            score = difflib.SequenceMatcher(None, nome_norm, ' '.join(palavras[i:i + n])).ratio()
+            if score >= INTENT_FUZZY_MIN_RATIO and (melhor is None or score > melhor[2]):
+                melhor = (nome, tipo, score)
+    return melhor
+
+
+def _disciplina_por_nome(nome_disciplina: str):
+    """Retorna (nome, tipo, 1.0) da disciplina com esse nome (ex.: lembrada pela sessão), ou None."""
+    nome_norm = normalizar_texto(nome_disciplina)
+    for nome, nome_cadastrado, tipo in _carregar_disciplinas():
+        if nome_cadastrado == nome_norm:
+            return nome, tipo, 1.0
+    return None
+
+
+def classificar_intencao(mensagem_usuario: str, tipo_usuario: str, ra_usuario: str = None, contexto: dict = None):
+    """
+    Classifica a mensagem localmente (regex + fuzzy match) e extrai os argumentos da ferramenta.
+    'contexto' traz as entidades lembradas pela sessão (RA e disciplina do último pedido) e completa
+    mensagens de continuação como "lance a NP2 dele com 8".
+    Retorna (nome_ferramenta, argumentos, confianca) ou None quando não reconhece a intenção.
+    """
+    contexto = contexto or {}
+    mensagem_upper = mensagem_usuario.upper()
+    mensagem_norm = normalizar_texto(mensagem_usuario)
+    is_professor = tipo_usuario.upper() == 'PROFESSOR'
+
+    ras = list(dict.fromkeys(_RE_RA.findall(mensagem_upper)))
+    np_tokens = set(_RE_NP.findall(mensagem_upper))
+
+    if _RE_VERBO_LANCAR.search(mensagem_norm):
+        # Lançamentos são exclusivos do professor e exigem todos os parâmetros, sem ambiguidade
+        if not is_professor or len(ras) > 1:
+            return None
+        # Parâmetros ausentes vêm da sessão, com confiança levemente menor
+        score_contexto = 1.0
+        if not ras:
+            if not contexto.get('ra_aluno'):
+                return None
+            ras = [contexto['ra_aluno']]
+            score_contexto *= 0.95
+        disciplina = _extrair_disciplina(mensagem_norm)
+        if not disciplina and contexto.get('nome_disciplina'):
+            disciplina = _disciplina_por_nome(contexto['nome_disciplina'])
+            score_contexto *= 0.95
+        if not disciplina:
+            return None
+        nome_disciplina, tipo_disciplina, score = disciplina
+        score *= score_contexto
+
+        # Números soltos, ignorando o RA e o sufixo das NPs
+        restante = _RE_NP.sub(' ', _RE_RA.sub(' ', mensagem_upper))
+        numeros = _RE_NUMERO.findall(restante)
+        if len(numeros) != 1:
+            return None
+        valor = float(numeros[0].replace(',', '.'))
+
+        if re.search(r'\bfaltas?\b', mensagem_norm):
+            if not valor.is_integer():
+                return None
+            return 'lancar_faltas', {"ra_aluno": ras[0], "nome_disciplina": nome_disciplina, "faltas": int(valor)}, score
+
+        if len(np_tokens) == 1 and tipo_disciplina != 'PIM':
+            np_qual = f"NP{np_tokens.pop()}"
+            return 'lancar_nota_np', {"ra_aluno": ras[0], "nome_disciplina": nome_disciplina, "np_qual": np_qual, "nota": valor}, score
+
+        if not np_tokens and tipo_disciplina == 'PIM':
+            return 'lancar_nota_pim', {"ra_aluno": ras[0], "nome_disciplina_pim": nome_disciplina, "nota": valor}, score
+
+        return None
+
+    if is_professor and not ras and _RE_ESTATISTICAS.search(mensagem_norm):
+        args = {}
+        semestre = _RE_SEMESTRE.search(mensagem_norm)
+        if semestre:
+            args["semestre"] = int(semestre.group(1) or semestre.group(2))
+        disciplina = _extrair_disciplina(mensagem_norm)
+        if disciplina:
+            args["nome_disciplina"] = disciplina[0]
+        return 'estatisticas_turma', args, disciplina[2] * 0.95 if disciplina else 0.9
+
+    # Antes do histórico: "resumo sobre médias ponderadas" é material, não o boletim do aluno
+    material = _RE_MATERIAL.search(mensagem_usuario.strip().rstrip('?.!').lower())
+    if material and len(material.group('topico').strip()) >= 3:
+        # Recupera o tópico com a grafia original do usuário
+        inicio = material.start('topico')
+        topico = mensagem_usuario.strip().rstrip('?.!')[inicio:].strip()
+        return 'gerar_material_estudo', {"topico": topico}, 0.9
+
+    if _RE_HISTORICO.search(mensagem_norm) and not _RE_PEDIDO_ESTUDO.search(mensagem_norm):
+        # O aluno só consulta o próprio histórico: o RA é o da identidade verificada, nunca o da mensagem.
+        # Sem identidade (ex.: telefone não vinculado) o roteador recusa sem chamar o Gemini.
+        if not is_professor:
+            return 'verificar_historico_academico', {"ra_aluno": ra_usuario}, 1.0
+        if len(ras) == 1:
+            return 'verificar_historico_academico', {"ra_aluno": ras[0]}, 1.0
+        # "E o histórico dele?": o professor continua falando do último aluno da sessão
+        if not ras and is_professor and contexto.get('ra_aluno'):
+            return 'verificar_historico_academico', {"ra_aluno": contexto['ra_aluno']}, 0.9
+        return None
+
+    return None
+
+
+def _registrar_intencao(ferramenta):
+    """Contabiliza um acerto (ferramenta) ou um fallback para o Gemini (None)."""
+    with _intent_metrics_lock:
+        if ferramenta:
+            INTENT_FASTPATH_METRICS["hits"] += 1
+            por_ferramenta = INTENT_FASTPATH_METRICS["hits_por_ferramenta"]
+            por_ferramenta[ferramenta] = por_ferramenta.get(ferramenta, 0) + 1
+        else:
+            INTENT_FASTPATH_METRICS["misses"] += 1
+
+
+def intent_fastpath_stats():
+    """Snapshot das métricas do fast-path, com estimativa de tempo de LLM economizado."""
+    with _intent_metrics_lock:
+        stats = dict(INTENT_FASTPATH_METRICS)
+        stats["hits_por_ferramenta"] = dict(INTENT_FASTPATH_METRICS["hits_por_ferramenta"])
+    total = stats["hits"] + stats["misses"]
+    media_router = (
+        stats["router_llm_time_total_s"] / stats["router_llm_calls"] if stats["router_llm_calls"] else 0.0
+    )
+    stats["hit_rate"] = stats["hits"] / total if total else 0.0
+    stats["router_llm_time_avg_s"] = media_router
+    stats["llm_calls_saved"] = stats["hits"]
+    stats["llm_time_saved_estimate_s"] = stats["hits"] * media_router
+    return stats
+
+
+# --- 4.2 RENDERIZAÇÃO LOCAL DAS RESPOSTAS (Templates com a personalidade do Joker) ---
+
+# '1' reativa a segunda chamada ao Gemini só para formatar o resultado das ferramentas
+FORMATAR_COM_GEMINI = os.environ.get('FORMATAR_COM_GEMINI', '0') == '1'
+
+
+def _renderizar_historico(dados: dict) -> str:
+    """Histórico no formato 'Disciplina: NP1: X / NP2: Y / PIM: Z / Média final: M / Status: S'."""
+    linhas = [f"Joker: Aqui está o histórico de **{dados['aluno']}** (RA: {dados['ra']}). Take your time."]
+    semestre_atual = None
+    for item in dados['historico']:
+        if item['semestre'] != semestre_atual:
+            semestre_atual = item['semestre']
+            linhas.append(f"\n**{semestre_atual}º Semestre**")
+        linhas.append(
+            f"- **{item['disciplina']}**: NP1: {item['np1']} / NP2: {item['np2']} / PIM: {item['pim_nota']} "
+            f"/ Média final: {item['media_final']} / Status: {item['status_conclusao']} / Faltas: {item['faltas']}"
+        )
+    linhas.append(f"\nNota de corte para aprovação: {NOTA_CORTE_APROVACAO:.1f}.")
+    return "\n".join(linhas)
+
+
+def _renderizar_material(dados: dict) -> str:
+    if dados.get('job_id'):
+        return (
+            f"Joker: Estou preparando o material sobre **{dados['topico']}** (pedido #{dados['job_id']}). "
+            "Ele aparece aqui assim que ficar pronto — take your time."
+        )
+    return f"Joker: Material sobre **{dados['topico']}**. Estude no seu ritmo — take your time.\n\n{dados['resultado']}"
+
+
+def _renderizar_lancamento(dados: dict) -> str:
+    return f"Joker: Missão cumprida. {dados['message']}"
+
+
+def _renderizar_estatisticas(dados: dict) -> str:
+    """Uma linha por disciplina/semestre, com os alunos em risco logo abaixo."""
+    def fmt(valor, sufixo=''):
+        return 'N/A' if valor is None else f"{valor:.2f}{sufixo}"
+
+    linhas = ["Joker: O panorama da turma, direto do quartel-general. Take your time."]
+    for item in dados['estatisticas']:
+        titulo = f"{item['semestre']}º Semestre" + ('' if item['tipo'] == 'SEMESTRE' else f" — {item['disciplina']}")
+        faltas = item['faltas']
+        linhas.append(
+            f"- **{titulo}**: média {fmt(item['media_geral'])} | aprovação {fmt(item['taxa_aprovacao'], '%')} "
+            f"({item['aprovados']}/{item['alunos_com_media']}) | faltas: média {fmt(faltas['media'])}, "
+            f"mediana {fmt(faltas['mediana'])}, p90 {fmt(faltas['p90'])} | em risco: {item['total_em_risco']}"
+        )
+        if item['alunos_em_risco'] and item['tipo'] != 'SEMESTRE':
+            linhas.append("  Em risco: " + ", ".join(
+                f"{a['nome']} ({a['ra']}, média {fmt(a['media'])}, faltas {a['faltas'] if a['faltas'] is not None else 'N/A'})"
+                for a in item['alunos_em_risco']
+            ))
+    linhas.append(
+        f"\nNota de corte: {dados['nota_corte']:.1f}. Em risco = abaixo da nota de corte ou com "
+        f"{dados['limite_faltas_risco']}+ faltas. Atualizado em {dados['atualizado_em'][:16].replace('T', ' ')}."
+    )
+    return "\n".join(linhas)
+
+
+RENDERIZADORES_TOOLS = {
+    'verificar_historico_academico': _renderizar_historico,
+    'gerar_material_estudo': _renderizar_material,
+    'lancar_nota_np': _renderizar_lancamento,
+    'lancar_nota_pim': _renderizar_lancamento,
+    'lancar_faltas': _renderizar_lancamento,
+    'estatisticas_turma': _renderizar_estatisticas,
+}
+
+
+def renderizar_resultado_tool(func_name: str, function_response_data: dict):
+    """Renderiza localmente o resultado de uma ferramenta. Retorna None se não houver template."""
+    if func_name == 'gerar_material_estudo' and function_response_data.get('job_id'):
+        # Material ainda na fila: não há conteúdo para o Gemini formatar
+        return _renderizar_material(function_response_data)
+    if FORMATAR_COM_GEMINI or func_name not in RENDERIZADORES_TOOLS:
+        return None
+    return RENDERIZADORES_TOOLS[func_name](function_response_data)
+
+
+# --- 4.3 SESSÕES DE CONVERSA (memória curta por usuário logado) ---
+
+class SessaoConversa:
+    """
+    Estado de uma conversa: os últimos SESSAO_MAX_TURNOS turnos (ring buffer), um resumo compacto dos
+    turnos que saíram do buffer e as entidades extraídas (RA, disciplina, tópico) para completar
+    mensagens de continuação sem que o usuário repita os dados.
+    """
+
+    # Argumentos das ferramentas que viram entidades da sessão
+    ENTIDADES = {
+        'ra_aluno': 'ra_aluno',
+        'nome_disciplina': 'nome_disciplina',
+        'nome_disciplina_pim': 'nome_disciplina',
+        'topico': 'topico',
+    }
+    # Trecho de cada mensagem guardado no histórico e no resumo
+    MAX_CHARS_TURNO = 400
+    MAX_CHARS_RESUMO_TURNO = 80
+
+    def __init__(self, ra: str, nome: str, tipo_usuario: str, id_aluno: int = None):
+        self.ra = ra
+        self.nome = nome
+        self.tipo_usuario = tipo_usuario.upper()
+        self.id_aluno = id_aluno
+        self.turnos = deque(maxlen=SESSAO_MAX_TURNOS)
+        self.resumo = ''
+        self.entidades = {}
+        self.ultimo_acesso = time.monotonic()
+        self._lock = threading.Lock()
+
+    def lembrar(self, argumentos: dict):
+        """Guarda as entidades presentes nos argumentos de uma ferramenta executada com sucesso."""
+        with self._lock:
+            for chave, entidade in self.ENTIDADES.items():
+                valor = argumentos.get(chave)
+                if valor:
+                    self.entidades[entidade] = str(valor).strip()
+
+    def registrar_turno(self, mensagem_usuario: str, resposta: str):
+        with self._lock:
+            if len(self.turnos) == self.turnos.maxlen:
+                # O turno mais antigo sai do buffer e deixa apenas uma linha no resumo
+                antigo_usuario, _ = self.turnos[0]
+                linha = f"- {antigo_usuario[:self.MAX_CHARS_RESUMO_TURNO]}"
+                self.resumo = f"{self.resumo}\n{linha}".strip()[-SESSAO_RESUMO_MAX_CHARS:]
+            self.turnos.append((
+                mensagem_usuario[:self.MAX_CHARS_TURNO],
+                (resposta or '')[:self.MAX_CHARS_TURNO]
+            ))
+
+    def contexto(self) -> dict:
+        with self._lock:
+            return dict(self.entidades)
+
+    def contexto_prompt(self) -> str:
+        """Bloco compacto com entidades, resumo e turnos recentes para o prompt do roteador ('' se vazio)."""
+        with self._lock:
+            partes = []
+            if self.entidades:
+                partes.append("Dados já informados: " + "; ".join(f"{k}={v}" for k, v in self.entidades.items()) + ".")
+            if self.resumo:
+                partes.append(f"Pedidos anteriores (resumo):\n{self.resumo}")
+            if self.turnos:
+                partes.append("Últimas mensagens:\n" + "\n".join(
+                    f"Usuário: {u}\nJoker: {r}" for u, r in self.turnos
+                ))
+        if not partes:
+            return ''
+        return "**Contexto da conversa (use para completar dados omitidos, sem pedi-los de novo):**\n" + "\n\n".join(partes)
+
+
+class SessaoStore:
+    """Sessões em memória por ID opaco devolvido no /login, com expiração por inatividade e limite LRU."""
+
+    def __init__(self, ttl: int, max_sessoes: int):
+        self.ttl = ttl
+        self.max_sessoes = max_sessoes
+        self._sessoes = OrderedDict()
+        self._lock = threading.Lock()
+        self.metrics = {"criadas": 0, "retomadas": 0, "expiradas": 0, "desconhecidas": 0}
+
+    def criar(self, ra: str, nome: str, tipo_usuario: str, id_aluno: int = None, sessao_id: str = None) -> str:
+        sessao_id = sessao_id or secrets.token_urlsafe(24)
+        with self._lock:
+            self._sessoes[sessao_id] = SessaoConversa(ra, nome, tipo_usuario, id_aluno)
+            self.metrics["criadas"] += 1
+            while len(self._sessoes) > self.max_sessoes:
+                self._sessoes.popitem(last=False)
+        return sessao_id
+
+    def retomar(self, usuario: dict) -> SessaoConversa:
+        """
+        Sessão do token verificado. Se ela não estiver neste processo (outro worker, restart ou expirada),
+        recomeça vazia com o mesmo ID e a identidade do token, sem consultar o banco.
+        """
+        sessao = self.obter(usuario['sid'])
+        if sessao is None:
+            self.criar(usuario['ra'], usuario['nome'], usuario['tipo'], usuario['id'], sessao_id=usuario['sid'])
+            sessao = self.obter(usuario['sid'])
+        return sessao
+
+    def obter(self, sessao_id: str):
+        """Retorna a SessaoConversa ativa ou None (ID ausente, desconhecido ou expirado)."""
+        if not sessao_id:
+            return None
+        agora = time.monotonic()
+        with self._lock:
+            sessao = self._sessoes.get(sessao_id)
+            if sessao is None:
+                self.metrics["desconhecidas"] += 1
+                return None
+            if agora - sessao.ultimo_acesso > self.ttl:
+                del self._sessoes[sessao_id]
+                self.metrics["expiradas"] += 1
+                return None
+            sessao.ultimo_acesso = agora
+            self._sessoes.move_to_end(sessao_id)
+            self.metrics["retomadas"] += 1
+            return sessao
+
+    def encerrar(self, sessao_id: str):
+        with self._lock:
+            self._sessoes.pop(sessao_id, None)
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self.metrics)
+            stats["ativas"] = len(self._sessoes)
+        return stats
+
+
+sessoes = SessaoStore(SESSAO_TTL, SESSAO_MAX)
+
+# Tokens de sessão: identidade (id_aluno, RA, perfil) assinada com HMAC e com validade, verificada sem ir ao banco
+_assinador_tokens = URLSafeTimedSerializer(SESSAO_TOKEN_SEGREDO, salt='joker-sessao')
+
+
+def emitir_token_sessao(id_aluno: int, ra: str, nome: str, tipo_usuario: str, sessao_id: str) -> str:
+    return _assinador_tokens.dumps({"id": id_aluno, "ra": ra, "nome": nome, "tipo": tipo_usuario.upper(), "sid": sessao_id})
+
+
+MENSAGEM_TOKEN_INVALIDO = "Sessão inválida ou expirada. Faça login novamente."
+
+
+def verificar_token_sessao(token: str):
+    """Dados do token (id, ra, nome, tipo, sid) ou None se ausente, adulterado ou expirado."""
+    if not token:
+        return None
+    try:
+        return _assinador_tokens.loads(token, max_age=SESSAO_TOKEN_TTL)
+    except BadSignature:
+        return None
+
+
+def usuario_autenticado(data: dict):
+    """Token do cabeçalho 'Authorization: Bearer ...' (ou do campo 'token' do JSON) já verificado, ou None."""
+    cabecalho = request.headers.get('Authorization', '')
+    token = cabecalho[7:].strip() if cabecalho.startswith('Bearer ') else data.get('token')
+    usuario = verificar_token_sessao(token)
+    if usuario is not None:
+        # O RA do token dispensa a busca do próprio aluno nas ferramentas
+        ids_alunos.set(usuario['ra'], usuario['id'])
+    return usuario
+
+
+# --- 4.4 PERSONA E CACHE DE CONTEXTO DO GEMINI (prefixo estático por perfil) ---
+
+# CONTROLE DE PERMISSÃO E PERSONALIDADE (JOKER P5 EXCLUSIVO)
+INSTRUCOES_PERFIL = {
+    'PROFESSOR': (
+        "Você é um assistente acadêmico para um **Professor**. Responda com um tom sarcástico, mas sempre respeitoso e informativo, usando a personalidade de **Akira Kurusu/Ren Amamiya, o 'Joker' dos Phantom Thieves de Persona 5**. Sua personalidade é a de um líder silencioso e confiante, que encoraja o usuário com frases como **'Take your time'** (Aproveite o seu tempo). Você **NÃO é o Coringa vilão da DC Comics**. "
+        "Suas principais tarefas são: 1. Ajudar o professor a visualizar dados acadêmicos. 2. Gerar material de estudo. 3. **Lançar notas (NP1, NP2, PIM) e faltas no sistema.** OBS: O status de conclusão da ED é fixo como 'ED CONCLUIDO' e a média é sempre calculada. A nota de corte para aprovação é 7.0."
+    ),
+    'ALUNO': (
+        "Você é um assistente acadêmico para um **Aluno**. Responda com um tom sarcástico, mas sempre informativo, usando a personalidade de **Akira Kurusu/Ren Amamiya, o 'Joker' dos Phantom Thieves de Persona 5**. Sua personalidade é a de um líder silencioso e confiante, que encoraja o usuário com frases como **'Take your time'** (Aproveite o seu tempo). Você **NÃO é o Coringa vilão da DC Comics**. "
+        "Suas principais tarefas são: 1. Ajudar o aluno a verificar o próprio histórico. 2. Gerar material de estudo. **(Você NÃO pode lançar ou alterar notas.)** A nota de corte para aprovação é 7.0."
+    ),
+}
+
+FERRAMENTAS_POR_PERFIL = {
+    'PROFESSOR': list(TOOLS),
+    'ALUNO': ['verificar_historico_academico', 'gerar_material_estudo'],
+}
+
+INSTRUCOES_FERRAMENTAS = (
+    "**Instruções para Ferramentas:**\n"
+    "1. Se o usuário pedir especificamente por um RA, notas ou histórico, use 'verificar_dados_curso_api'.\n"
+    "2. Se o usuário pedir um material de estudo/resumo/explicação sobre um tópico, use 'buscar_material_estudo_api'.\n"
+    "3. Se o professor pedir para lançar NP1/NP2, use 'lancar_nota_np'.\n"
+    "4. Se o professor pedir para lançar PIM, use 'lancar_nota_pim'.\n"
+    "5. Se o professor pedir para lançar faltas, use 'lancar_faltas'.\n"
+    "6. Se o professor pedir estatísticas, médias ou aprovação da turma, ou alunos em risco, use 'estatisticas_turma_api'.\n"
+    "7. Para **qualquer outra pergunta abrangente** ou se a função for desnecessária/impossível, **RESPONDA DIRETAMENTE**.\n"
+    "Em caso de dados faltantes (ex: RA), peça-os."
+)
+
+# O Gemini devolve o nome da função Python; o roteador usa as chaves de TOOLS
+TOOLS_POR_NOME_FUNCAO = {f.__name__: chave for chave, f in TOOLS.items()}
+# Argumento preenchido pelo servidor (token/cache de ids), nunca pelo modelo
+ARGUMENTOS_DO_SERVIDOR = ('id_aluno',)
+
+
+def _declaracao_ferramenta(funcao):
+    declaracao = genai.types.FunctionDeclaration.from_callable_with_api_option(callable=funcao, api_option='GEMINI_API')
+    parametros = declaracao.parameters
+    for nome in ARGUMENTOS_DO_SERVIDOR:
+        if parametros and parametros.properties and nome in parametros.properties:
+            del parametros.properties[nome]
+            parametros.required = [p for p in (parametros.required or []) if p != nome]
+    return declaracao
+
+
+# Declarações montadas uma vez. Como declarações (e não callables) o SDK não executa as funções sozinho:
+# o roteador confere o perfil e completa os argumentos do servidor antes de chamar a ferramenta.
+DECLARACOES_TOOLS = {chave: _declaracao_ferramenta(funcao) for chave, funcao in TOOLS.items()}
+
+
+def ferramentas_do_perfil(papel: str) -> list:
+    return [genai.types.Tool(function_declarations=[DECLARACOES_TOOLS[chave] for chave in FERRAMENTAS_POR_PERFIL[papel]])]
+
+
+# Resposta quando um aluno sem identidade verificada (ex.: telefone não vinculado) pede dados acadêmicos
+MENSAGEM_SEM_IDENTIDADE = (
+    "Só mostro notas para quem eu sei quem é. Entre pelo site com o seu RA "
+    "(ou vincule este número ao seu cadastro) e tente de novo."
+)
+
+
+def argumentos_da_ferramenta(func_name: str, func_args: dict, papel: str, sessao: SessaoConversa = None):
+    """
+    Argumentos vindos do classificador/Gemini, sem os do servidor. Para o ALUNO, 'ra_aluno' e 'id_aluno'
+    são sempre os da identidade verificada da sessão (token do /login ou telefone vinculado), ignorando
+    qualquer RA da mensagem; sem identidade, devolve None. Para o professor, o id_aluno vem do cache por RA.
+    """
+    argumentos = {k: v for k, v in func_args.items() if k not in ARGUMENTOS_DO_SERVIDOR}
+    parametros = inspect.signature(TOOLS[func_name]).parameters
+    if 'ra_aluno' not in parametros:
+        return argumentos
+    if papel == 'ALUNO':
+        if sessao is None or not sessao.ra or sessao.id_aluno is None:
+            return None
+        argumentos['ra_aluno'] = sessao.ra
+        argumentos['id_aluno'] = sessao.id_aluno
+        return argumentos
+    ra = argumentos.get('ra_aluno')
+    if ra and 'id_aluno' in parametros:
+        id_aluno = ids_alunos.get(str(ra).upper().strip())
+        if id_aluno is not None:
+            argumentos['id_aluno'] = id_aluno
+    return argumentos
+
+
+def papel_do_usuario(tipo_usuario: str) -> str:
+    return 'PROFESSOR' if tipo_usuario.upper() == 'PROFESSOR' else 'ALUNO'
+
+
+class CacheContextoGemini:
+    """
+    Registra uma vez por perfil (Professor/Aluno) o prefixo estático do roteador — persona, instruções e
+    declarações das ferramentas — como conteúdo em cache no Gemini. Cada requisição envia só a mensagem.
+    O cache é recriado antes de expirar; se a criação falhar (API sem suporte, prefixo abaixo do mínimo
+    de tokens do modelo), obter() devolve None por GEMINI_CONTEXT_CACHE_RETRY segundos e o roteador usa
+    o prefixo como system_instruction. O conteúdo em cache só vale para 'modelo' (o primeiro do roteamento).
+    A criação roda fora do lock e uma por perfil: enquanto ela não volta, as demais requisições seguem com
+    o cache anterior (se ainda válido) ou sem cache, em vez de esperar pela API.
+    """
+
+    # Recria o cache um pouco antes da expiração para não usar um nome já removido pelo Gemini
+    MARGEM_RENOVACAO = 60
+
+    def __init__(self, modelo: str, ttl: int, espera_apos_falha: int, timeout: float):
+        self.modelo = modelo
+        self.ttl = ttl
+        self.espera_apos_falha = espera_apos_falha
+        self.timeout = timeout
+        self._caches = {}  # papel -> (nome_no_gemini, expira_em)
+        self._falhou_em = {}  # papel -> instante da última falha de criação
+        self._criando = set()  # perfis com uma criação em andamento
+        self._lock = threading.Lock()
+
+    def obter(self, papel: str):
+        """Nome do conteúdo em cache para o perfil, criando/renovando se preciso; None se indisponível."""
+        if not (client and GEMINI_CONTEXT_CACHE):
+            return None
+        agora = time.monotonic()
+        with self._lock:
+            atual = self._caches.get(papel)
+            if atual and agora < atual[1] - self.MARGEM_RENOVACAO:
+                return atual[0]
+            vigente = atual[0] if atual and agora < atual[1] else None
+            if papel in self._criando:
+                return vigente
+            if agora - self._falhou_em.get(papel, -self.espera_apos_falha) < self.espera_apos_falha:
+                return None
+            self._criando.add(papel)
+
+        try:
+            cache = client.caches.create(
+                model=self.modelo,
+                config=genai.types.CreateCachedContentConfig(
+                    display_name=f"joker-roteador-{papel.lower()}",
+                    system_instruction=prefixo_roteador(papel),
+                    tools=ferramentas_do_perfil(papel),
+                    ttl=f"{self.ttl}s",
+                    http_options=genai.types.HttpOptions(timeout=int(self.timeout * 1000)),
+                )
+            )
+        except Exception as e:
+            with self._lock:
+                self._falhou_em[papel] = agora
+                self._caches.pop(papel, None)
+            print(f"⚠️ Cache de contexto do Gemini indisponível para {papel}; enviando o prefixo completo. Detalhe: {e}")
+            return None
+        else:
+            with self._lock:
+                self._caches[papel] = (cache.name, agora + self.ttl)
+        finally:
+            with self._lock:
+                self._criando.discard(papel)
+        print(f"✅ Prefixo do roteador ({papel}) registrado no cache do Gemini: {cache.name}")
+        return cache.name
+
+    def invalidar(self, papel: str):
+        """Descarta o cache do perfil (ex.: o Gemini respondeu que o conteúdo em cache não existe mais)."""
+        with self._lock:
+            self._caches.pop(papel, None)
+
+
+cache_contexto_gemini = CacheContextoGemini(
+    politica_modelos.modelos('roteamento')[0], GEMINI_CONTEXT_CACHE_TTL, GEMINI_CONTEXT_CACHE_RETRY,
+    GEMINI_CONTEXT_CACHE_TIMEOUT
+)
+
+GEMINI_TOKEN_METRICS = {
+    "requisicoes": 0,
+    "requisicoes_com_cache": 0,
+    "tokens_entrada_total": 0,        # Prompt completo processado pelo modelo (prefixo + mensagem)
+    "tokens_entrada_cache_total": 0,  # Parte do prompt servida pelo conteúdo em cache
 }
+_token_metrics_lock = threading.Lock()
+
+
+def prefixo_roteador(papel: str) -> str:
+    return f"{INSTRUCOES_PERFIL[papel]}\n\n{INSTRUCOES_FERRAMENTAS}"
+
+
+def _registrar_tokens(response, com_cache: bool):
+    uso = getattr(response, 'usage_metadata', None)
+    entrada = (uso.prompt_token_count or 0) if uso else 0
+    em_cache = (uso.cached_content_token_count or 0) if uso else 0
+    with _token_metrics_lock:
+        GEMINI_TOKEN_METRICS["requisicoes"] += 1
+        GEMINI_TOKEN_METRICS["requisicoes_com_cache"] += int(com_cache)
+        GEMINI_TOKEN_METRICS["tokens_entrada_total"] += entrada
+        GEMINI_TOKEN_METRICS["tokens_entrada_cache_total"] += em_cache
+
+
+def gemini_token_stats():
+    """
+    Tokens de entrada por requisição do roteador: 'antes' é o prompt completo (o que seria enviado sem
+    cache) e 'depois' é o que efetivamente sai a cada chamada (prompt menos a parte em cache).
+    """
+    with _token_metrics_lock:
+        stats = dict(GEMINI_TOKEN_METRICS)
+    n = stats["requisicoes"]
+    stats["tokens_entrada_por_requisicao_antes"] = stats["tokens_entrada_total"] / n if n else 0.0
+    stats["tokens_entrada_por_requisicao_depois"] = (
+        (stats["tokens_entrada_total"] - stats["tokens_entrada_cache_total"]) / n if n else 0.0
+    )
+    return stats
+
+
+def _configs_roteador(papel: str):
+    """(config completa, nome do cache de contexto ou None) das chamadas do roteador para o perfil."""
+    config_completa = GenerateContentConfig(
+        system_instruction=prefixo_roteador(papel),
+        # CORREÇÃO CRÍTICA: Não misturar Function Calling com google_search explícito.
+        tools=ferramentas_do_perfil(papel)
+    )
+    return config_completa, cache_contexto_gemini.obter(papel)
+
+
+def gerar_resposta_roteador(papel: str, conteudo: str):
+    """
+    Chamada do roteador ao Gemini. Com o cache de contexto ativo envia só 'conteudo' (mensagem + contexto
+    da sessão); sem ele, envia o mesmo prefixo como system_instruction e as declarações das ferramentas.
+    O modelo vem da política de 'roteamento'; o fallback para outro modelo sempre envia o prefixo, já que o
+    conteúdo em cache pertence ao modelo em que foi criado.
+    """
+    config_completa, nome_cache = _configs_roteador(papel)
+    if nome_cache:
+        config_cache = GenerateContentConfig(cached_content=nome_cache)
+        modelos_usados = []
+
+        def config_do_modelo(modelo):
+            modelos_usados.append(modelo)
+            return config_cache if modelo == cache_contexto_gemini.modelo else config_completa
+
+        try:
+            with medir('gemini_roteador', 'com_cache'):
+                response = politica_modelos.gerar('roteamento', [conteudo], config_do_modelo)
+            _registrar_tokens(response, com_cache=modelos_usados[-1] == cache_contexto_gemini.modelo)
+            return response
+        except APIError as e:
+            # Cache expirado/removido no Gemini: descarta e segue sem cache nesta requisição
+            print(f"⚠️ Falha ao usar o cache de contexto ({nome_cache}); reenviando o prefixo. Detalhe: {e}")
+            cache_contexto_gemini.invalidar(papel)
+
+    with medir('gemini_roteador', 'sem_cache'):
+        response = politica_modelos.gerar('roteamento', [conteudo], config_completa)
+    _registrar_tokens(response, com_cache=False)
+    return response
+
+
+def gerar_resposta_roteador_stream(papel: str, conteudo: str):
+    """
+    Versão em streaming de 'gerar_resposta_roteador': produz os pedaços da resposta conforme o Gemini gera.
+    A troca para o prefixo completo (cache de contexto inválido) só acontece antes do primeiro pedaço.
+    """
+    config_completa, nome_cache = _configs_roteador(papel)
+    if nome_cache:
+        config_cache = GenerateContentConfig(cached_content=nome_cache)
+        modelos_usados = []
+
+        def config_do_modelo(modelo):
+            modelos_usados.append(modelo)
+            return config_cache if modelo == cache_contexto_gemini.modelo else config_completa
+
+        ultimo = None
+        try:
+            with medir('gemini_roteador', 'com_cache'):
+                for chunk in politica_modelos.gerar_stream('roteamento', [conteudo], config_do_modelo):
+                    ultimo = chunk
+                    yield chunk
+            _registrar_tokens(ultimo, com_cache=modelos_usados[-1] == cache_contexto_gemini.modelo)
+            return
+        except APIError as e:
+            if ultimo is not None:
+                raise
+            print(f"⚠️ Falha ao usar o cache de contexto ({nome_cache}); reenviando o prefixo. Detalhe: {e}")
+            cache_contexto_gemini.invalidar(papel)
 
-def rotear_e_executar_mensagem(mensagem_usuario: str, tipo_usuario: str) -> str:
+    ultimo = None
+    with medir('gemini_roteador', 'sem_cache'):
+        for chunk in politica_modelos.gerar_stream('roteamento', [conteudo], config_completa):
+            ultimo = chunk
+            yield chunk
+    _registrar_tokens(ultimo, com_cache=False)
+
+
+def _gerar_texto(tarefa: str, contents, stream: bool):
+    """Texto de uma chamada ao Gemini: uma única parte, ou os pedaços conforme são gerados com 'stream'."""
+    if not stream:
+        yield politica_modelos.gerar(tarefa, contents).text or ""
+        return
+    for chunk in politica_modelos.gerar_stream(tarefa, contents):
+        if chunk.text:
+            yield chunk.text
+
+
+def _formatar_resultado_fastpath(func_name: str, function_response_data: dict, instrucoes_perfil: str, stream: bool = False):
+    """Formata com uma única chamada ao Gemini o resultado de uma ferramenta executada pelo fast-path."""
+    dados = (
+        {"resultado": function_response_data.get("resultado")}
+        if func_name == 'gerar_material_estudo'
+        else function_response_data
+    )
+    prompt_formatacao = (
+        f"{instrucoes_perfil}\n\n"
+        f"A ferramenta '{func_name}' foi executada e retornou os dados abaixo (JSON). "
+        "Apresente-os ao usuário de forma clara, sem inventar informações.\n\n"
+        f"{json.dumps(dados, ensure_ascii=False, default=str)}"
+    )
+    with medir('gemini_formatacao', func_name):
+        yield from _gerar_texto('formatacao', [prompt_formatacao], stream)
+
+
+def _depois_de(entregue: bool, mensagem: str) -> str:
+    """Mensagem de falha; se parte da resposta já saiu, ela vai em um parágrafo próprio no fim."""
+    return f"\n\n{mensagem}" if entregue else mensagem
+
+
+def rotear_e_executar_mensagem(mensagem_usuario: str, tipo_usuario: str, ra_usuario: str = None, sessao: SessaoConversa = None) -> str:
     """Usa o Gemini para interpretar a intenção do usuário (Function Calling) e executa a função apropriada."""
+    resposta = "".join(_rotear_e_executar_mensagem(mensagem_usuario, tipo_usuario, ra_usuario, sessao))
+    if sessao is not None:
+        sessao.registrar_turno(mensagem_usuario, resposta)
+    return resposta
+
+
+def _rotear_e_executar_mensagem(mensagem_usuario: str, tipo_usuario: str, ra_usuario: str, sessao: SessaoConversa, stream: bool = False):
+    """
+    Produz a resposta em partes. Sem 'stream' cada chamada ao Gemini gera uma única parte; com 'stream',
+    a resposta direta do roteador e a formatação do resultado das ferramentas saem conforme são geradas.
+    """
+
+    # 1. CONTROLE DE PERMISSÃO E PERSONALIDADE (ver INSTRUCOES_PERFIL / FERRAMENTAS_POR_PERFIL)
+    papel = papel_do_usuario(tipo_usuario)
+    instrucoes_perfil = INSTRUCOES_PERFIL[papel]
+
+    # 1.1 FAST-PATH: pedidos óbvios são classificados localmente e dispensam o roteador do Gemini
+    try:
+        intencao = classificar_intencao(mensagem_usuario, tipo_usuario, ra_usuario, sessao.contexto() if sessao else None)
+    except Exception as e:
+        print(f"⚠️ Fast-path de intenções indisponível, usando o Gemini. Detalhe: {e}")
+        intencao = None
+
+    if intencao and intencao[2] >= INTENT_FASTPATH_MIN_CONFIDENCE:
+        func_name, func_args, confianca = intencao
+        _registrar_intencao(func_name)
+        argumentos = argumentos_da_ferramenta(func_name, func_args, papel, sessao)
+        if argumentos is None:
+            yield f"Joker: {MENSAGEM_SEM_IDENTIDADE}"
+            return
+        log_json("ferramenta", origem="fast_path", ferramenta=func_name, confianca=round(confianca, 2), args=argumentos)
+
+        with medir('ferramenta', func_name):
+            function_response_data = TOOLS[func_name](**argumentos)
+        if function_response_data.get('status') == 'error':
+            yield f"Joker: Oops! {function_response_data['message']}"
+            return
+        if sessao is not None:
+            sessao.lembrar(argumentos)
+
+        resposta_local = renderizar_resultado_tool(func_name, function_response_data)
+        if resposta_local is not None:
+            yield resposta_local
+            return
+
+        if not client:
+            yield "❌ Desculpe, a conexão com a inteligência artificial está temporariamente indisponível."
+            return
+        entregue = False
+        try:
+            for pedaco in _formatar_resultado_fastpath(func_name, function_response_data, instrucoes_perfil, stream):
+                entregue = True
+                yield pedaco
+        except GeminiSobrecarregado:
+            yield _depois_de(entregue, f"Joker: {MENSAGEM_SOBRECARGA}")
+        except Exception as e:
+            print(f"*** ERRO DETALHADO DO GEMINI (FORMATAÇÃO) ***: {e}")
+            yield _depois_de(entregue, "❌ Erro ao processar a requisição com o Gemini. Tente novamente. Verifique os logs do servidor para detalhes.")
+        return
+
+    _registrar_intencao(None)
 
     if not client:
-        return "❌ Desculpe, a conexão com a inteligência artificial está temporariamente indisponível."
-
-    # 1. CONTROLE DE PERMISSÃO E PERSONALIDADE (JOKER P5 EXCLUSIVO)
-    if tipo_usuario.upper() == 'PROFESSOR':
-        ferramentas_permitidas = list(TOOLS.values()) 
-        instrucoes_perfil = (
-            "Você é um assistente acadêmico para um **Professor**. Responda com um tom sarcástico, mas sempre respeitoso e informativo, usando a personalidade de **Akira Kurusu/Ren Amamiya, o 'Joker' dos Phantom Thieves de Persona 5**. Sua personalidade é a de um líder silencioso e confiante, que encoraja o usuário com frases como **'Take your time'** (Aproveite o seu tempo). Você **NÃO é o Coringa vilão da DC Comics**. "
-            "Suas principais tarefas são: 1. Ajudar o professor a visualizar dados acadêmicos. 2. Gerar material de estudo. 3. **Lançar notas (NP1, NP2, PIM) e faltas no sistema.** OBS: O status de conclusão da ED é fixo como 'ED CONCLUIDO' e a média é sempre calculada. A nota de corte para aprovação é 7.0."
-        )
-    else: # Aluno
-        ferramentas_permitidas = [
-            TOOLS['verificar_historico_academico'], 
-            TOOLS['gerar_material_estudo']
-        ]
-        instrucoes_perfil = (
-            "Você é um assistente acadêmico para um **Aluno**. Responda com um tom sarcástico, mas sempre informativo, usando a personalidade de **Akira Kurusu/Ren Amamiya, o 'Joker' dos Phantom Thieves de Persona 5**. Sua personalidade é a de um líder silencioso e confiante, que encoraja o usuário com frases como **'Take your time'** (Aproveite o seu tempo). Você **NÃO é o Coringa vilão da DC Comics**. "
-            "Suas principais tarefas são: 1. Ajudar o aluno a verificar o próprio histórico. 2. Gerar material de estudo. **(Você NÃO pode lançar ou alterar notas.)** A nota de corte para aprovação é 7.0."
-        )
-        
-    prompt_ferramenta = (
-        f"{instrucoes_perfil}\n\n"
-        "O usuário enviou a seguinte mensagem: '{}'. \n\n"
-        "**Instruções para Ferramentas:**\n"
-        "1. Se o usuário pedir especificamente por um RA, notas ou histórico, use 'verificar_dados_curso_api'.\n"
-        "2. Se o usuário pedir um material de estudo/resumo/explicação sobre um tópico, use 'buscar_material_estudo_api'.\n"
-        "3. Se o professor pedir para lançar NP1/NP2, use 'lancar_nota_np'.\n"
-        "4. Se o professor pedir para lançar PIM, use 'lancar_nota_pim'.\n"
-        "5. Se o professor pedir para lançar faltas, use 'lancar_faltas'.\n"
-        "6. Para **qualquer outra pergunta abrangente** ou se a função for desnecessária/impossível, **RESPONDA DIRETAMENTE**.\n"
-        "Em caso de dados faltantes (ex: RA), peça-os. \n\n"
-    ).format(mensagem_usuario)
+        yield "❌ Desculpe, a conexão com a inteligência artificial está temporariamente indisponível."
+        return
+
+    # O prefixo estático (persona + instruções + ferramentas) vai no cache de contexto do Gemini;
+    # a requisição leva só a mensagem e o contexto da sessão
+    prompt_ferramenta = f"O usuário enviou a seguinte mensagem: '{mensagem_usuario}'."
+    if sessao is not None:
+        contexto_sessao = sessao.contexto_prompt()
+        if contexto_sessao:
+            prompt_ferramenta += f"\n\n{contexto_sessao}"
 
     # 2. Envia a mensagem com as ferramentas FILTRADAS (APENAS FUNCTIONS)
+    # Em streaming, o texto da resposta direta já sai aqui; um pedaço com function_calls segue para o passo 3
+    response = None
+    entregue = False
     try:
-        response = client.models.generate_content(
-            model='gemini-2.5-flash',
-            contents=[prompt_ferramenta],
-            config=GenerateContentConfig(
-                # CORREÇÃO CRÍTICA: Não misturar Function Calling com google_search explícito.
-                tools=ferramentas_permitidas
-            )
-        )
+        inicio_router = time.perf_counter()
+        if stream:
+            for chunk in gerar_resposta_roteador_stream(papel, prompt_ferramenta):
+                if response is None and chunk.function_calls:
+                    response = chunk
+                elif response is None and chunk.text:
+                    entregue = True
+                    yield chunk.text
+        else:
+            response = gerar_resposta_roteador(papel, prompt_ferramenta)
+        with _intent_metrics_lock:
+            INTENT_FASTPATH_METRICS["router_llm_calls"] += 1
+            INTENT_FASTPATH_METRICS["router_llm_time_total_s"] += time.perf_counter() - inicio_router
+    except GeminiSobrecarregado as e:
+        print(f"⚠️ Gemini saturado, descartando a requisição: {e}")
+        yield _depois_de(entregue, f"Joker: {MENSAGEM_SOBRECARGA}")
+        return
     except Exception as e:
         print(f"*** ERRO DETALHADO DO GEMINI (ROTEADOR) ***: {e}")
-        return "❌ Erro ao processar a requisição com o Gemini. Tente novamente. Verifique os logs do servidor para detalhes."
+        yield _depois_de(entregue, "❌ Erro ao processar a requisição com o Gemini. Tente novamente. Verifique os logs do servidor para detalhes.")
+        return
 
+    if response is None:
+        return
 
     # 3. Verifica se o Gemini decidiu chamar uma função
     if response.function_calls:
         call = response.function_calls[0]
-        func_name = call.name
+        func_name = TOOLS_POR_NOME_FUNCAO.get(call.name, call.name)
         func_args = dict(call.args)
 
-        if func_name in TOOLS:
-            print(f"🤖 Chamando função {func_name} com args: {func_args}")
+        if func_name in TOOLS and func_name in FERRAMENTAS_POR_PERFIL[papel]:
+            argumentos = argumentos_da_ferramenta(func_name, func_args, papel, sessao)
+            if argumentos is None:
+                yield f"Joker: {MENSAGEM_SEM_IDENTIDADE}"
+                return
+            log_json("ferramenta", origem="gemini", ferramenta=func_name, args=argumentos)
 
             # 4. Executa a função localmente
-            function_response_data = TOOLS[func_name](**func_args)
+            with medir('ferramenta', func_name):
+                function_response_data = TOOLS[func_name](**argumentos)
 
             if function_response_data.get('status') == 'error':
-                return f"Joker: Oops! {function_response_data['message']}"
+                yield f"Joker: Oops! {function_response_data['message']}"
+                return
+            if sessao is not None:
+                sessao.lembrar(argumentos)
+
+            # 4.1 Template local: dispensa a segunda chamada ao Gemini (padrão)
+            resposta_local = renderizar_resultado_tool(func_name, function_response_data)
+            if resposta_local is not None:
+                yield resposta_local
+                return
 
             # 5. Envia o resultado da execução de volta ao Gemini
             segundo_prompt = [
                 response,
                 genai.types.Part.from_function_response(
-                    name=func_name,
+                    name=call.name,
                     # CORREÇÃO ESSENCIAL: Para 'buscar_material_estudo_api', enviamos APENAS a chave 'resultado'
                     # para garantir que o Gemini exiba o conteúdo puro e não o JSON completo da função.
                     response={"resultado": function_response_data.get("resultado")}
-                    if func_name == 'buscar_material_estudo_api'
+                    if func_name == 'gerar_material_estudo'
                     else function_response_data
                 )
             ]
 
             # 6. Gera a resposta final formatada para o usuário
-            final_response = client.models.generate_content(
-                model='gemini-2.5-flash',
-                contents=segundo_prompt
+            entregue = False
+            try:
+                with medir('gemini_formatacao', func_name):
+                    for pedaco in _gerar_texto('formatacao', segundo_prompt, stream):
+                        entregue = True
+                        yield pedaco
+            except GeminiSobrecarregado:
+                yield _depois_de(entregue, f"Joker: {MENSAGEM_SOBRECARGA}")
+            return
+
+    # 7. Se nenhuma função foi chamada, o Gemini respondeu diretamente (em streaming, já enviado no passo 2)
+    if not stream:
+        yield response.text or ""
+
+
+def rotear_e_executar_mensagem_stream(mensagem_usuario: str, tipo_usuario: str, ra_usuario: str = None, sessao: SessaoConversa = None):
+    """
+    Versão em streaming do roteador: a resposta direta do Gemini e a formatação do resultado das ferramentas
+    saem em pedaços conforme são geradas. Com a fila de material desativada (MATERIAL_FILA=0), o material
+    de estudo reconhecido pelo fast-path também é gerado em streaming; com ela, o worker gera o material e
+    o SSE do /web_router_stream informa o job.
+    """
+    try:
+        intencao = classificar_intencao(mensagem_usuario, tipo_usuario, ra_usuario, sessao.contexto() if sessao else None)
+    except Exception as e:
+        print(f"⚠️ Fast-path de intenções indisponível, usando o Gemini. Detalhe: {e}")
+        intencao = None
+
+    # Com a fila ativa o material é gerado pelo worker; o roteador só devolve o job
+    if (intencao and intencao[0] == 'gerar_material_estudo' and intencao[2] >= INTENT_FASTPATH_MIN_CONFIDENCE
+            and not fila_material_ativa()):
+        _registrar_intencao(intencao[0])
+        topico = intencao[1]['topico']
+        cabecalho = f"Joker: Material sobre **{topico}**. Estude no seu ritmo — take your time.\n\n"
+        yield cabecalho
+        pedacos = []
+        for pedaco in gerar_material_estudo_stream(topico):
+            pedacos.append(pedaco)
+            yield pedaco
+        if sessao is not None:
+            sessao.lembrar(intencao[1])
+            sessao.registrar_turno(mensagem_usuario, cabecalho + ''.join(pedacos))
+        return
+
+    pedacos = []
+    for pedaco in _rotear_e_executar_mensagem(mensagem_usuario, tipo_usuario, ra_usuario, sessao, stream=True):
+        pedacos.append(pedaco)
+        yield pedaco
+    if sessao is not None:
+        sessao.registrar_turno(mensagem_usuario, ''.join(pedacos))
+
+
+def _evento_sse(dados: dict) -> str:
+    return f"data: {json.dumps(dados, ensure_ascii=False)}\n\n"
+
+
+# --- 5. CANAL WHATSAPP/SMS (Twilio: confirma na hora, responde depois pela API REST) ---
+# O webhook da Twilio expira bem antes de uma resposta do Gemini: a rota só valida, deduplica e enfileira;
+# um pool de threads roda o roteador e envia a resposta em uma ou mais mensagens.
+
+_twilio_executor = ThreadPoolExecutor(max_workers=TWILIO_WORKERS, thread_name_prefix='twilio')
+_twilio_pendentes = threading.BoundedSemaphore(TWILIO_FILA_MAX)
+
+
+class _MensagensRecebidas:
+    """MessageSids vistos recentemente: a Twilio reenvia o webhook quando não recebe resposta a tempo."""
+
+    def __init__(self, ttl: int, max_itens: int = 10000):
+        self.ttl = ttl
+        self.max_itens = max_itens
+        self._vistos = OrderedDict()
+        self._lock = threading.Lock()
+
+    def registrar(self, message_sid: str) -> bool:
+        """Retorna True na primeira vez que o MessageSid aparece dentro da janela, False nas reentregas."""
+        agora = time.monotonic()
+        with self._lock:
+            while self._vistos and next(iter(self._vistos.values())) < agora - self.ttl:
+                self._vistos.popitem(last=False)
+            if message_sid in self._vistos:
+                return False
+            self._vistos[message_sid] = agora
+            while len(self._vistos) > self.max_itens:
+                self._vistos.popitem(last=False)
+            return True
+
+
+mensagens_twilio_recebidas = _MensagensRecebidas(TWILIO_DEDUP_TTL)
+
+
+def dividir_mensagem(texto: str, limite: int = TWILIO_MAX_CHARS) -> list:
+    """
+    Divide o texto em partes de até 'limite' caracteres, preferindo quebrar entre parágrafos, depois entre
+    linhas e por fim entre palavras. Com mais de uma parte, cada uma recebe o prefixo '(i/n)'.
+    """
+    if len(texto) <= limite:
+        return [texto]
+    limite_util = limite - len("(99/99) ")
+    partes = []
+    restante = texto.strip()
+    while len(restante) > limite_util:
+        corte = -1
+        for separador in ('\n\n', '\n', ' '):
+            corte = restante.rfind(separador, 0, limite_util)
+            if corte > limite_util // 2:
+                break
+        if corte <= 0:
+            corte = limite_util
+        partes.append(restante[:corte].rstrip())
+        restante = restante[corte:].lstrip()
+    if restante:
+        partes.append(restante)
+    return [f"({i}/{len(partes)}) {parte}" for i, parte in enumerate(partes, 1)]
+
+
+def _formatar_para_whatsapp(texto: str) -> str:
+    # O WhatsApp usa *negrito* em vez do **negrito** do Markdown
+    return texto.replace('**', '*')
+
+
+def enviar_mensagem_twilio(para: str, de: str, corpo: str):
+    """
+    Envia uma mensagem pela API REST da Twilio, com retentativas e jitter em 429/5xx e em falhas de rede
+    (conexão recusada ou derrubada, timeout). Uma queda depois de a Twilio aceitar o POST pode duplicar a
+    mensagem; para um aviso no WhatsApp, isso é melhor do que perdê-la.
+    """
+    url = f"{TWILIO_API_BASE}/2010-04-01/Accounts/{TWILIO_ACCOUNT_SID}/Messages.json"
+    dados = urllib.parse.urlencode({"To": para, "From": de, "Body": corpo}).encode()
+    credencial = base64.b64encode(f"{TWILIO_ACCOUNT_SID}:{TWILIO_AUTH_TOKEN}".encode()).decode()
+    for tentativa in range(TWILIO_MAX_TENTATIVAS):
+        req = urllib.request.Request(url, data=dados, headers={"Authorization": f"Basic {credencial}"})
+        try:
+            with medir('twilio_envio'):
+                with urllib.request.urlopen(req, timeout=TWILIO_TIMEOUT) as resp:
+                    return json.loads(resp.read() or b'{}')
+        except urllib.error.HTTPError as e:
+            if not (e.code == 429 or e.code >= 500) or tentativa == TWILIO_MAX_TENTATIVAS - 1:
+                raise
+            print(f"⚠️ Twilio respondeu {e.code}; nova tentativa ({tentativa + 2}/{TWILIO_MAX_TENTATIVAS}).")
+        except (urllib.error.URLError, TimeoutError, ConnectionError) as e:
+            if tentativa == TWILIO_MAX_TENTATIVAS - 1:
+                raise
+            print(f"⚠️ Falha de rede ao enviar pela Twilio ({e}); nova tentativa ({tentativa + 2}/{TWILIO_MAX_TENTATIVAS}).")
+        time.sleep(random.uniform(0, min(TWILIO_BACKOFF_MAX, TWILIO_BACKOFF_BASE * 2 ** tentativa)))
+
+
+_RE_TELEFONE = re.compile(r'^\+?\d{10,15}$')
+
+
+def normalizar_telefone(valor: str):
+    """'whatsapp:+55 (11) 99999-0000' -> '+5511999990000'; None se não for um número válido."""
+    numero = re.sub(r'[\s().-]', '', str(valor or '').split(':')[-1])
+    if not _RE_TELEFONE.match(numero):
+        return None
+    return numero if numero.startswith('+') else f"+{numero}"
+
+
+def _aluno_do_telefone(telefone: str):
+    """id_aluno, RA e nome do aluno que vinculou este número, ou None."""
+    numero = normalizar_telefone(telefone)
+    if numero is None:
+        return None
+    conn, cursor = get_db_connection()
+    try:
+        executar_preparada(cursor, 'aluno_por_telefone', (numero,))
+        return cursor.fetchone()
+    finally:
+        conn.close()
+
+
+def registrar_entrega_material(job_id: int, destino: str, origem: str):
+    """Agenda o envio do material do job para 'destino' quando ele terminar (ou envia já, se terminou)."""
+    conn, cursor = get_db_connection()
+    try:
+        cursor.execute(
+            "INSERT INTO Entregas_Material (fk_id_job, Destino, Origem) VALUES (%s, %s, %s) ON CONFLICT DO NOTHING",
+            (job_id, destino, origem)
+        )
+        conn.commit()
+    finally:
+        conn.close()
+    # O job pode ter terminado antes do INSERT: nesse caso o worker já passou e a entrega sai daqui
+    entregar_material_pronto(job_id)
+
+
+def entregar_material_pronto(job_id: int) -> int:
+    """
+    Envia o material (ou o motivo da falha) a quem pediu o job pelo WhatsApp/SMS, se ele já terminou.
+    Chamado pelo worker ao fim de cada job e pelo webhook ao registrar o pedido. Quem apaga a linha de
+    Entregas_Material é quem envia, então cada entrega sai uma vez só. Retorna o número de destinatários.
+    """
+    if not (TWILIO_ACCOUNT_SID and TWILIO_AUTH_TOKEN):
+        return 0
+    conn, cursor = get_db_connection()
+    try:
+        cursor.execute(
+            """
+            DELETE FROM Entregas_Material E USING Fila_Material F
+            WHERE E.fk_id_job = %s AND F.id_job = E.fk_id_job AND F.Status IN ('concluido', 'falhou')
+            RETURNING E.Destino, E.Origem
+            """,
+            (job_id,)
+        )
+        entregas = cursor.fetchall()
+        conn.commit()
+    finally:
+        conn.close()
+    if not entregas:
+        return 0
+
+    partes = dividir_mensagem(_formatar_para_whatsapp(_mensagem_job_material(consultar_job_material(job_id))))
+    for entrega in entregas:
+        try:
+            for parte in partes:
+                enviar_mensagem_twilio(entrega['destino'], entrega['origem'], parte)
+            log_json("twilio_material", job_id=job_id, de=entrega['destino'], partes=len(partes))
+        except Exception as e:
+            log_json("twilio_erro", job_id=job_id, de=entrega['destino'], erro=str(e))
+    return len(entregas)
+
+
+def _sessao_do_telefone(telefone: str) -> SessaoConversa:
+    """
+    Sessão do remetente. Com o número vinculado a um aluno, a sessão tem a identidade dele (RA e id_aluno)
+    e ele consulta o próprio histórico; sem vínculo, é anônima e só tem acesso ao material de estudo.
+    O vínculo é conferido de novo a cada mensagem enquanto a sessão for anônima.
+    """
+    # O próprio número é o ID da sessão: o LRU/TTL do SessaoStore descarta as conversas inativas
+    sessao_id = f"tel:{telefone}"
+    sessao = sessoes.obter(sessao_id)
+    if sessao is None or sessao.id_aluno is None:
+        aluno = _aluno_do_telefone(telefone)
+        if aluno is not None:
+            sessoes.criar(aluno['ra'], aluno['nome_completo'], 'ALUNO', aluno['id_aluno'], sessao_id=sessao_id)
+        elif sessao is None:
+            sessoes.criar(None, telefone, 'ALUNO', sessao_id=sessao_id)
+        sessao = sessoes.obter(sessao_id)
+    return sessao
+
+
+def _encerrar_sessoes_do_telefone(numero: str):
+    # O mesmo número chega como 'whatsapp:+55...' (WhatsApp) ou '+55...' (SMS)
+    for remetente in (numero, f"whatsapp:{numero}"):
+        sessoes.encerrar(f"tel:{remetente}")
+
+
+def _processar_mensagem_twilio(message_sid: str, de: str, para: str, corpo: str):
+    """Executado no pool: roda o roteador e devolve a resposta (em partes, se longa) pela API REST."""
+    _contexto_requisicao.request_id = message_sid
+    _contexto_requisicao.etapas = []
+    _contexto_requisicao.usuario = de
+    _contexto_requisicao.jobs_material = []
+    try:
+        with medir('twilio_mensagem'):
+            sessao = _sessao_do_telefone(de)
+            resposta = rotear_e_executar_mensagem(corpo, 'aluno', sessao.ra, sessao)
+            partes = dividir_mensagem(_formatar_para_whatsapp(resposta))
+            for parte in partes:
+                enviar_mensagem_twilio(de, para, parte)
+        log_json("twilio_resposta", de=de, partes=len(partes), etapas=_contexto_requisicao.etapas)
+        # Material na fila: o worker envia o conteúdo quando o job terminar; esta thread já fica livre
+        for job_id in _contexto_requisicao.jobs_material:
+            registrar_entrega_material(job_id, de, para)
+    except Exception as e:
+        log_json("twilio_erro", de=de, erro=str(e))
+    finally:
+        _twilio_pendentes.release()
+
+
+# --- 6. PIPELINE DE ARQUIVOS ESTÁTICOS (fingerprint, cache imutável, pré-compressão e WebP/AVIF) ---
+# Montado uma vez por processo (no mestre do gunicorn, antes do fork) e servido da memória: cada arquivo
+# ganha um nome com o hash do conteúdo e cache imutável; a página é reescrita para apontar para esses nomes.
+
+CACHE_IMUTAVEL = 'public, max-age=31536000, immutable'
+EXTENSOES_COMPRIMIVEIS = {'.html', '.css', '.js', '.svg', '.json', '.txt'}
+EXTENSOES_IMAGEM = {'.jpg', '.jpeg', '.png'}
+# (variante, tipo no Accept do navegador, formato do Pillow), na ordem de preferência
+VARIANTES_IMAGEM = (('avif', 'image/avif', 'AVIF'), ('webp', 'image/webp', 'WEBP'))
+_RE_REFERENCIA_ESTATICA = re.compile(r"(?<![\w/.-])static/([\w./-]+\.\w+)")
+
+METRICA_ASSETS_BYTES = Contador(
+    'joker_assets_bytes_total', 'Bytes de arquivos estáticos enviados, por variante (respostas 304 não contam).',
+    ('variante',)
+)
+
+
+class Asset:
+    """Um arquivo estático com as variantes (compressões ou formatos de imagem) prontas para envio."""
+
+    def __init__(self, nome: str, conteudo: bytes):
+        self.nome = nome
+        self.hash = hashlib.sha256(conteudo).hexdigest()[:12]
+        raiz, self.extensao = os.path.splitext(nome)
+        self.nome_com_hash = f"{raiz}.{self.hash}{self.extensao}"
+        self.mimetype = mimetypes.guess_type(nome)[0] or 'application/octet-stream'
+        # variante -> (corpo, Content-Type, Content-Encoding)
+        self.variantes = {'original': (conteudo, self.mimetype, None)}
+
+    def gerar_variantes(self):
+        conteudo = self.variantes['original'][0]
+        if self.extensao in EXTENSOES_COMPRIMIVEIS:
+            candidatas = {'gzip': gzip.compress(conteudo, compresslevel=9, mtime=0)}
+            if brotli is not None:
+                candidatas['br'] = brotli.compress(conteudo, quality=11)
+            for codificacao, corpo in candidatas.items():
+                if len(corpo) < len(conteudo):
+                    self.variantes[codificacao] = (corpo, self.mimetype, codificacao)
+        elif self.extensao in EXTENSOES_IMAGEM:
+            for variante, tipo, formato in VARIANTES_IMAGEM:
+                corpo = _converter_imagem(conteudo, self.hash, formato)
+                if corpo is not None and len(corpo) < len(conteudo):
+                    self.variantes[variante] = (corpo, tipo, None)
+
+    def negociar(self) -> str:
+        """Escolhe a variante pelo Accept (imagens) ou Accept-Encoding (texto) da requisição atual."""
+        if len(self.variantes) == 1:
+            return 'original'
+        if self.extensao in EXTENSOES_IMAGEM:
+            # Só tipos citados explicitamente: '*/*' não garante que o navegador decodifica AVIF
+            aceitos = {valor for valor, qualidade in request.accept_mimetypes if qualidade > 0}
+            for variante, tipo, _ in VARIANTES_IMAGEM:
+                if variante in self.variantes and tipo in aceitos:
+                    return variante
+        else:
+            for codificacao in ('br', 'gzip'):
+                if codificacao in self.variantes and request.accept_encodings[codificacao] > 0:
+                    return codificacao
+        return 'original'
+
+
+def _converter_imagem(conteudo: bytes, hash_original: str, formato: str):
+    """Codifica a imagem em WebP/AVIF, reaproveitando o resultado gravado em ASSETS_CACHE_DIR."""
+    if Image is None or not pil_features.check(formato.lower()):
+        return None
+    caminho = os.path.join(ASSETS_CACHE_DIR, f"{hash_original}.{formato.lower()}")
+    try:
+        with open(caminho, 'rb') as f:
+            return f.read()
+    except FileNotFoundError:
+        pass
+    try:
+        with medir('asset_conversao', formato.lower()):
+            imagem = Image.open(io.BytesIO(conteudo))
+            saida = io.BytesIO()
+            qualidade = ASSETS_QUALIDADE_AVIF if formato == 'AVIF' else ASSETS_QUALIDADE_WEBP
+            imagem.save(saida, format=formato, quality=qualidade)
+        corpo = saida.getvalue()
+        # Gravação atômica: vários workers podem converter o mesmo arquivo ao mesmo tempo
+        os.makedirs(ASSETS_CACHE_DIR, exist_ok=True)
+        temporario = f"{caminho}.{os.getpid()}.tmp"
+        with open(temporario, 'wb') as f:
+            f.write(corpo)
+        os.replace(temporario, caminho)
+        return corpo
+    except Exception as e:
+        print(f"⚠️ Falha ao gerar {formato} de um arquivo estático ({hash_original}). Detalhe: {e}")
+        return None
+
+
+class PipelineAssets:
+    """Índice dos estáticos por nome original e por nome com hash, mais a página já reescrita."""
+
+    def __init__(self, diretorio: str, pagina: str):
+        self.diretorio = diretorio
+        self.caminho_pagina = pagina
+        self._por_nome = {}
+        self._por_nome_com_hash = {}
+        self._pagina = None
+        self._lock = threading.Lock()
+
+    def carregar(self):
+        """Lê, versiona e pré-processa tudo. Chamado no mestre do gunicorn ou na primeira requisição."""
+        with self._lock:
+            if self._pagina is not None:
+                return
+            inicio = time.perf_counter()
+            por_nome, por_nome_com_hash = {}, {}
+            for raiz, pastas, arquivos in os.walk(self.diretorio):
+                pastas[:] = [p for p in pastas if not p.startswith('.')]
+                for arquivo in arquivos:
+                    if arquivo.startswith('.'):
+                        continue
+                    caminho = os.path.join(raiz, arquivo)
+                    nome = os.path.relpath(caminho, self.diretorio).replace(os.sep, '/')
+                    with open(caminho, 'rb') as f:
+                        asset = Asset(nome, f.read())
+                    asset.gerar_variantes()
+                    por_nome[nome] = asset
+                    por_nome_com_hash[asset.nome_com_hash] = asset
+
+            with open(self.caminho_pagina, 'rb') as f:
+                html = f.read().decode('utf-8')
+            html = _RE_REFERENCIA_ESTATICA.sub(
+                lambda m: f"static/{por_nome[m.group(1)].nome_com_hash}" if m.group(1) in por_nome else m.group(0),
+                html
             )
+            pagina = Asset(os.path.basename(self.caminho_pagina), html.encode('utf-8'))
+            pagina.gerar_variantes()
 
-            return final_response.text
+            self._por_nome, self._por_nome_com_hash = por_nome, por_nome_com_hash
+            self._pagina = pagina
+            print(f"✅ {len(por_nome)} arquivos estáticos versionados em {time.perf_counter() - inicio:.2f}s.")
 
-    # 7. Se nenhuma função foi chamada, o Gemini respondeu diretamente
-    return response.text
+    def pagina(self) -> Asset:
+        if self._pagina is None:
+            self.carregar()
+        return self._pagina
+
+    def obter(self, nome: str):
+        """Retorna (asset, imutável). Nomes com hash são imutáveis; os originais seguem valendo, com cache curto."""
+        if self._pagina is None:
+            self.carregar()
+        asset = self._por_nome_com_hash.get(nome)
+        if asset is not None:
+            return asset, True
+        return self._por_nome.get(nome), False
+
+
+assets = PipelineAssets(ASSETS_DIR, ASSETS_PAGINA)
+
+
+def responder_asset(asset: Asset, cache_control: str) -> Response:
+    """Envia a variante negociada com ETag e Cache-Control, ou 304 se o navegador já tem a mesma."""
+    variante = asset.negociar()
+    corpo, tipo, codificacao = asset.variantes[variante]
+    etag = f"{asset.hash}-{variante}"
+    cabecalhos = {'Cache-Control': cache_control}
+    if len(asset.variantes) > 1:
+        cabecalhos['Vary'] = 'Accept' if asset.extensao in EXTENSOES_IMAGEM else 'Accept-Encoding'
+
+    if request.if_none_match.contains(etag):
+        resposta = Response(status=304, headers=cabecalhos)
+        resposta.set_etag(etag)
+        return resposta
+
+    resposta = Response(corpo, mimetype=tipo, headers=cabecalhos)
+    resposta.set_etag(etag)
+    if codificacao:
+        resposta.headers['Content-Encoding'] = codificacao
+    METRICA_ASSETS_BYTES.incrementar(variante, valor=len(corpo))
+    return resposta
 
 
 # --- ROTAS DE FLASK (Login e Router) ---
 
 @app.route('/login', methods=['POST'])
 def handle_login():
-    """Simulação de autenticação e inicialização do DB."""
-    global DB_INITIALIZED    
-    
+    """Simulação de autenticação."""
     conn = None
     try:
-        if not DB_INITIALIZED:
-            if init_db():
-                DB_INITIALIZED = True
-            else:
-                return jsonify({"status": "error", "message": "Falha crítica ao inicializar o banco de dados. Verifique a variável DATABASE_URL nos logs."}), 503
-
         data = request.get_json()
         tipo_usuario = data.get('tipo_usuario', '').upper().strip()
         senha = data.get('senha')    
@@ -708,11 +4456,9 @@ def handle_login():
         conn, cursor = get_db_connection()
         
         if tipo_usuario == 'ALUNO':
-            sql = "SELECT Nome_Completo FROM Alunos WHERE RA = %s AND Senha = %s AND Tipo_Usuario = 'Aluno'"
-            cursor.execute(sql, (credencial, senha))
+            executar_preparada(cursor, 'login_aluno', (credencial, senha))
         elif tipo_usuario == 'PROFESSOR':
-            sql = "SELECT Nome_Completo FROM Alunos WHERE RA = %s AND Senha = %s AND Codigo_Seguranca = %s AND Tipo_Usuario = 'Professor'"
-            cursor.execute(sql, (credencial, senha, codigo_seguranca))
+            executar_preparada(cursor, 'login_professor', (credencial, senha, codigo_seguranca))
         else:
             conn.close()
             return jsonify({"status": "error", "message": "Tipo de usuário inválido."}), 400
@@ -721,13 +4467,19 @@ def handle_login():
 
         if user_info:
             conn.close()
+            id_aluno = user_info['id_aluno']
+            sessao_id = sessoes.criar(credencial, user_info['nome_completo'], tipo_usuario, id_aluno)
+            ids_alunos.set(credencial, id_aluno)
             return jsonify({
                 "status": "success",
                 "message": "Login bem-sucedido!",
                 "user": {
                     "nome": user_info['nome_completo'],
                     "ra": credencial,
-                    "tipo_usuario": tipo_usuario.lower()
+                    "tipo_usuario": tipo_usuario.lower(),
+                    "session_id": sessao_id,
+                    # Enviar em 'Authorization: Bearer <token>' no /web_router e no /web_router_stream
+                    "token": emitir_token_sessao(id_aluno, credencial, user_info['nome_completo'], tipo_usuario, sessao_id)
                 }
             }), 200
         else:
@@ -739,49 +4491,367 @@ def handle_login():
             conn.close()
         return jsonify({"status": "error", "message": f"Erro de servidor: {e}"}), 500
 
+@app.route('/telefone', methods=['POST'])
+def vincular_telefone():
+    """
+    Vincula ao aluno logado (token do /login) o número de WhatsApp/SMS em 'telefone'; 'telefone' vazio ou
+    null desfaz o vínculo. Só números vinculados consultam notas pelo canal da Twilio.
+    """
+    data = request.get_json(silent=True) or {}
+    usuario = usuario_autenticado(data)
+    if usuario is None:
+        return jsonify({"status": "error", "message": MENSAGEM_TOKEN_INVALIDO}), 401
+    if usuario['tipo'] != 'ALUNO':
+        return jsonify({"status": "error", "message": "Só alunos vinculam um telefone."}), 403
+
+    numero = None
+    if data.get('telefone'):
+        numero = normalizar_telefone(data['telefone'])
+        if numero is None:
+            return jsonify({"status": "error", "message": "Telefone inválido. Use o formato internacional, ex.: +5511999990000."}), 400
+
+    conn = None
+    try:
+        conn, cursor = get_db_connection()
+        cursor.execute("""
+        WITH anterior AS (SELECT Telefone FROM Alunos WHERE id_aluno = %s)
+        UPDATE Alunos A SET Telefone = %s FROM anterior
+        WHERE A.id_aluno = %s AND A.Tipo_Usuario = 'Aluno'
+        RETURNING anterior.Telefone AS anterior;
+        """, (usuario['id'], numero, usuario['id']))
+        alterado = cursor.fetchone()
+        conn.commit()
+    except psycopg2.errors.UniqueViolation:
+        conn.rollback()
+        return jsonify({"status": "error", "message": "Este telefone já está vinculado a outro aluno."}), 409
+    except Exception as e:
+        return jsonify({"status": "error", "message": f"Erro de servidor: {e}"}), 500
+    finally:
+        if conn:
+            conn.close()
+
+    if alterado is None:
+        return jsonify({"status": "error", "message": "Aluno não encontrado."}), 404
+    # Conversas abertas pelo número antigo ou pelo novo recomeçam com a identidade atualizada
+    for anterior_ou_novo in {alterado['anterior'], numero} - {None}:
+        _encerrar_sessoes_do_telefone(anterior_ou_novo)
+    return jsonify({"status": "success", "telefone": numero}), 200
+
+
 @app.route('/web_router', methods=['POST'])
 def web_router():
     """Rota unificada para receber mensagens do chat e rotear para o Gemini/DB."""
-    global DB_INITIALIZED
-    if not DB_INITIALIZED:
-        if init_db():
-            DB_INITIALIZED = True
-        else:
-            return jsonify({"error": "Serviço indisponível. Falha na inicialização do banco de dados."}), 503
-
     try:
         data = request.get_json()
         message = data.get('message', '').strip()
-        tipo_usuario = data.get('tipo_usuario', '').strip()
+        # O token assinado no /login é a fonte de verdade de quem está conversando (e do perfil);
+        # 'tipo_usuario' e 'ra' do corpo são ignorados
+        usuario = usuario_autenticado(data)
+        if usuario is None:
+            return jsonify({"error": MENSAGEM_TOKEN_INVALIDO}), 401
+        sessao = sessoes.retomar(usuario)
+        tipo_usuario, ra_usuario = usuario['tipo'], usuario['ra']
+        # Chave do limite de taxa por usuário no gateway do Gemini
+        _contexto_requisicao.usuario = ra_usuario
 
         if not message:
             return jsonify({"error": "Mensagem vazia."}), 400
-        
-        if not tipo_usuario:
-            return jsonify({"error": "Tipo de usuário ausente na requisição."}), 400
 
-        response_text = rotear_e_executar_mensagem(message, tipo_usuario)
+        response_text = rotear_e_executar_mensagem(message, tipo_usuario, ra_usuario, sessao)
 
-        return jsonify({"message": response_text}), 200
+        resposta = {"message": response_text}
+        if _contexto_requisicao.jobs_material:
+            # Material na fila: acompanhe em /material/<job_id> ou /material/<job_id>/eventos
+            resposta["job_id"] = _contexto_requisicao.jobs_material[-1]
+        return jsonify(resposta), 200
 
     except Exception as e:
         return jsonify({"error": f"Erro interno no roteador: {e}"}), 500
 
 
+@app.route('/web_router_stream', methods=['POST'])
+def web_router_stream():
+    """Variante do /web_router que envia a resposta em pedaços via Server-Sent Events."""
+    data = request.get_json(silent=True) or {}
+    message = data.get('message', '').strip()
+    usuario = usuario_autenticado(data)
+    if usuario is None:
+        return jsonify({"error": MENSAGEM_TOKEN_INVALIDO}), 401
+    sessao = sessoes.retomar(usuario)
+    tipo_usuario, ra_usuario = usuario['tipo'], usuario['ra']
+    _contexto_requisicao.usuario = ra_usuario
+
+    if not message:
+        return jsonify({"error": "Mensagem vazia."}), 400
+
+    def gerar_eventos():
+        try:
+            for pedaco in rotear_e_executar_mensagem_stream(message, tipo_usuario, ra_usuario, sessao):
+                if pedaco:
+                    yield _evento_sse({"delta": pedaco})
+            for job_id in _contexto_requisicao.jobs_material:
+                yield _evento_sse({"job": job_id})
+        except Exception as e:
+            yield _evento_sse({"error": f"Erro interno no roteador: {e}"})
+        yield _evento_sse({"done": True})
+
+    return Response(
+        stream_with_context(gerar_eventos()),
+        mimetype='text/event-stream',
+        # Desliga buffers de proxy para que cada pedaço chegue ao navegador imediatamente
+        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+    )
+
+
+def _exportar_snapshots() -> list:
+    """Converte os snapshots numéricos (pool, caches, fast-path, tokens, sessões) em gauges."""
+    snapshots = {
+        'historico_cache': historico_cache.stats,
+        'material_cache': material_cache.stats,
+        'intent_fastpath': intent_fastpath_stats,
+        'gemini_tokens': gemini_token_stats,
+        'sessoes': sessoes.stats,
+        'fila_material': fila_material_stats,
+    }
+    if _db_pool is not None:
+        snapshots['db_pool'] = _db_pool.stats
+    linhas = []
+    for grupo, snapshot in snapshots.items():
+        for chave, valor in snapshot().items():
+            if isinstance(valor, bool) or not isinstance(valor, (int, float)):
+                valor = int(valor) if isinstance(valor, bool) else None
+            if valor is None:
+                continue
+            nome = f"joker_{grupo}_{chave}"
+            linhas.append(f"# TYPE {nome} gauge")
+            linhas.append(f"{nome} {valor}")
+    return linhas
+
+
+@app.route('/metrics')
+def metrics():
+    """Métricas no formato de texto do Prometheus: duração por etapa, requisições e snapshots internos."""
+    linhas = []
+    for metrica in (
+        METRICA_ETAPAS, METRICA_ERROS_ETAPAS, METRICA_REQUISICOES, METRICA_RESPOSTAS, METRICA_GATEWAY,
+        METRICA_GEMINI_DURACAO, METRICA_GEMINI_TOKENS,
+    ):
+        linhas.extend(metrica.exportar())
+    linhas.extend(_exportar_snapshots())
+    return Response("\n".join(linhas) + "\n", mimetype='text/plain; version=0.0.4')
+
+
+@app.route('/importar_notas', methods=['POST'])
+def importar_notas():
+    """
+    Importação em lote para professores. Aceita:
+    - multipart/form-data com o arquivo CSV em 'arquivo' (colunas: ra, disciplina, np1, np2, pim, faltas;
+      separador ',' ou ';') e as credenciais 'funcional', 'codigo_seguranca' e 'senha';
+    - JSON com as credenciais e a lista 'linhas' de objetos com as mesmas colunas.
+    """
+    arquivo = request.files.get('arquivo')
+    if arquivo:
+        credenciais = request.form
+    else:
+        credenciais = request.get_json(silent=True) or {}
+        linhas = credenciais.get('linhas')
+        if not isinstance(linhas, list) or not all(isinstance(l, dict) for l in linhas):
+            return jsonify({"status": "error", "message": f"Envie um CSV em 'arquivo' ou uma lista 'linhas' com as colunas {', '.join(COLUNAS_IMPORTACAO)}."}), 400
+
+    try:
+        conn, cursor = get_db_connection()
+        try:
+            autorizado = _autenticar_professor(
+                cursor, credenciais.get('funcional'), credenciais.get('senha'), credenciais.get('codigo_seguranca')
+            )
+        finally:
+            conn.close()
+        if not autorizado:
+            return jsonify({"status": "error", "message": "Credenciais de professor inválidas."}), 401
+
+        if arquivo:
+            # O CSV é lido em streaming, linha a linha, direto do upload
+            texto = io.TextIOWrapper(arquivo.stream, encoding='utf-8-sig')
+            cabecalho = texto.readline()
+            try:
+                dialeto = csv.Sniffer().sniff(cabecalho, delimiters=',;')
+            except csv.Error:
+                dialeto = csv.excel
+            nomes_colunas = next(csv.reader([cabecalho], dialeto), [])
+            linhas = csv.DictReader(texto, fieldnames=[c.strip().lower() for c in nomes_colunas], dialect=dialeto)
+
+        resultado = importar_notas_lote_api(linhas)
+        return jsonify(resultado), 200 if resultado['status'] == 'success' else 500
+
+    except UnicodeDecodeError:
+        return jsonify({"status": "error", "message": "O arquivo CSV deve estar codificado em UTF-8."}), 400
+    except csv.Error as e:
+        return jsonify({"status": "error", "message": f"Arquivo CSV inválido: {e}"}), 400
+    except Exception as e:
+        return jsonify({"status": "error", "message": f"Erro de servidor: {e}"}), 500
+
+
+@app.route('/twilio_webhook', methods=['POST'])
+def twilio_webhook():
+    """
+    Webhook de mensagens (WhatsApp/SMS) da Twilio. Responde na hora com TwiML vazio e processa em segundo
+    plano; reentregas do mesmo MessageSid são ignoradas.
+    """
+    if not (TWILIO_ACCOUNT_SID and TWILIO_AUTH_TOKEN):
+        return jsonify({"error": "Canal Twilio não configurado (TWILIO_ACCOUNT_SID / TWILIO_AUTH_TOKEN)."}), 503
+
+    if TWILIO_VALIDAR_ASSINATURA:
+        valido = RequestValidator(TWILIO_AUTH_TOKEN).validate(
+            request.url, request.form.to_dict(), request.headers.get('X-Twilio-Signature', '')
+        )
+        if not valido:
+            return jsonify({"error": "Assinatura da Twilio inválida."}), 403
+
+    message_sid = request.form.get('MessageSid', '')
+    de = request.form.get('From', '')
+    para = request.form.get('To', '')
+    corpo = (request.form.get('Body') or '').strip()
+    twiml = MessagingResponse()
+
+    if not (message_sid and de and corpo):
+        return Response(str(twiml), mimetype='application/xml')
+    if not mensagens_twilio_recebidas.registrar(message_sid):
+        log_json("twilio_reentrega_ignorada", message_sid=message_sid)
+        return Response(str(twiml), mimetype='application/xml')
+
+    if not _twilio_pendentes.acquire(blocking=False):
+        # Fila cheia: avisa no próprio TwiML em vez de deixar a mensagem sem resposta
+        twiml.message(f"Joker: {MENSAGEM_SOBRECARGA}")
+        return Response(str(twiml), mimetype='application/xml')
+
+    _twilio_executor.submit(_processar_mensagem_twilio, message_sid, de, para, corpo)
+    return Response(str(twiml), mimetype='application/xml')
+
+
+def _mensagem_job_material(job: dict) -> str:
+    """Texto do chat para um job finalizado (material pronto ou motivo da falha)."""
+    if job['status'] == 'concluido':
+        return _renderizar_material(job | {"job_id": None})
+    if job['status'] == 'falhou':
+        return f"Joker: Oops! Não consegui gerar o material sobre **{job['topico']}**. {job['erro'] or ''}".rstrip()
+    return f"Joker: O pedido de material sobre **{job['topico']}** foi cancelado."
+
+
+def _job_para_resposta(job: dict) -> dict:
+    if job['status'] in STATUS_FINAIS_JOB:
+        job = job | {"mensagem": _mensagem_job_material(job)}
+    return job
+
+
+@app.route('/material/<int:job_id>', methods=['GET'])
+def status_job_material(job_id):
+    """Polling do job de material: status, tentativas e, quando concluído, o material ('mensagem' já formatada)."""
+    try:
+        job = consultar_job_material(job_id)
+    except Exception as e:
+        return jsonify({"status": "error", "message": f"Erro de servidor: {e}"}), 500
+    if job is None:
+        return jsonify({"status": "error", "message": "Job não encontrado."}), 404
+    return jsonify(_job_para_resposta(job)), 200
+
+
+@app.route('/material/<int:job_id>/eventos', methods=['GET'])
+def eventos_job_material(job_id):
+    """Assinatura do job via Server-Sent Events: um evento por mudança de status, até o job terminar."""
+    def gerar_eventos():
+        try:
+            encontrado = False
+            for job in acompanhar_job_material(job_id, MATERIAL_JOB_TIMEOUT * MATERIAL_MAX_TENTATIVAS):
+                encontrado = True
+                yield _evento_sse(_job_para_resposta(job))
+            if not encontrado:
+                yield _evento_sse({"error": "Job não encontrado."})
+        except Exception as e:
+            yield _evento_sse({"error": f"Erro de servidor: {e}"})
+        yield _evento_sse({"done": True})
+
+    return Response(
+        stream_with_context(gerar_eventos()),
+        mimetype='text/event-stream',
+        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+    )
+
+
+@app.route('/material/<int:job_id>/cancelar', methods=['POST'])
+def cancelar_job_material_rota(job_id):
+    """Cancela um job de material pendente/em execução. Só quem pediu (mesmo RA do token) pode cancelar."""
+    usuario = usuario_autenticado(request.get_json(silent=True) or {})
+    if usuario is None:
+        return jsonify({"status": "error", "message": MENSAGEM_TOKEN_INVALIDO}), 401
+    solicitante = usuario['ra']
+    try:
+        if cancelar_job_material(job_id, solicitante):
+            return jsonify({"status": "success", "job_id": job_id, "message": "Pedido de material cancelado."}), 200
+        job = consultar_job_material(job_id)
+    except Exception as e:
+        return jsonify({"status": "error", "message": f"Erro de servidor: {e}"}), 500
+    if job is None:
+        return jsonify({"status": "error", "message": "Job não encontrado."}), 404
+    return jsonify({
+        "status": "error", "message": f"O job não pode ser cancelado (status: {job['status']}, ou pedido por outro usuário)."
+    }), 409
+
+
+@app.route('/estatisticas', methods=['POST'])
+def estatisticas():
+    """
+    Estatísticas da turma para painéis (professores). JSON com 'funcional', 'senha', 'codigo_seguranca' e,
+    opcionalmente, 'semestre', 'disciplina' e 'atualizar' (true recalcula o resumo antes de ler).
+    """
+    data = request.get_json(silent=True) or {}
+    try:
+        conn, cursor = get_db_connection()
+        try:
+            autorizado = _autenticar_professor(cursor, data.get('funcional'), data.get('senha'), data.get('codigo_seguranca'))
+        finally:
+            conn.close()
+        if not autorizado:
+            return jsonify({"status": "error", "message": "Credenciais de professor inválidas."}), 401
+
+        if data.get('atualizar'):
+            atualizar_resumo_desempenho()
+        resultado = estatisticas_turma_api(data.get('semestre') or 0, data.get('disciplina') or '')
+        return jsonify(resultado), 200 if resultado['status'] == 'success' else 404
+
+    except Exception as e:
+        return jsonify({"status": "error", "message": f"Erro de servidor: {e}"}), 500
+
+
+@app.route('/static/<path:nome>')
+def servir_asset(nome):
+    """Serve os arquivos da pasta 'static' pelo pipeline de assets (versões com hash têm cache imutável)."""
+    asset, imutavel = assets.obter(nome)
+    if asset is None:
+        return jsonify({"error": "Arquivo não encontrado."}), 404
+    return responder_asset(asset, CACHE_IMUTAVEL if imutavel else f"public, max-age={ASSETS_MAX_AGE_SEM_HASH}")
+
+
 @app.route('/<path:filename>')
 def serve_static(filename):
-    """Serve arquivos estáticos (CSS, JS, imagens) localizados na pasta 'static'."""
+    """Compatibilidade com o link direto para a página; os demais estáticos ficam em '/static'."""
     if filename == 'joker_bot.html':
-        return send_file(filename)
-    return send_file(filename)
+        return index()
+    return jsonify({"error": "Arquivo não encontrado."}), 404
 
 
 @app.route('/')
 def index():
-    """Rota da página inicial."""
-    return send_file('joker_bot.html')
+    """Rota da página inicial (revalidada a cada acesso, pois aponta para os estáticos da versão atual)."""
+    return responder_asset(assets.pagina(), 'no-cache')
 
 
 if __name__ == '__main__':
+    # Servidor de desenvolvimento: em produção o gunicorn faz estes passos (ver gunicorn.conf.py)
+    aplicar_migracoes()
+    assets.carregar()
+    iniciar_tarefas_de_fundo()
+    if fila_material_ativa():
+        # Em produção o worker é um processo separado (Procfile); aqui roda junto, em segundo plano
+        threading.Thread(target=WorkerMaterial(MATERIAL_WORKERS).executar, name="worker-material", daemon=True).start()
     port = int(os.environ.get('PORT', 5000))
     app.run(host='0.0.0.0', port=port, debug=False)
@@ -0,0 +1,65 @@
+"""
+Benchmark de cold start: latência do primeiro /login de um worker recém-iniciado.
+
+Compara o modelo antigo (o script SQL completo rodando dentro da primeira requisição) com o atual
+(migrações aplicadas no boot; a requisição não faz trabalho de schema). Cada medição roda em um
+processo Python novo, como um worker recém-criado pelo gunicorn.
+
+Requer DATABASE_URL apontando para um banco descartável (as migrações serão aplicadas nele).
+Uso: python benchmarks/cold_start.py --rodadas 5
+"""
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+
+RAIZ = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Executado em um processo novo: mede o primeiro /login (e, no modo 'legado', o script de schema antes dele)
+_SCRIPT_WORKER = r"""
+import sys, time
+import app
+modo = sys.argv[1]
+cliente = app.app.test_client()
+inicio = time.perf_counter()
+if modo == 'legado':
+    conn, cursor = app.get_db_connection()
+    for _, _, passo in app.MIGRACOES:
+        passo(cursor) if callable(passo) else cursor.execute(passo)
+    conn.commit()
+    conn.close()
+resp = cliente.post('/login', json={"tipo_usuario": "aluno", "ra": "R818888", "senha": "123456"})
+assert resp.status_code == 200, resp.get_json()
+print(time.perf_counter() - inicio)
+"""
+
+
+def _medir(modo):
+    saida = subprocess.run(
+        [sys.executable, '-c', _SCRIPT_WORKER, modo],
+        cwd=RAIZ, capture_output=True, text=True, check=True
+    ).stdout
+    return float(saida.strip().splitlines()[-1])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--rodadas', type=int, default=5)
+    args = parser.parse_args()
+
+    if not os.environ.get('DATABASE_URL'):
+        sys.exit("Defina DATABASE_URL (banco descartável) para rodar o benchmark.")
+
+    sys.path.insert(0, RAIZ)
+    import app
+    aplicadas = app.aplicar_migracoes()
+    print(f"Migrações aplicadas antes do benchmark: {len(aplicadas)}")
+
+    for modo, titulo in (('legado', 'schema na 1ª requisição'), ('migrado', 'migrações no boot')):
+        tempos = [_medir(modo) for _ in range(args.rodadas)]
+        print(f"{titulo:>25}: mediana {statistics.median(tempos) * 1000:7.1f} ms | máx {max(tempos) * 1000:7.1f} ms")
+
+
+if __name__ == '__main__':
+    main()
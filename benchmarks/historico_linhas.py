@@ -0,0 +1,120 @@
+"""
+Micro-benchmark da montagem do histórico a partir das linhas do banco (sem I/O).
+
+Gera N linhas sintéticas no formato de 'historico_exibicao_por_ra' e compara, por 10 mil linhas:
+- dict: RealDictRow por linha (cursor padrão do get_db_connection) + um dict de saída por linha (antigo);
+- namedtuple: uma namedtuple por linha (como o NamedTupleCursor) + dict de saída;
+- tupla: cursor de tuplas desempacotado em uma passada por app._montar_historico (atual).
+Mede o tempo (melhor de --repeticoes) e o pico de memória alocada (tracemalloc) de cada caminho,
+incluindo a criação das linhas, que é o custo que cada tipo de cursor impõe ao fetchall().
+
+Uso: python benchmarks/historico_linhas.py --linhas 10000
+"""
+import argparse
+import os
+import sys
+import time
+import tracemalloc
+from collections import namedtuple
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import psycopg2.extras  # noqa: E402
+
+import app  # noqa: E402
+
+COLUNAS = ('nome_completo', 'nome_disciplina', 'semestre', 'tipo_avaliacao',
+           'np1', 'np2', 'pim_nota', 'media_final', 'faltas', 'status_conclusao')
+Registro = namedtuple('Registro', COLUNAS)
+
+
+def _linhas_brutas(total):
+    """Tuplas como o psycopg2 devolve (números já formatados pelo SQL materializado)."""
+    return [
+        (f"Aluno {i // 16}", f"Disciplina {i % 16}", 1 + (i % 16) // 8, 'TEORICA' if i % 2 else 'ED',
+         f"{i % 10}.50", f"{(i + 3) % 10}.00", 'Indefinida', f"{(i + 1) % 10}.20",
+         None if i % 5 == 0 else i % 20, 'Aprovado' if i % 3 else 'Reprovado')
+        for i in range(total)
+    ]
+
+
+def caminho_dict(brutas):
+    registros = [psycopg2.extras.RealDictRow(zip(COLUNAS, linha)) for linha in brutas]
+    return [
+        {
+            "semestre": reg['semestre'],
+            "disciplina": reg['nome_disciplina'],
+            "tipo": reg['tipo_avaliacao'],
+            "np1": reg['np1'],
+            "np2": reg['np2'],
+            "pim_nota": reg['pim_nota'],
+            "media_final": reg['media_final'],
+            "faltas": reg['faltas'] if reg['faltas'] is not None else "N/A",
+            "status_conclusao": reg['status_conclusao'],
+        }
+        for reg in registros
+    ]
+
+
+def caminho_namedtuple(brutas):
+    registros = [Registro._make(linha) for linha in brutas]
+    return [
+        {
+            "semestre": reg.semestre,
+            "disciplina": reg.nome_disciplina,
+            "tipo": reg.tipo_avaliacao,
+            "np1": reg.np1,
+            "np2": reg.np2,
+            "pim_nota": reg.pim_nota,
+            "media_final": reg.media_final,
+            "faltas": "N/A" if reg.faltas is None else reg.faltas,
+            "status_conclusao": reg.status_conclusao,
+        }
+        for reg in registros
+    ]
+
+
+def caminho_tupla(brutas):
+    # O cursor de tuplas entrega a lista como está: não há objeto de linha extra para criar
+    registros = list(brutas)
+    return app._montar_historico(registros)
+
+
+CAMINHOS = {'dict (antigo)': caminho_dict, 'namedtuple': caminho_namedtuple, 'tupla (atual)': caminho_tupla}
+
+
+def _medir(funcao, brutas, repeticoes):
+    melhor = float('inf')
+    for _ in range(repeticoes):
+        inicio = time.perf_counter()
+        funcao(brutas)
+        melhor = min(melhor, time.perf_counter() - inicio)
+
+    tracemalloc.start()
+    resultado = funcao(brutas)
+    _, pico = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return melhor, pico, resultado
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--linhas', type=int, default=10000)
+    parser.add_argument('--repeticoes', type=int, default=20)
+    args = parser.parse_args()
+
+    brutas = _linhas_brutas(args.linhas)
+    fator = 10000 / args.linhas
+    referencia = None
+    print(f"{'caminho':>15} {'ms/10k':>9} {'KiB/10k':>9}")
+    for nome, funcao in CAMINHOS.items():
+        tempo, pico, resultado = _medir(funcao, brutas, args.repeticoes)
+        if referencia is None:
+            referencia = (tempo, pico, resultado)
+        assert resultado == referencia[2], f"{nome} montou um histórico diferente"
+        print(f"{nome:>15} {tempo * 1000 * fator:9.2f} {pico / 1024 * fator:9.0f}"
+              f"   ({tempo / referencia[0]:.2f}x tempo, {pico / referencia[1]:.2f}x memória)")
+
+
+if __name__ == '__main__':
+    main()
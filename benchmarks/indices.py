@@ -0,0 +1,140 @@
+"""
+Benchmark dos índices e das consultas preparadas nas buscas quentes (RA, nome da disciplina e PIM).
+
+Para cada tamanho em --tamanhos, completa o banco até esse número de alunos sintéticos (RA 'B0000001',
+...), cada um com histórico em todas as disciplinas, e roda EXPLAIN (ANALYZE, BUFFERS) nas consultas de
+CONSULTAS_PREPARADAS e nas buscas internas das funções de lançamento. Mostra o tempo de execução e os tipos de scan: o esperado é
+que nenhuma tabela grande (Alunos, Historico_Academico, Historico_Exibicao) apareça com 'Seq Scan'.
+Disciplinas tem poucas linhas e o planner pode preferir lê-la inteira, o que é normal.
+
+Requer DATABASE_URL apontando para um banco descartável.
+Uso: python benchmarks/indices.py --tamanhos 1000,10000,50000
+"""
+import argparse
+import json
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import app  # noqa: E402
+
+TABELAS_GRANDES = {'alunos', 'historico_academico', 'historico_exibicao'}
+
+SQL_SEED_ALUNOS = """
+INSERT INTO Alunos (RA, Nome_Completo, Tipo_Usuario, Codigo_Seguranca, Senha)
+SELECT 'B' || lpad(g::TEXT, 7, '0'), 'Aluno Sintético ' || g, 'Aluno', NULL, '123456'
+FROM generate_series(1, %(total)s) g
+ON CONFLICT (RA) DO NOTHING
+RETURNING id_aluno;
+"""
+
+SQL_SEED_HISTORICO = """
+INSERT INTO Historico_Academico (fk_id_aluno, fk_id_disciplina, NP1, NP2, Media_Final, Faltas)
+SELECT A.id_aluno, D.id_disciplina,
+    CASE WHEN D.Tipo_Avaliacao = 'PIM' THEN NULL ELSE round((random() * 10)::NUMERIC, 2) END,
+    CASE WHEN D.Tipo_Avaliacao = 'PIM' THEN NULL ELSE round((random() * 10)::NUMERIC, 2) END,
+    CASE WHEN D.Tipo_Avaliacao = 'PIM' THEN round((random() * 10)::NUMERIC, 2) ELSE NULL END,
+    (random() * 20)::INT
+FROM Alunos A
+CROSS JOIN Disciplinas D
+WHERE A.id_aluno = ANY(%(ids)s)
+ON CONFLICT (fk_id_aluno, fk_id_disciplina) DO NOTHING;
+"""
+
+# Buscas feitas dentro das funções fn_lancar_* (migração 11), que EXPLAIN EXECUTE não detalha:
+# matrícula por id_aluno (token/cache) ou por RA, e a nota PIM por semestre (filtro por Semestre e Tipo_Avaliacao)
+CONSULTAS_INTERNAS = {
+    'matricula_por_id': """
+        SELECT * FROM fn_localizar_matricula(NULL, %(id_aluno)s, 'Estruturas de Dados')
+    """,
+    'matricula_por_ra': """
+        SELECT * FROM fn_localizar_matricula(%(ra)s, NULL, 'Estruturas de Dados')
+    """,
+    'pim_por_semestre': """
+        SELECT H.Media_Final FROM Historico_Academico H
+        JOIN Disciplinas D ON H.fk_id_disciplina = D.id_disciplina
+        WHERE H.fk_id_aluno = %(id_aluno)s AND D.Semestre = 2 AND D.Tipo_Avaliacao = 'PIM'
+    """,
+    'todas_pim_do_aluno': """
+        SELECT D.Semestre, H.Media_Final FROM Historico_Academico H
+        JOIN Disciplinas D ON H.fk_id_disciplina = D.id_disciplina
+        WHERE H.fk_id_aluno = %(id_aluno)s AND D.Tipo_Avaliacao = 'PIM'
+    """,
+}
+
+
+def _popular(cursor, total):
+    cursor.execute(SQL_SEED_ALUNOS, {"total": total})
+    novos = [r[0] for r in cursor.fetchall()]
+    if novos:
+        cursor.execute(SQL_SEED_HISTORICO, {"ids": novos})
+        app._atualizar_historico_exibicao(cursor, novos)
+    cursor.execute("ANALYZE Alunos; ANALYZE Historico_Academico; ANALYZE Historico_Exibicao;")
+    return len(novos)
+
+
+def _nos_do_plano(plano):
+    yield plano
+    for filho in plano.get('Plans', []):
+        yield from _nos_do_plano(filho)
+
+
+def _explicar(cursor, sql, params):
+    cursor.execute(f"EXPLAIN (ANALYZE, BUFFERS, FORMAT JSON) {sql}", params)
+    resultado = cursor.fetchone()[0]
+    resultado = resultado[0] if isinstance(resultado, list) else json.loads(resultado)[0]
+    scans = sorted({
+        f"{n['Node Type']}({n['Relation Name']})"
+        for n in _nos_do_plano(resultado['Plan']) if 'Relation Name' in n
+    })
+    seq_grandes = [s for s in scans if s.startswith('Seq Scan') and s[9:-1].lower() in TABELAS_GRANDES]
+    return resultado['Execution Time'], scans, seq_grandes
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--tamanhos', default='1000,10000,50000', help="Números de alunos sintéticos, em ordem crescente")
+    args = parser.parse_args()
+
+    if not os.environ.get('DATABASE_URL'):
+        sys.exit("Defina DATABASE_URL (banco descartável) para rodar o benchmark.")
+
+    app.aplicar_migracoes()
+    conn, cursor = app.get_db_connection()
+    # O EXPLAIN precisa de tuplas simples, não do RealDictCursor
+    cursor = conn.cursor()
+    try:
+        for total in [int(t) for t in args.tamanhos.split(',')]:
+            novos = _popular(cursor, total)
+            conn.commit()
+
+            ra_amostra = f"B{total // 2:07d}"
+            cursor.execute("SELECT id_aluno FROM Alunos WHERE RA = %s", (ra_amostra,))
+            id_amostra = cursor.fetchone()[0]
+            print(f"\n=== {total} alunos sintéticos ({novos} novos) | amostra {ra_amostra} ===")
+
+            casos = {
+                'historico_exibicao_por_ra': (ra_amostra,),
+                'historico_exibicao_por_id': (id_amostra,),
+                'login_aluno': (ra_amostra, '123456'),
+            }
+            for nome, params in casos.items():
+                app.executar_preparada(cursor, nome, params)
+                cursor.fetchall()
+                marcadores = ", ".join(["%s"] * len(params))
+                tempo, scans, seq = _explicar(cursor, f"EXECUTE {nome} ({marcadores})", params)
+                alerta = f"  ⚠️ SEQ SCAN: {seq}" if seq else ""
+                print(f"{nome:>28}: {tempo:8.3f} ms | {', '.join(scans)}{alerta}")
+
+            for nome, sql in CONSULTAS_INTERNAS.items():
+                tempo, scans, seq = _explicar(cursor, sql, {"id_aluno": id_amostra, "ra": ra_amostra})
+                alerta = f"  ⚠️ SEQ SCAN: {seq}" if seq else ""
+                print(f"{nome:>28}: {tempo:8.3f} ms | {', '.join(scans)}{alerta}")
+            conn.rollback()
+    finally:
+        conn.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,372 @@
+"""
+Suíte de benchmarks do Joker: HTTP (/login e /web_router) e chamadas diretas às funções *_api.
+
+Roda contra um Postgres descartável — DATABASE_URL ou, com --cluster-temporario, um cluster criado com
+initdb em um diretório temporário (sem container) e removido no fim — populado com --alunos alunos
+sintéticos (RA 'B0000001', ...) e --disciplinas disciplinas extras. O Gemini é trocado por um stub
+determinístico com latência configurável (--latencia), então os números medem o app e o banco.
+
+Cada cenário roda em cada nível de --concorrencias e reporta req/s, p50/p95/p99 e erros. Os resultados
+são salvos em JSON (benchmarks/resultados/) e comparados com a execução anterior salva.
+
+Uso: python benchmarks/suite.py --cluster-temporario --alunos 5000 --concorrencias 1,8,32
+     python benchmarks/suite.py --cenarios historico,api_historico --comparar benchmarks/resultados/base.json
+"""
+import argparse
+import atexit
+import glob
+import hashlib
+import json
+import logging
+import math
+import os
+import random
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.error
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+from types import SimpleNamespace
+
+RAIZ = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+DIR_RESULTADOS = os.path.join(RAIZ, 'benchmarks', 'resultados')
+sys.path.insert(0, RAIZ)
+sys.path.insert(0, os.path.join(RAIZ, 'benchmarks'))
+
+# 'app' e 'indices' leem DATABASE_URL na importação: são importados depois de preparar o banco
+app = None
+
+SQL_SEED_DISCIPLINAS = """
+INSERT INTO Disciplinas (Nome_Disciplina, Semestre, Tipo_Avaliacao)
+SELECT 'Disciplina Sintetica ' || lpad(g::TEXT, 3, '0'), 1 + g %% 2, 'TEORICA'
+FROM generate_series(1, %(total)s) g
+ON CONFLICT (Nome_Disciplina, Semestre) DO NOTHING;
+"""
+
+TOPICOS = ['Estruturas de Dados', 'Banco de Dados I', 'Sistemas Operacionais', 'Álgebra Linear', 'Lógica de Programação']
+
+
+# --- GEMINI SIMULADO ---
+
+class _StubModels:
+    """
+    Substitui 'client.models'. Responde após 'latencia' segundos com texto derivado do hash do prompt
+    (mesma entrada, mesma saída) e sem function calling: os cenários de ferramentas passam pelo fast-path.
+    """
+
+    def __init__(self, latencia):
+        self.latencia = latencia
+
+    @staticmethod
+    def _texto(contents):
+        semente = hashlib.sha1(repr(contents).encode()).hexdigest()[:8]
+        return f"Take your time. Resumo determinístico #{semente}.\n\n" + "Conceito. " * 200
+
+    @staticmethod
+    def _uso(contents, cached_content=None):
+        entrada = len(repr(contents)) // 4
+        return SimpleNamespace(prompt_token_count=entrada + (400 if cached_content else 0),
+                               cached_content_token_count=400 if cached_content else 0)
+
+    def generate_content(self, model, contents, config=None):
+        time.sleep(self.latencia)
+        cache = getattr(config, 'cached_content', None) if config else None
+        return SimpleNamespace(function_calls=None, text=self._texto(contents), usage_metadata=self._uso(contents, cache))
+
+    def generate_content_stream(self, model, contents, config=None):
+        texto = self._texto(contents)
+        pedacos = 8
+        tamanho = len(texto) // pedacos + 1
+        for i in range(pedacos):
+            time.sleep(self.latencia / pedacos)
+            yield SimpleNamespace(text=texto[i * tamanho:(i + 1) * tamanho])
+
+
+class _StubCaches:
+    def create(self, model, config):
+        return SimpleNamespace(name=f"cachedContents/stub-{config.display_name}")
+
+
+def instalar_gemini_simulado(latencia):
+    app.client = SimpleNamespace(models=_StubModels(latencia), caches=_StubCaches())
+
+
+# --- BANCO DESCARTÁVEL ---
+
+def _binario_postgres(nome):
+    caminho = shutil.which(nome)
+    if caminho:
+        return caminho
+    try:
+        bindir = subprocess.run(['pg_config', '--bindir'], capture_output=True, text=True, check=True).stdout.strip()
+        candidatos = [os.path.join(bindir, nome)]
+    except (OSError, subprocess.CalledProcessError):
+        candidatos = sorted(glob.glob(f'/usr/lib/postgresql/*/bin/{nome}'), reverse=True)
+    return next((c for c in candidatos if os.path.exists(c)), None)
+
+
+def iniciar_cluster_temporario():
+    """Cria e sobe um cluster Postgres em um diretório temporário; retorna a DSN (socket Unix local)."""
+    initdb, pg_ctl = _binario_postgres('initdb'), _binario_postgres('pg_ctl')
+    if not (initdb and pg_ctl):
+        sys.exit("initdb/pg_ctl não encontrados: instale o PostgreSQL ou use DATABASE_URL.")
+
+    diretorio = tempfile.mkdtemp(prefix='joker-bench-pg-')
+    dados = os.path.join(diretorio, 'dados')
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        porta = s.getsockname()[1]
+
+    subprocess.run([initdb, '-D', dados, '-U', 'postgres', '--auth=trust', '-E', 'UTF8'], check=True, capture_output=True)
+    subprocess.run([
+        pg_ctl, '-D', dados, '-l', os.path.join(diretorio, 'postgres.log'), '-w',
+        '-o', f"-p {porta} -k {diretorio} -c listen_addresses='' -c max_connections=200 -c fsync=off",
+        'start'
+    ], check=True, capture_output=True)
+
+    def parar():
+        subprocess.run([pg_ctl, '-D', dados, '-m', 'immediate', 'stop'], capture_output=True)
+        shutil.rmtree(diretorio, ignore_errors=True)
+
+    atexit.register(parar)
+    return f"host={diretorio} port={porta} user=postgres dbname=postgres"
+
+
+def popular_banco(alunos, disciplinas):
+    import indices
+
+    app.aplicar_migracoes()
+    conn, _ = app.get_db_connection()
+    cursor = conn.cursor()
+    try:
+        if disciplinas:
+            cursor.execute(SQL_SEED_DISCIPLINAS, {"total": disciplinas})
+            # Disciplinas novas também entram no histórico dos alunos já existentes
+            cursor.execute("SELECT id_aluno FROM Alunos")
+            todos = [r[0] for r in cursor.fetchall()]
+            cursor.execute(indices.SQL_SEED_HISTORICO, {"ids": todos})
+            app._atualizar_historico_exibicao(cursor, todos)
+        novos = indices._popular(cursor, alunos)
+        conn.commit()
+    finally:
+        conn.close()
+    return novos
+
+
+# --- CENÁRIOS ---
+
+def _ra_aleatorio(total_alunos):
+    return f"B{random.randint(1, total_alunos):07d}"
+
+
+def _token(tipo):
+    """Token de sessão como o /login emitiria (o servidor roda neste processo, com o mesmo segredo)."""
+    ra = 'P12345' if tipo == 'professor' else 'R818888'
+    return app.emitir_token_sessao(None, ra, f"Benchmark {tipo}", tipo, f"benchmark-{tipo}")
+
+
+def _payload_router(mensagem, tipo='professor'):
+    return '/web_router', {"message": mensagem, "token": _token(tipo)}
+
+
+# Cenários HTTP: função (i, total_alunos) -> (rota, corpo JSON)
+CENARIOS_HTTP = {
+    'login': lambda i, n: ('/login', {"tipo_usuario": "aluno", "ra": _ra_aleatorio(n), "senha": "123456"}),
+    'historico': lambda i, n: _payload_router(f"mostrar o histórico do aluno {_ra_aleatorio(n)}"),
+    'material': lambda i, n: _payload_router(f"me explica sobre {TOPICOS[i % len(TOPICOS)]}", 'aluno'),
+    'lancar_nota_np': lambda i, n: _payload_router(
+        f"lançar NP1 do {_ra_aleatorio(n)} em Estruturas de Dados com {random.randint(0, 10)}"),
+    'lancar_nota_pim': lambda i, n: _payload_router(f"lançar PIM II do {_ra_aleatorio(n)} com {random.randint(0, 10)}"),
+    'lancar_faltas': lambda i, n: _payload_router(
+        f"lançar {random.randint(0, 20)} faltas do {_ra_aleatorio(n)} em Sistemas Operacionais"),
+    'estatisticas': lambda i, n: _payload_router(f"estatísticas da turma no {1 + i % 2}º semestre"),
+    'conversa': lambda i, n: _payload_router("oi Joker, qual é o plano de hoje?", 'aluno'),
+}
+
+# Cenários das funções *_api chamadas diretamente (sem Flask): função (i, total_alunos) -> resultado
+CENARIOS_API = {
+    'api_historico': lambda i, n: app.verificar_dados_curso_api(_ra_aleatorio(n)),
+    'api_material': lambda i, n: app.buscar_material_estudo_api(TOPICOS[i % len(TOPICOS)]),
+    'api_lancar_nota_np': lambda i, n: app.lancar_nota_np_api(_ra_aleatorio(n), 'Banco de Dados I', 'NP2', random.randint(0, 10)),
+    'api_lancar_nota_pim': lambda i, n: app.lancar_nota_pim_api(_ra_aleatorio(n), 'PIM I', random.randint(0, 10)),
+    'api_lancar_faltas': lambda i, n: app.lancar_faltas_api(_ra_aleatorio(n), 'Álgebra Linear', random.randint(0, 20)),
+    'api_estatisticas': lambda i, n: app.estatisticas_turma_api(1 + i % 2),
+}
+
+
+def _percentil(ordenadas, p):
+    """Percentil pelo método nearest-rank."""
+    if not ordenadas:
+        return 0.0
+    return ordenadas[max(math.ceil(p / 100 * len(ordenadas)) - 1, 0)]
+
+
+def _rodar(executar, total, concorrencia):
+    def medir(i):
+        inicio = time.perf_counter()
+        try:
+            ok = executar(i)
+        except Exception:
+            ok = False
+        return time.perf_counter() - inicio, ok
+
+    inicio = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concorrencia) as pool:
+        resultados = list(pool.map(medir, range(total)))
+    duracao = time.perf_counter() - inicio
+    latencias = sorted(r[0] for r in resultados)
+    return {
+        "concorrencia": concorrencia,
+        "requisicoes": total,
+        "erros": sum(1 for r in resultados if not r[1]),
+        "req_s": total / duracao,
+        "p50_ms": _percentil(latencias, 50) * 1000,
+        "p95_ms": _percentil(latencias, 95) * 1000,
+        "p99_ms": _percentil(latencias, 99) * 1000,
+    }
+
+
+def _executor_http(base_url, gerar, total_alunos):
+    def executar(i):
+        rota, corpo = gerar(i, total_alunos)
+        req = urllib.request.Request(
+            base_url + rota, data=json.dumps(corpo).encode(), headers={'Content-Type': 'application/json'}
+        )
+        try:
+            with urllib.request.urlopen(req, timeout=600) as resp:
+                resposta = json.loads(resp.read())
+        except urllib.error.HTTPError:
+            return False
+        # O /web_router devolve 200 mesmo quando a ferramenta falha; o Joker sinaliza com "Oops"/"❌"
+        mensagem = resposta.get('message', '')
+        return not (mensagem.startswith('Joker: Oops') or mensagem.startswith('❌'))
+    return executar
+
+
+def _executor_api(gerar, total_alunos):
+    def executar(i):
+        return gerar(i, total_alunos).get('status') == 'success'
+    return executar
+
+
+# --- RELATÓRIO E HISTÓRICO ---
+
+def _commit_atual():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=RAIZ, capture_output=True, text=True).stdout.strip()
+    except OSError:
+        return None
+
+
+def _ultimo_resultado():
+    arquivos = sorted(glob.glob(os.path.join(DIR_RESULTADOS, '*.json')))
+    return arquivos[-1] if arquivos else None
+
+
+def _imprimir(resultados, anterior):
+    referencia = {}
+    if anterior:
+        for r in anterior['resultados']:
+            referencia[(r['cenario'], r['concorrencia'])] = r
+        print(f"\nComparando com {anterior['arquivo']} (commit {anterior.get('commit')})")
+
+    print(f"\n{'cenário':>20} {'conc':>5} {'req/s':>9} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9} {'erros':>6}")
+    for r in resultados:
+        linha = (f"{r['cenario']:>20} {r['concorrencia']:>5} {r['req_s']:9.1f} {r['p50_ms']:9.1f} "
+                 f"{r['p95_ms']:9.1f} {r['p99_ms']:9.1f} {r['erros']:>6}")
+        base = referencia.get((r['cenario'], r['concorrencia']))
+        if base and base['req_s'] and base['p95_ms']:
+            linha += (f"   Δ req/s {100 * (r['req_s'] / base['req_s'] - 1):+6.1f}%"
+                      f" | Δ p95 {100 * (r['p95_ms'] / base['p95_ms'] - 1):+6.1f}%")
+        print(linha)
+
+
+def main():
+    global app
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--cluster-temporario', action='store_true', help="Cria um Postgres temporário com initdb (ignora DATABASE_URL)")
+    parser.add_argument('--alunos', type=int, default=1000, help="Alunos sintéticos no banco")
+    parser.add_argument('--disciplinas', type=int, default=0, help="Disciplinas sintéticas extras")
+    parser.add_argument('--concorrencias', default='1,8,32', help="Níveis de concorrência, separados por vírgula")
+    parser.add_argument('--requisicoes', type=int, default=200, help="Requisições por cenário e nível")
+    parser.add_argument('--latencia', type=float, default=0.3, help="Latência simulada do Gemini (s)")
+    parser.add_argument('--cenarios', default=','.join([*CENARIOS_HTTP, *CENARIOS_API]))
+    parser.add_argument('--semente', type=int, default=42, help="Semente dos RAs/notas sorteados")
+    parser.add_argument('--comparar', help="Arquivo de resultados para comparação (padrão: o último salvo)")
+    parser.add_argument('--nao-salvar', action='store_true')
+    args = parser.parse_args()
+
+    if args.cluster_temporario:
+        os.environ['DATABASE_URL'] = iniciar_cluster_temporario()
+    elif not os.environ.get('DATABASE_URL'):
+        sys.exit("Defina DATABASE_URL (banco descartável) ou use --cluster-temporario.")
+    os.environ.setdefault('DB_POOL_MAX', str(max(int(c) for c in args.concorrencias.split(',')) + 4))
+    # Todas as requisições saem de 127.0.0.1: sem isto o limite por usuário do gateway descartaria a carga
+    os.environ.setdefault('GEMINI_RPS_USUARIO', '1e9')
+    os.environ.setdefault('GEMINI_BURST_USUARIO', '1000000')
+    os.environ.setdefault('GEMINI_RPS_GLOBAL', '1e9')
+    os.environ.setdefault('GEMINI_BURST_GLOBAL', '1000000')
+    # Os cenários de material medem a geração em si, não só o enfileiramento na fila de jobs
+    os.environ.setdefault('MATERIAL_FILA', '0')
+
+    import app as modulo_app
+    app = modulo_app
+    random.seed(args.semente)
+    logging.getLogger('werkzeug').setLevel(logging.ERROR)
+
+    novos = popular_banco(args.alunos, args.disciplinas)
+    print(f"Banco pronto: {args.alunos} alunos sintéticos ({novos} novos), {args.disciplinas} disciplinas extras.")
+    instalar_gemini_simulado(args.latencia)
+    app.iniciar_tarefas_de_fundo()
+
+    from werkzeug.serving import make_server
+    servidor = make_server('127.0.0.1', 0, app.app, threaded=True)
+    threading.Thread(target=servidor.serve_forever, daemon=True).start()
+    base_url = f"http://127.0.0.1:{servidor.server_port}"
+
+    anterior_arquivo = args.comparar or _ultimo_resultado()
+    anterior = None
+    if anterior_arquivo and os.path.exists(anterior_arquivo):
+        with open(anterior_arquivo, encoding='utf-8') as f:
+            anterior = json.load(f)
+        anterior['arquivo'] = anterior_arquivo
+
+    resultados = []
+    try:
+        for cenario in [c.strip() for c in args.cenarios.split(',') if c.strip()]:
+            if cenario in CENARIOS_HTTP:
+                executar = _executor_http(base_url, CENARIOS_HTTP[cenario], args.alunos)
+            elif cenario in CENARIOS_API:
+                executar = _executor_api(CENARIOS_API[cenario], args.alunos)
+            else:
+                sys.exit(f"Cenário desconhecido: {cenario}")
+            for concorrencia in [int(c) for c in args.concorrencias.split(',')]:
+                r = _rodar(executar, args.requisicoes, concorrencia)
+                r["cenario"] = cenario
+                resultados.append(r)
+                print(f"  {cenario} @ {concorrencia}: {r['req_s']:.1f} req/s, p95 {r['p95_ms']:.1f} ms")
+    finally:
+        servidor.shutdown()
+
+    _imprimir(resultados, anterior)
+
+    if not args.nao_salvar:
+        os.makedirs(DIR_RESULTADOS, exist_ok=True)
+        arquivo = os.path.join(DIR_RESULTADOS, time.strftime('%Y%m%d-%H%M%S') + '.json')
+        with open(arquivo, 'w', encoding='utf-8') as f:
+            json.dump({
+                "commit": _commit_atual(),
+                "data": time.strftime('%Y-%m-%dT%H:%M:%S'),
+                "parametros": vars(args),
+                "resultados": resultados,
+            }, f, ensure_ascii=False, indent=2)
+        print(f"\nResultados salvos em {os.path.relpath(arquivo, RAIZ)}")
+
+
+if __name__ == '__main__':
+    main()
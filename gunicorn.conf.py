@@ -0,0 +1,28 @@
+import os
+
+# --- CONFIGURAÇÃO DO GUNICORN ---
+# Worker 'gthread': cada worker atende várias conversas ao mesmo tempo em threads.
+# As chamadas ao Gemini e ao PostgreSQL são I/O (liberam o GIL), então uma conversa lenta
+# não trava as demais, como acontecia com o worker síncrono de thread única.
+workers = int(os.environ.get('WEB_CONCURRENCY', 1))
+worker_class = 'gthread'
+threads = int(os.environ.get('GUNICORN_THREADS', 64))
+timeout = int(os.environ.get('GUNICORN_TIMEOUT', 240))
+# Conexões keep-alive ficam ociosas sem ocupar uma thread
+keepalive = 5
+
+
+def on_starting(server):
+    """
+    Aplica as migrações do banco e versiona os estáticos UMA vez, no processo mestre, antes de criar
+    os workers (que herdam os arquivos já comprimidos/convertidos em memória).
+    """
+    import app
+    app.aplicar_migracoes()
+    app.assets.carregar()
+
+
+def post_worker_init(worker):
+    """Inicia as tarefas de segundo plano (listener do cache, pré-aquecimento) em cada worker."""
+    import app
+    app.iniciar_tarefas_de_fundo()
@@ -0,0 +1,91 @@
+"""
+Teste de carga do /web_router com um Gemini simulado (stub).
+
+Sobe o app em um servidor WSGI local duas vezes (thread única x multi-thread) e dispara
+N conversas simultâneas. O stub apenas dorme pela latência configurada, então o ganho
+medido é exatamente o de atender várias conversas em paralelo no mesmo processo.
+
+Uso: python loadtest.py --requests 100 --concurrency 50 --latency 0.5
+"""
+import argparse
+import json
+import logging
+import os
+import threading
+import time
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+from types import SimpleNamespace
+
+from werkzeug.serving import make_server
+
+# O teste mede o paralelismo do servidor, não os limites de taxa do gateway do Gemini
+os.environ.setdefault('GEMINI_RPS_USUARIO', '1e9')
+os.environ.setdefault('GEMINI_BURST_USUARIO', '1000000')
+os.environ.setdefault('GEMINI_RPS_GLOBAL', '1e9')
+os.environ.setdefault('GEMINI_BURST_GLOBAL', '1000000')
+
+import app as joker_app  # noqa: E402
+
+
+class _StubModels:
+    """Substitui 'client.models': responde direto (sem function calling) após 'latency' segundos."""
+
+    def __init__(self, latency):
+        self.latency = latency
+
+    def generate_content(self, model, contents, config=None):
+        time.sleep(self.latency)
+        return SimpleNamespace(function_calls=None, text="Take your time. - Joker")
+
+
+def _rodar_cenario(threaded, total, concorrencia, latencia):
+    joker_app.client = SimpleNamespace(models=_StubModels(latencia))
+    # O cenário não usa o banco: a resposta do stub não chama nenhuma ferramenta
+
+    server = make_server('127.0.0.1', 0, joker_app.app, threaded=threaded)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    url = f"http://127.0.0.1:{server.server_port}/web_router"
+
+    # Token emitido pelo próprio app, como no /login (o /web_router não consulta o banco para verificá-lo)
+    token = joker_app.emitir_token_sessao(None, 'R818888', 'Aluno Carga', 'aluno', 'loadtest')
+
+    def enviar(i):
+        # Mensagens distintas: o single-flight do gateway não pode juntar as chamadas ao stub
+        corpo = json.dumps({"message": f"oi {i}", "token": token}).encode()
+        inicio = time.perf_counter()
+        req = urllib.request.Request(url, data=corpo, headers={'Content-Type': 'application/json'})
+        with urllib.request.urlopen(req, timeout=600) as resp:
+            resp.read()
+        return time.perf_counter() - inicio
+
+    inicio = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concorrencia) as pool:
+        latencias = sorted(pool.map(enviar, range(total)))
+    duracao = time.perf_counter() - inicio
+    server.shutdown()
+
+    return {
+        "modo": "multi-thread" if threaded else "thread única",
+        "req_s": total / duracao,
+        "p50_s": latencias[len(latencias) // 2],
+        "p95_s": latencias[int(len(latencias) * 0.95) - 1],
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--requests', type=int, default=40)
+    parser.add_argument('--concurrency', type=int, default=20)
+    parser.add_argument('--latency', type=float, default=0.5, help="Latência simulada do Gemini (s)")
+    args = parser.parse_args()
+    logging.getLogger('werkzeug').setLevel(logging.ERROR)
+
+    for threaded in (False, True):
+        r = _rodar_cenario(threaded, args.requests, args.concurrency, args.latency)
+        print(f"{r['modo']:>13}: {r['req_s']:7.1f} req/s | p50 {r['p50_s']:.2f}s | p95 {r['p95_s']:.2f}s")
+
+
+if __name__ == '__main__':
+    main()
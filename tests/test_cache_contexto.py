@@ -0,0 +1,72 @@
+"""Cache de contexto do Gemini: a criação lenta de um perfil não segura as demais requisições."""
+import threading
+import time
+
+import pytest
+
+import app
+
+
+class _CachesLentos:
+    def __init__(self):
+        self.liberar = threading.Event()
+        self.chamadas = []
+
+    def create(self, model, config):
+        self.chamadas.append(config)
+        assert self.liberar.wait(5)
+        return type('Cache', (), {'name': f"cachedContents/{len(self.chamadas)}"})()
+
+
+@pytest.fixture
+def caches(monkeypatch):
+    caches = _CachesLentos()
+    monkeypatch.setattr(app, 'client', type('Cliente', (), {'caches': caches})())
+    monkeypatch.setattr(app, 'GEMINI_CONTEXT_CACHE', True)
+    return caches
+
+
+def _em_segundo_plano(funcao, *args):
+    resultado = {}
+    thread = threading.Thread(target=lambda: resultado.setdefault('valor', funcao(*args)))
+    thread.start()
+    return thread, resultado
+
+
+def _esperar_chamadas(caches, quantidade):
+    limite = time.monotonic() + 5
+    while len(caches.chamadas) < quantidade and time.monotonic() < limite:
+        time.sleep(0.01)
+
+
+def test_criacao_em_andamento_nao_bloqueia_outras_requisicoes(caches):
+    cache = app.CacheContextoGemini('modelo', ttl=3600, espera_apos_falha=600, timeout=7)
+    thread, resultado = _em_segundo_plano(cache.obter, 'ALUNO')
+    _esperar_chamadas(caches, 1)
+
+    # Sem esperar pela API: segue sem cache nesta requisição
+    inicio = time.monotonic()
+    assert cache.obter('ALUNO') is None
+    assert time.monotonic() - inicio < 1
+    assert len(caches.chamadas) == 1
+
+    caches.liberar.set()
+    thread.join()
+    assert resultado['valor'] == 'cachedContents/1'
+    assert cache.obter('ALUNO') == 'cachedContents/1'
+    assert caches.chamadas[0].http_options.timeout == 7000
+
+
+def test_renovacao_em_andamento_continua_servindo_o_cache_vigente(caches, monkeypatch):
+    cache = app.CacheContextoGemini('modelo', ttl=3600, espera_apos_falha=600, timeout=7)
+    # Cache ainda válido, mas dentro da margem de renovação
+    cache._caches['ALUNO'] = ('cachedContents/antigo', time.monotonic() + 30)
+    thread, resultado = _em_segundo_plano(cache.obter, 'ALUNO')
+    _esperar_chamadas(caches, 1)
+
+    assert cache.obter('ALUNO') == 'cachedContents/antigo'
+    assert len(caches.chamadas) == 1
+
+    caches.liberar.set()
+    thread.join()
+    assert cache.obter('ALUNO') == 'cachedContents/1'
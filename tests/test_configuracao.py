@@ -0,0 +1,39 @@
+"""
+Validação da configuração no boot: valores que deixariam o gateway do Gemini sem tentativas ou sem
+modelos devem impedir o app.py de subir, com uma mensagem que aponte a variável de ambiente.
+"""
+import os
+import subprocess
+import sys
+
+import pytest
+
+RAIZ = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def _importar_app(**variaveis):
+    ambiente = dict(os.environ, **variaveis)
+    return subprocess.run([sys.executable, '-c', 'import app'], cwd=RAIZ, env=ambiente,
+                          capture_output=True, text=True, timeout=120)
+
+
+@pytest.mark.parametrize('valor', ['0', '-1'])
+def test_gemini_max_tentativas_menor_que_um_falha_no_boot(valor):
+    resultado = _importar_app(GEMINI_MAX_TENTATIVAS=valor)
+    assert resultado.returncode != 0
+    assert 'GEMINI_MAX_TENTATIVAS' in resultado.stderr
+
+
+@pytest.mark.parametrize('valor', ['0', '-1'])
+def test_twilio_max_tentativas_menor_que_um_falha_no_boot(valor):
+    resultado = _importar_app(TWILIO_MAX_TENTATIVAS=valor)
+    assert resultado.returncode != 0
+    assert 'TWILIO_MAX_TENTATIVAS' in resultado.stderr
+
+
+@pytest.mark.parametrize('variavel', ['GEMINI_MODELOS_ROTEAMENTO', 'GEMINI_MODELOS_FORMATACAO', 'GEMINI_MODELOS_MATERIAL'])
+@pytest.mark.parametrize('valor', ['', ' , '])
+def test_lista_de_modelos_vazia_falha_no_boot(variavel, valor):
+    resultado = _importar_app(**{variavel: valor})
+    assert resultado.returncode != 0
+    assert variavel in resultado.stderr
@@ -0,0 +1,33 @@
+import app
+
+
+def _cache():
+    cache = app.HistoricoCache(ttl=60, max_itens=10)
+    cache.listener_ativo = True
+    return cache
+
+
+def test_set_sem_invalidacao_no_meio_fica_no_cache():
+    cache = _cache()
+    geracao = cache.geracao()
+    cache.set('R123', {"status": "success"}, geracao)
+    assert cache.get('R123') == {"status": "success"}
+
+
+def test_invalidacao_durante_a_leitura_descarta_o_resultado():
+    cache = _cache()
+    geracao = cache.geracao()
+    # NOTIFY chega enquanto a consulta ao banco ainda está em andamento
+    cache.invalidar('R123')
+    cache.set('R123', {"status": "success", "historico": "antigo"}, geracao)
+
+    assert cache.get('R123') is None
+    assert cache.stats()["descartados"] == 1
+
+
+def test_invalidacao_geral_tambem_descarta():
+    cache = _cache()
+    geracao = cache.geracao()
+    cache.invalidar('*')
+    cache.set('R999', {"status": "success"}, geracao)
+    assert cache.get('R999') is None
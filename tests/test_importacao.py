@@ -0,0 +1,165 @@
+"""
+Importação em lote. Os testes marcados com 'requer_banco' usam o PostgreSQL de DATABASE_URL (com as
+migrações aplicadas); os dados criados neles usam um sufixo aleatório e são removidos ao final.
+"""
+import csv
+import io
+import os
+import uuid
+
+import pytest
+
+import app
+
+requer_banco = pytest.mark.skipif(not os.environ.get('DATABASE_URL'), reason="DATABASE_URL não configurada")
+
+
+class _ConexaoFalsa:
+    def __init__(self):
+        self.fechada = False
+
+    def cursor(self, *args, **kwargs):
+        return _CursorFalso()
+
+    def close(self):
+        self.fechada = True
+
+
+class _CursorFalso:
+    def execute(self, *args):
+        pass
+
+    def fetchall(self):
+        return []
+
+
+@pytest.fixture
+def conexoes(monkeypatch):
+    abertas = []
+
+    def get_db_connection():
+        conn = _ConexaoFalsa()
+        abertas.append(conn)
+        return conn, conn.cursor()
+
+    monkeypatch.setattr(app, 'get_db_connection', get_db_connection)
+    return abertas
+
+
+@pytest.mark.parametrize("erro", [
+    UnicodeDecodeError('utf-8', b'\xff', 0, 1, 'invalid start byte'),
+    csv.Error('field larger than field limit'),
+])
+def test_erro_ao_ler_as_linhas_devolve_a_conexao(conexoes, erro):
+    def linhas():
+        yield {"ra": "R1", "disciplina": "Redes", "np1": "8"}
+        raise erro
+
+    with pytest.raises(type(erro)):
+        app.importar_notas_lote_api(linhas())
+    assert [c.fechada for c in conexoes] == [True]
+
+
+@pytest.fixture
+def limite_de_campo():
+    anterior = csv.field_size_limit(20)
+    yield
+    csv.field_size_limit(anterior)
+
+
+@pytest.mark.parametrize("conteudo, mensagem", [
+    # Latin-1 no meio do arquivo e logo no cabeçalho
+    (b"ra;disciplina;np1\nR1;Reda\xe7\xe3o;8\n", "UTF-8"),
+    (b"\xff\xfera,disciplina\n", "UTF-8"),
+    # Campo maior que csv.field_size_limit
+    (b"ra,disciplina,np1\nR1," + b"x" * 50 + b",8\n", "CSV"),
+])
+def test_upload_ilegivel_responde_400(conexoes, monkeypatch, limite_de_campo, conteudo, mensagem):
+    monkeypatch.setattr(app, '_autenticar_professor', lambda *args: True)
+
+    resposta = app.app.test_client().post('/importar_notas', data={
+        "funcional": "P1", "senha": "x", "codigo_seguranca": "1",
+        "arquivo": (io.BytesIO(conteudo), 'notas.csv'),
+    }, content_type='multipart/form-data')
+
+    assert resposta.status_code == 400
+    assert mensagem in resposta.get_json()["message"]
+    assert conexoes and all(c.fechada for c in conexoes)
+
+
+@pytest.fixture
+def turma(monkeypatch):
+    """Um aluno matriculado em 'Redes' e no PIM do semestre, mas sem registro em 'Banco de Dados'."""
+    monkeypatch.setattr(app, 'agendar_atualizacao_resumo_desempenho', lambda: None)
+    sufixo = uuid.uuid4().hex[:8]
+    ra = f"T{sufixo}".upper()
+    nomes = {"redes": f"Redes {sufixo}", "bd": f"Banco de Dados {sufixo}", "pim": f"PIM {sufixo}"}
+
+    conn, cursor = app.get_db_connection()
+    cursor.execute("INSERT INTO Alunos (RA, Nome_Completo, Senha) VALUES (%s, 'Importação', 'x') RETURNING id_aluno", (ra,))
+    id_aluno = cursor.fetchone()['id_aluno']
+    ids = {}
+    for chave, tipo in (("redes", 'TEORICA'), ("bd", 'TEORICA'), ("pim", 'PIM')):
+        cursor.execute(
+            "INSERT INTO Disciplinas (Nome_Disciplina, Semestre, Tipo_Avaliacao) VALUES (%s, 9101, %s) RETURNING id_disciplina",
+            (nomes[chave], tipo),
+        )
+        ids[chave] = cursor.fetchone()['id_disciplina']
+    for chave in ("redes", "pim"):
+        cursor.execute("INSERT INTO Historico_Academico (fk_id_aluno, fk_id_disciplina) VALUES (%s, %s)", (id_aluno, ids[chave]))
+    conn.commit()
+    conn.close()
+
+    yield {"ra": ra, "id_aluno": id_aluno, "nomes": nomes}
+
+    conn, cursor = app.get_db_connection()
+    cursor.execute("DELETE FROM Historico_Exibicao WHERE fk_id_aluno = %s", (id_aluno,))
+    cursor.execute("DELETE FROM Historico_Academico WHERE fk_id_aluno = %s", (id_aluno,))
+    cursor.execute("DELETE FROM Disciplinas WHERE id_disciplina = ANY(%s)", (list(ids.values()),))
+    cursor.execute("DELETE FROM Alunos WHERE id_aluno = %s", (id_aluno,))
+    conn.commit()
+    conn.close()
+
+
+@requer_banco
+def test_linha_sem_registro_no_historico_volta_como_erro(turma):
+    ra, nomes = turma["ra"], turma["nomes"]
+
+    resultado = app.importar_notas_lote_api([
+        {"RA": ra, "Disciplina": nomes["redes"], "NP1": "8", "NP2": "7", "PIM": "9"},
+        {"RA": ra, "Disciplina": nomes["bd"], "NP1": "6"},
+        {"RA": ra, "Disciplina": nomes["bd"], "Faltas": "2"},
+    ])
+
+    assert resultado["status"] == "success"
+    assert resultado["registros_atualizados"] == 2 # Redes e o PIM do semestre
+    assert resultado["linhas_com_erro"] == 2
+    assert [(e["linha"], e["ra"]) for e in resultado["erros"]] == [(2, ra), (3, ra)]
+    assert all(nomes["bd"] in e["message"] for e in resultado["erros"])
+
+    conn, cursor = app.get_db_connection()
+    cursor.execute(
+        "SELECT NP1, NP2, Media_Final FROM Historico_Academico H JOIN Disciplinas D ON H.fk_id_disciplina = D.id_disciplina "
+        "WHERE H.fk_id_aluno = %s AND D.Nome_Disciplina = %s", (turma["id_aluno"], nomes["redes"])
+    )
+    registro = cursor.fetchone()
+    conn.close()
+    assert (float(registro['np1']), float(registro['np2']), float(registro['media_final'])) == (8.0, 7.0, 7.8)
+
+
+@requer_banco
+def test_pim_de_semestre_sem_matricula_no_pim_volta_como_erro(turma):
+    ra, nomes = turma["ra"], turma["nomes"]
+    conn, cursor = app.get_db_connection()
+    cursor.execute(
+        "DELETE FROM Historico_Academico WHERE fk_id_aluno = %s AND fk_id_disciplina = "
+        "(SELECT id_disciplina FROM Disciplinas WHERE Nome_Disciplina = %s)", (turma["id_aluno"], nomes["pim"])
+    )
+    conn.commit()
+    conn.close()
+
+    resultado = app.importar_notas_lote_api([{"RA": ra, "Disciplina": nomes["redes"], "PIM": "9"}])
+
+    assert resultado["registros_atualizados"] == 0
+    assert [e["linha"] for e in resultado["erros"]] == [1]
+    assert nomes["pim"] in resultado["erros"][0]["message"]
@@ -0,0 +1,120 @@
+"""Fast-path de intenções: qual ferramenta (e com quais argumentos) o classificador local escolhe."""
+import pytest
+
+import app
+
+DISCIPLINAS = [
+    ("Redes de Computadores", 'TEORICA'),
+    ("Banco de Dados", 'TEORICA'),
+    ("Engenharia de Software", 'ED'),
+    ("PIM I", 'PIM'),
+    ("PIM II", 'PIM'),
+]
+
+
+@pytest.fixture(autouse=True)
+def disciplinas(monkeypatch):
+    monkeypatch.setattr(app, '_carregar_disciplinas', lambda: [
+        (nome, app.normalizar_texto(nome), tipo) for nome, tipo in DISCIPLINAS
+    ])
+
+
+def _classificar(mensagem, tipo='professor', ra='R123', contexto=None):
+    return app.classificar_intencao(mensagem, tipo, ra, contexto)
+
+
+@pytest.mark.parametrize("mensagem, tipo, esperado", [
+    # Lançamentos (professor)
+    ("Lançar NP1 8,5 para o RA R12345 em Redes de Computadores", 'professor',
+     ('lancar_nota_np', {"ra_aluno": "R12345", "nome_disciplina": "Redes de Computadores", "np_qual": "NP1", "nota": 8.5})),
+    ("registre a np2 do aluno R12345 em banco de dados: 7", 'professor',
+     ('lancar_nota_np', {"ra_aluno": "R12345", "nome_disciplina": "Banco de Dados", "np_qual": "NP2", "nota": 7.0})),
+    ("coloque nota 9 no PIM II do R12345", 'professor',
+     ('lancar_nota_pim', {"ra_aluno": "R12345", "nome_disciplina_pim": "PIM II", "nota": 9.0})),
+    ("lance 4 faltas para R12345 em Redes de Computadores", 'professor',
+     ('lancar_faltas', {"ra_aluno": "R12345", "nome_disciplina": "Redes de Computadores", "faltas": 4})),
+    ("atribua NP1 6 ao R12345 em Redes de Computadres", 'professor',
+     ('lancar_nota_np', {"ra_aluno": "R12345", "nome_disciplina": "Redes de Computadores", "np_qual": "NP1", "nota": 6.0})),
+    # Estatísticas (professor)
+    ("estatísticas da turma do 2º semestre", 'professor', ('estatisticas_turma', {"semestre": 2})),
+    ("qual a taxa de aprovação em Banco de Dados?", 'professor', ('estatisticas_turma', {"nome_disciplina": "Banco de Dados"})),
+    # Histórico
+    ("quais são as minhas notas?", 'aluno', ('verificar_historico_academico', {"ra_aluno": "R123"})),
+    ("mostra meu boletim", 'aluno', ('verificar_historico_academico', {"ra_aluno": "R123"})),
+    ("histórico do aluno R12345", 'professor', ('verificar_historico_academico', {"ra_aluno": "R12345"})),
+    # O aluno só vê o próprio histórico, mesmo citando outro RA
+    ("notas do R99999", 'aluno', ('verificar_historico_academico', {"ra_aluno": "R123"})),
+    # Material de estudo
+    ("me explica sobre redes neurais", 'aluno', ('gerar_material_estudo', {"topico": "redes neurais"})),
+    ("Resumo de Banco de Dados", 'professor', ('gerar_material_estudo', {"topico": "Banco de Dados"})),
+])
+def test_intencoes_reconhecidas(mensagem, tipo, esperado):
+    resultado = _classificar(mensagem, tipo)
+    assert resultado is not None
+    assert resultado[:2] == esperado
+    assert resultado[2] >= app.INTENT_FASTPATH_MIN_CONFIDENCE
+
+
+@pytest.mark.parametrize("mensagem, tipo, esperado", [
+    # Pedidos de estudo que citam palavras do histórico não viram consulta ao boletim
+    ("Faz um resumo sobre médias ponderadas", 'aluno', ('gerar_material_estudo', {"topico": "médias ponderadas"})),
+    ("gere um material sobre o histórico da computação", 'aluno',
+     ('gerar_material_estudo', {"topico": "o histórico da computação"})),
+    ("me explica notas musicais", 'aluno', None),
+    # 'colocação'/'registro' não são verbos de lançamento
+    ("me explica sobre colocação pronominal", 'aluno', ('gerar_material_estudo', {"topico": "colocação pronominal"})),
+    ("explicação sobre colocação pronominal", 'professor', ('gerar_material_estudo', {"topico": "colocação pronominal"})),
+    ("resumo sobre registro de domínios", 'professor', ('gerar_material_estudo', {"topico": "registro de domínios"})),
+])
+def test_pedidos_de_estudo_nao_sao_desviados(mensagem, tipo, esperado):
+    resultado = _classificar(mensagem, tipo)
+    assert (resultado[:2] if resultado else None) == esperado
+
+
+@pytest.mark.parametrize("mensagem, tipo", [
+    ("lançar NP1 8 para R12345 em Redes de Computadores", 'aluno'),      # aluno não lança notas
+    ("lançar NP1 8 para R12345 e R54321 em Redes de Computadores", 'professor'),  # dois RAs
+    ("lançar NP1 8 para R12345", 'professor'),                            # sem disciplina
+    ("lançar NP1 8 ou 9 para R12345 em Redes de Computadores", 'professor'),  # dois valores
+    ("lançar NP1 8 no PIM I do R12345", 'professor'),                     # NP em disciplina PIM
+    ("lance 2,5 faltas para R12345 em Redes de Computadores", 'professor'),  # faltas fracionárias
+    ("notas de R12345 e R54321", 'professor'),                            # histórico ambíguo
+    ("notas", 'professor'),                                               # sem RA nem sessão
+    ("estatísticas da turma", 'aluno'),                                   # só o professor
+    ("bom dia, tudo bem?", 'aluno'),
+    ("resumo de IA", 'aluno'),                                            # tópico curto demais
+])
+def test_ambiguos_ou_incompletos_vao_para_o_gemini(mensagem, tipo):
+    assert _classificar(mensagem, tipo) is None
+
+
+@pytest.mark.parametrize("mensagem, contexto, esperado", [
+    ("lance a NP2 dele com 8", {"ra_aluno": "R12345", "nome_disciplina": "Redes de Computadores"},
+     ('lancar_nota_np', {"ra_aluno": "R12345", "nome_disciplina": "Redes de Computadores", "np_qual": "NP2", "nota": 8.0})),
+    ("lance também 3 faltas", {"ra_aluno": "R12345", "nome_disciplina": "Banco de Dados"},
+     ('lancar_faltas', {"ra_aluno": "R12345", "nome_disciplina": "Banco de Dados", "faltas": 3})),
+    ("agora lance a NP1 dele em Banco de Dados com 5", {"ra_aluno": "R12345"},
+     ('lancar_nota_np', {"ra_aluno": "R12345", "nome_disciplina": "Banco de Dados", "np_qual": "NP1", "nota": 5.0})),
+    ("e o histórico dele?", {"ra_aluno": "R12345"}, ('verificar_historico_academico', {"ra_aluno": "R12345"})),
+])
+def test_sessao_completa_mensagens_de_continuacao(mensagem, contexto, esperado):
+    resultado = _classificar(mensagem, 'professor', contexto=contexto)
+    assert resultado is not None and resultado[:2] == esperado
+    # Parâmetros vindos da sessão reduzem a confiança
+    assert resultado[2] < 1.0
+
+
+def test_continuacao_sem_sessao_vai_para_o_gemini():
+    assert _classificar("lance a NP2 dele com 8", 'professor') is None
+    assert _classificar("e o histórico dele?", 'professor') is None
+
+
+def _ferramenta_com_local_ra(nome_disciplina):
+    ra_aluno = nome_disciplina.upper()  # variável local: não é parâmetro da ferramenta
+    return ra_aluno
+
+
+def test_argumentos_consideram_so_parametros_da_ferramenta(monkeypatch):
+    monkeypatch.setitem(app.TOOLS, 'ferramenta_teste', _ferramenta_com_local_ra)
+    argumentos = app.argumentos_da_ferramenta('ferramenta_teste', {"nome_disciplina": "Redes"}, 'ALUNO')
+    assert argumentos == {"nome_disciplina": "Redes"}
@@ -0,0 +1,83 @@
+"""
+Paridade entre a média recalculada no banco (SQL_RECALCULO_MEDIAS) e 'calcular_media_final'.
+Usa o PostgreSQL de DATABASE_URL (com as migrações aplicadas) dentro de uma transação desfeita ao final.
+"""
+import os
+import random
+import uuid
+from decimal import Decimal
+
+import psycopg2
+import pytest
+
+import app
+
+pytestmark = pytest.mark.skipif(not os.environ.get('DATABASE_URL'), reason="DATABASE_URL não configurada")
+
+
+def _nota_aleatoria(rng, chance_nula=0.1):
+    if rng.random() < chance_nula:
+        return None
+    return Decimal(rng.randint(0, 1000)) / 100
+
+
+@pytest.fixture
+def cursor():
+    conn = psycopg2.connect(os.environ['DATABASE_URL'])
+    try:
+        yield conn.cursor()
+    finally:
+        conn.rollback()
+        conn.close()
+
+
+def test_recalculo_no_banco_bate_com_calcular_media_final(cursor):
+    rng = random.Random(20241)
+    sufixo = uuid.uuid4().hex[:8]
+    cursor.execute(
+        "INSERT INTO Alunos (RA, Nome_Completo, Senha) VALUES (%s, 'Paridade', 'x') RETURNING id_aluno",
+        (f"T{sufixo}",),
+    )
+    id_aluno = cursor.fetchone()[0]
+
+    esperado = {}
+    for semestre in range(9001, 9041):
+        nota_pim = _nota_aleatoria(rng)
+        cursor.execute(
+            "INSERT INTO Disciplinas (Nome_Disciplina, Semestre, Tipo_Avaliacao) VALUES (%s, %s, 'PIM') RETURNING id_disciplina",
+            (f"PIM {sufixo}", semestre),
+        )
+        cursor.execute(
+            "INSERT INTO Historico_Academico (fk_id_aluno, fk_id_disciplina, Media_Final) VALUES (%s, %s, %s)",
+            (id_aluno, cursor.fetchone()[0], nota_pim),
+        )
+        for n in range(5):
+            np1, np2 = _nota_aleatoria(rng), _nota_aleatoria(rng)
+            cursor.execute(
+                "INSERT INTO Disciplinas (Nome_Disciplina, Semestre, Tipo_Avaliacao) VALUES (%s, %s, %s) RETURNING id_disciplina",
+                (f"Disciplina {n} {sufixo}", semestre, rng.choice(['TEORICA', 'ED'])),
+            )
+            cursor.execute(
+                "INSERT INTO Historico_Academico (fk_id_aluno, fk_id_disciplina, NP1, NP2) VALUES (%s, %s, %s, %s) RETURNING id_registro",
+                (id_aluno, cursor.fetchone()[0], np1, np2),
+            )
+            esperado[cursor.fetchone()[0]] = app.calcular_media_final(np1, np2, nota_pim)
+
+    recalculado = {id_registro: media for id_registro, media in app._recalcular_medias(cursor, id_aluno=id_aluno)}
+
+    assert recalculado.keys() == esperado.keys()
+    for id_registro, media in esperado.items():
+        assert (None if media is None else Decimal(str(media)).quantize(Decimal('0.01'))) == recalculado[id_registro], id_registro
+
+
+def test_casos_de_arredondamento_meio_para_cima(cursor):
+    # (NP1*4 + NP2*4 + PIM*2) / 10 com terceira casa 5: o banco (ROUND NUMERIC) e o Python arredondam para cima
+    casos = [
+        (Decimal('2.67'), Decimal('2.68'), Decimal('2.68')),
+        (Decimal('0.01'), Decimal('0.00'), Decimal('0.01')),
+        (Decimal('6.99'), Decimal('7.00'), Decimal('5.01')),
+        (Decimal('10.00'), Decimal('10.00'), Decimal('10.00')),
+    ]
+    for np1, np2, pim in casos:
+        cursor.execute("SELECT ROUND((%s::NUMERIC(4,2) * 4 + %s::NUMERIC(4,2) * 4 + %s::NUMERIC(4,2) * 2) / 10, 2)", (np1, np2, pim))
+        assert Decimal(str(app.calcular_media_final(np1, np2, pim))).quantize(Decimal('0.01')) == cursor.fetchone()[0]
@@ -0,0 +1,35 @@
+"""
+Migrações publicadas não mudam (ver o aviso em '1. MIGRAÇÕES DO BANCO DE DADOS'): o SQL de cada versão
+fica fixado aqui. Se este teste falhar, a mudança deve ir para uma nova versão, não para uma existente.
+"""
+import hashlib
+
+import app
+
+SQL_PUBLICADO = {
+    1: "f630d6a36f2d9ad7",
+    2: "5d414a431825b5ce",
+    3: "2d5f6fdfd26feb8e",
+    4: "7c3cee7c45355ad6",
+    5: "686286e700a1d505",
+    6: "014ed90c9761ce81",
+    7: "2ad536524b58021e",
+    8: "acb528b51d88e8ec",
+    9: "1a07df79412c7b26",
+    10: "dc1d26342a9bf83e",
+    11: "1992154f271f4e01",
+    12: "f57ae1bbb3c156be",
+    13: "aad01dad61bc0eb8",
+}
+
+
+def test_versoes_em_ordem_e_sem_lacunas():
+    assert [versao for versao, _, _ in app.MIGRACOES] == list(range(1, len(app.MIGRACOES) + 1))
+
+
+def test_migracoes_publicadas_nao_mudam():
+    passos = {versao: passo for versao, _, passo in app.MIGRACOES}
+    for versao, hash_publicado in SQL_PUBLICADO.items():
+        # SQL literal: nada montado a partir de constantes usadas em tempo de execução
+        assert isinstance(passos[versao], str), versao
+        assert hashlib.sha256(passos[versao].encode()).hexdigest()[:16] == hash_publicado, versao
@@ -0,0 +1,51 @@
+"""Pool de conexões contra o PostgreSQL de DATABASE_URL: quando o checkout vai (ou não) ao servidor."""
+import os
+
+import psycopg2
+import pytest
+
+import app
+
+pytestmark = pytest.mark.skipif(not os.environ.get('DATABASE_URL'), reason="DATABASE_URL não configurada")
+
+
+@pytest.fixture
+def pool():
+    pool = app.DBConnectionPool(os.environ['DATABASE_URL'], 1, 2, 5, healthcheck=True, ping_ociosa=60)
+    yield pool
+    pool._pool.closeall()
+
+
+def _usar(pool):
+    conn = pool.getconn()
+    with conn.cursor() as cur:
+        cur.execute("SELECT pg_backend_pid()")
+        pid = cur.fetchone()[0]
+    conn.commit()
+    conn.close()
+    return pid
+
+
+def test_conexao_usada_ha_pouco_nao_recebe_ping(pool):
+    for _ in range(5):
+        _usar(pool)
+    assert pool.stats()["pings"] == 0
+    assert pool.stats()["reconnects"] == 0
+
+
+def test_conexao_ociosa_recebe_ping(pool):
+    _usar(pool)
+    pool.ping_ociosa = 0
+    _usar(pool)
+    assert pool.stats()["pings"] == 1
+
+
+def test_conexao_derrubada_pelo_servidor_e_substituida(pool):
+    pid = _usar(pool)
+    with psycopg2.connect(os.environ['DATABASE_URL']) as admin, admin.cursor() as cur:
+        cur.execute("SELECT pg_terminate_backend(%s)", (pid,))
+    admin.close()
+    pool.ping_ociosa = 0
+
+    assert _usar(pool) != pid
+    assert pool.stats()["reconnects"] == 1
@@ -0,0 +1,103 @@
+"""
+/web_router_stream com um cliente no lugar do Gemini: a resposta direta do roteador e a formatação do
+resultado de uma ferramenta devem chegar em vários eventos 'delta', na ordem em que foram gerados.
+"""
+import json
+
+import pytest
+from google.genai import types
+
+import app
+
+
+def _resposta(texto=None, chamada=None):
+    parte = types.Part(function_call=chamada) if chamada else types.Part(text=texto)
+    return types.GenerateContentResponse(
+        candidates=[types.Candidate(content=types.Content(role='model', parts=[parte]))]
+    )
+
+
+class _Modelos:
+    def __init__(self, roteamento, formatacao=()):
+        self.roteamento = list(roteamento)
+        self.formatacao = list(formatacao)
+        self.chamadas = []
+
+    def _pedacos(self, contents):
+        # O roteador recebe só a mensagem do usuário; a formatação recebe o resultado da ferramenta
+        return self.formatacao if len(contents) > 1 else self.roteamento
+
+    def generate_content(self, model, contents, config=None):
+        self.chamadas.append('generate_content')
+        pedacos = self._pedacos(contents)
+        if isinstance(pedacos[0], types.FunctionCall):
+            return _resposta(chamada=pedacos[0])
+        return _resposta("".join(pedacos))
+
+    def generate_content_stream(self, model, contents, config=None):
+        self.chamadas.append('generate_content_stream')
+        for pedaco in self._pedacos(contents):
+            yield _resposta(chamada=pedaco) if isinstance(pedaco, types.FunctionCall) else _resposta(pedaco)
+
+
+class _Cliente:
+    def __init__(self, modelos):
+        self.models = modelos
+
+
+@pytest.fixture
+def gemini(monkeypatch):
+    def instalar(roteamento, formatacao=()):
+        modelos = _Modelos(roteamento, formatacao)
+        monkeypatch.setattr(app, 'client', _Cliente(modelos))
+        monkeypatch.setattr(app, 'GEMINI_CONTEXT_CACHE', False)
+        monkeypatch.setattr(app, 'classificar_intencao', lambda *args, **kwargs: None)
+        return modelos
+    return instalar
+
+
+def _eventos(resposta):
+    return [json.loads(linha[len('data: '):]) for linha in resposta.get_data(as_text=True).split('\n\n') if linha]
+
+
+def _postar(tipo, mensagem):
+    cliente = app.app.test_client()
+    token = app.emitir_token_sessao(None, "P0001" if tipo == 'professor' else "R0001", "Teste", tipo, None)
+    return cliente.post('/web_router_stream', json={"message": mensagem}, headers={'Authorization': f"Bearer {token}"})
+
+
+def test_resposta_direta_do_roteador_sai_em_pedacos(gemini):
+    modelos = gemini(["Joker: ", "Take your ", "time."])
+
+    eventos = _eventos(_postar('aluno', 'me conta uma piada'))
+
+    assert [e["delta"] for e in eventos if "delta" in e] == ["Joker: ", "Take your ", "time."]
+    assert eventos[-1] == {"done": True}
+    assert modelos.chamadas == ['generate_content_stream']
+
+
+def test_formatacao_do_resultado_da_ferramenta_sai_em_pedacos(gemini, monkeypatch):
+    def estatisticas(semestre=None, nome_disciplina=None):
+        return {"status": "success", "turmas": []}
+
+    monkeypatch.setitem(app.TOOLS, 'estatisticas_turma', estatisticas)
+    monkeypatch.setattr(app, 'renderizar_resultado_tool', lambda func_name, dados: None)
+    modelos = gemini(
+        [types.FunctionCall(name='estatisticas_turma_api', args={})],
+        ["Joker: Nenhuma ", "turma encontrada."],
+    )
+
+    eventos = _eventos(_postar('professor', 'estatísticas da turma'))
+
+    assert [e["delta"] for e in eventos if "delta" in e] == ["Joker: Nenhuma ", "turma encontrada."]
+    assert modelos.chamadas == ['generate_content_stream', 'generate_content_stream']
+
+
+def test_web_router_continua_com_a_resposta_inteira(gemini):
+    modelos = gemini(["Joker: ", "Take your ", "time."])
+    token = app.emitir_token_sessao(None, "R0001", "Teste", 'aluno', None)
+
+    resposta = app.app.test_client().post('/web_router', json={"message": "oi"}, headers={'Authorization': f"Bearer {token}"})
+
+    assert resposta.get_json()["message"] == "Joker: Take your time."
+    assert modelos.chamadas == ['generate_content']
@@ -0,0 +1,256 @@
+"""
+Canal WhatsApp/SMS contra um servidor local no lugar da API REST da Twilio (TWILIO_API_BASE).
+O roteador é trocado por uma função fixa: os testes cobrem o webhook e o envio, não o Gemini.
+"""
+import threading
+import time
+import urllib.parse
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+from twilio.request_validator import RequestValidator
+
+import app
+
+ACCOUNT_SID = 'ACteste'
+AUTH_TOKEN = 'token-de-teste'
+URL_WEBHOOK = 'http://localhost/twilio_webhook'
+
+
+class _TwilioLocal(BaseHTTPRequestHandler):
+    """
+    Grava cada POST em Messages.json. Enquanto houver falhas programadas, derruba a conexão sem resposta
+    ('quedas'), demora mais que o TWILIO_TIMEOUT ('atrasos') ou responde 503 ('falhas'), nessa ordem.
+    """
+
+    def do_POST(self):
+        corpo = urllib.parse.parse_qs(self.rfile.read(int(self.headers['Content-Length'])).decode())
+        servidor = self.server
+        with servidor.lock:
+            if servidor.quedas:
+                servidor.quedas -= 1
+                self.close_connection = True
+                return
+            atrasar = servidor.atrasos > 0
+            servidor.atrasos -= atrasar
+        if atrasar:
+            time.sleep(0.5)
+            return
+        with servidor.lock:
+            if servidor.falhas:
+                servidor.falhas -= 1
+                self.send_response(503)
+                self.end_headers()
+                return
+            servidor.mensagens.append({
+                "path": self.path,
+                "authorization": self.headers.get('Authorization'),
+                **{k: v[0] for k, v in corpo.items()},
+            })
+        self.send_response(201)
+        self.send_header('Content-Type', 'application/json')
+        self.end_headers()
+        self.wfile.write(b'{"sid": "SMlocal"}')
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def twilio_local(monkeypatch):
+    servidor = ThreadingHTTPServer(('127.0.0.1', 0), _TwilioLocal)
+    servidor.lock = threading.Lock()
+    servidor.mensagens = []
+    servidor.falhas = 0
+    servidor.quedas = 0
+    servidor.atrasos = 0
+    threading.Thread(target=servidor.serve_forever, daemon=True).start()
+
+    monkeypatch.setattr(app, 'TWILIO_ACCOUNT_SID', ACCOUNT_SID)
+    monkeypatch.setattr(app, 'TWILIO_AUTH_TOKEN', AUTH_TOKEN)
+    monkeypatch.setattr(app, 'TWILIO_API_BASE', f"http://127.0.0.1:{servidor.server_port}")
+    monkeypatch.setattr(app, 'TWILIO_VALIDAR_ASSINATURA', True)
+    monkeypatch.setattr(app, 'TWILIO_BACKOFF_BASE', 0.01)
+    # Sem banco: nenhum telefone vinculado
+    monkeypatch.setattr(app, '_aluno_do_telefone', lambda telefone: None)
+    yield servidor
+    servidor.shutdown()
+
+
+@pytest.fixture
+def roteador(monkeypatch):
+    """Substitui o roteador; 'resposta' define o texto e 'chamadas' registra as mensagens recebidas."""
+    estado = {"resposta": "Joker: Take your time.", "chamadas": []}
+
+    def rotear(mensagem, tipo_usuario, ra_usuario=None, sessao=None):
+        estado["chamadas"].append((mensagem, tipo_usuario, ra_usuario))
+        return estado["resposta"]
+
+    monkeypatch.setattr(app, 'rotear_e_executar_mensagem', rotear)
+    return estado
+
+
+def _formulario(corpo='oi', de='whatsapp:+5511999990000'):
+    return {'MessageSid': f"SM{uuid.uuid4().hex}", 'From': de, 'To': 'whatsapp:+14155238886', 'Body': corpo}
+
+
+def _postar(cliente, formulario, assinar=True):
+    headers = {}
+    if assinar:
+        headers['X-Twilio-Signature'] = RequestValidator(AUTH_TOKEN).compute_signature(URL_WEBHOOK, formulario)
+    return cliente.post('/twilio_webhook', data=formulario, headers=headers)
+
+
+def _esperar_mensagens(servidor, quantidade, timeout=5):
+    limite = time.monotonic() + timeout
+    while time.monotonic() < limite:
+        with servidor.lock:
+            if len(servidor.mensagens) >= quantidade:
+                return list(servidor.mensagens)
+        time.sleep(0.02)
+    with servidor.lock:
+        return list(servidor.mensagens)
+
+
+def test_assinatura_invalida_e_recusada(twilio_local, roteador):
+    cliente = app.app.test_client()
+    formulario = _formulario()
+
+    assert _postar(cliente, formulario, assinar=False).status_code == 403
+    formulario_adulterado = dict(formulario, Body='outra coisa')
+    resposta = cliente.post('/twilio_webhook', data=formulario_adulterado, headers={
+        'X-Twilio-Signature': RequestValidator(AUTH_TOKEN).compute_signature(URL_WEBHOOK, formulario)
+    })
+    assert resposta.status_code == 403
+
+    time.sleep(0.2)
+    assert roteador["chamadas"] == []
+    assert twilio_local.mensagens == []
+
+
+def test_resposta_sai_pela_api_rest(twilio_local, roteador):
+    cliente = app.app.test_client()
+    formulario = _formulario('minhas notas')
+
+    resposta = _postar(cliente, formulario)
+    assert resposta.status_code == 200
+    assert resposta.mimetype == 'application/xml'
+    assert b'<Message>' not in resposta.data
+
+    mensagens = _esperar_mensagens(twilio_local, 1)
+    assert len(mensagens) == 1
+    assert mensagens[0]['path'] == f"/2010-04-01/Accounts/{ACCOUNT_SID}/Messages.json"
+    assert mensagens[0]['authorization'].startswith('Basic ')
+    assert mensagens[0]['To'] == formulario['From']
+    assert mensagens[0]['From'] == formulario['To']
+    assert mensagens[0]['Body'] == 'Joker: Take your time.'
+    assert roteador["chamadas"] == [('minhas notas', 'aluno', None)]
+
+
+def test_reentrega_do_mesmo_message_sid_e_ignorada(twilio_local, roteador):
+    cliente = app.app.test_client()
+    formulario = _formulario()
+
+    assert _postar(cliente, formulario).status_code == 200
+    assert _postar(cliente, formulario).status_code == 200
+
+    _esperar_mensagens(twilio_local, 1)
+    time.sleep(0.2)
+    assert len(roteador["chamadas"]) == 1
+    assert len(twilio_local.mensagens) == 1
+
+
+def test_fila_cheia_responde_sobrecarga_no_twiml(twilio_local, roteador, monkeypatch):
+    cheia = threading.BoundedSemaphore(1)
+    cheia.acquire()
+    monkeypatch.setattr(app, '_twilio_pendentes', cheia)
+
+    resposta = _postar(app.app.test_client(), _formulario())
+
+    assert resposta.status_code == 200
+    assert '<Message>' in resposta.get_data(as_text=True)
+    assert app.MENSAGEM_SOBRECARGA in resposta.get_data(as_text=True)
+    time.sleep(0.2)
+    assert roteador["chamadas"] == []
+
+
+def test_resposta_longa_sai_em_partes_numeradas(twilio_local, roteador):
+    roteador["resposta"] = "Joker: **Material**\n\n" + " ".join(f"palavra{i}" for i in range(900))
+
+    _postar(app.app.test_client(), _formulario('me explica sobre redes'))
+
+    esperado = app.dividir_mensagem(app._formatar_para_whatsapp(roteador["resposta"]))
+    mensagens = _esperar_mensagens(twilio_local, len(esperado))
+    assert len(esperado) > 1
+    assert [m['Body'] for m in mensagens] == esperado
+
+
+def test_envio_repete_apos_503(twilio_local, roteador):
+    twilio_local.falhas = 1
+
+    _postar(app.app.test_client(), _formulario())
+
+    mensagens = _esperar_mensagens(twilio_local, 1)
+    assert [m['Body'] for m in mensagens] == ['Joker: Take your time.']
+
+
+def test_envio_repete_apos_queda_de_conexao(twilio_local):
+    twilio_local.quedas = 1
+
+    assert app.enviar_mensagem_twilio('whatsapp:+5511999990000', 'whatsapp:+14155238886', 'oi') == {"sid": "SMlocal"}
+    assert [m['Body'] for m in twilio_local.mensagens] == ['oi']
+
+
+def test_envio_repete_apos_timeout(twilio_local, monkeypatch):
+    monkeypatch.setattr(app, 'TWILIO_TIMEOUT', 0.1)
+    twilio_local.atrasos = 1
+
+    assert app.enviar_mensagem_twilio('whatsapp:+5511999990000', 'whatsapp:+14155238886', 'oi') == {"sid": "SMlocal"}
+    assert [m['Body'] for m in twilio_local.mensagens] == ['oi']
+
+
+def test_envio_desiste_apos_twilio_max_tentativas(twilio_local, monkeypatch):
+    monkeypatch.setattr(app, 'TWILIO_MAX_TENTATIVAS', 2)
+    twilio_local.quedas = 2
+
+    with pytest.raises(ConnectionError):
+        app.enviar_mensagem_twilio('whatsapp:+5511999990000', 'whatsapp:+14155238886', 'oi')
+    assert twilio_local.mensagens == []
+
+
+def test_dividir_mensagem_curta_fica_inteira():
+    texto = "x" * 1500
+    assert app.dividir_mensagem(texto, 1500) == [texto]
+
+
+def test_dividir_mensagem_longa_respeita_limite_e_prefixos():
+    paragrafos = [" ".join(f"p{n}w{i}" for i in range(120)) for n in range(6)]
+    texto = "\n\n".join(paragrafos)
+
+    partes = app.dividir_mensagem(texto, 1500)
+
+    assert len(partes) > 1
+    assert all(len(parte) <= 1500 for parte in partes)
+    for i, parte in enumerate(partes, 1):
+        assert parte.startswith(f"({i}/{len(partes)}) ")
+    # Nenhuma palavra se perde nem é cortada ao meio
+    palavras = [p for parte in partes for p in parte.split(' ', 1)[1].split()]
+    assert palavras == texto.split()
+
+
+def test_dividir_mensagem_prefere_quebrar_entre_paragrafos():
+    primeiro = "a " * 500
+    segundo = "b " * 500
+    partes = app.dividir_mensagem(f"{primeiro.strip()}\n\n{segundo.strip()}", 1500)
+
+    assert partes == [f"(1/2) {primeiro.strip()}", f"(2/2) {segundo.strip()}"]
+
+
+def test_dividir_mensagem_corta_palavra_maior_que_o_limite():
+    texto = "z" * 4000
+
+    partes = app.dividir_mensagem(texto, 1500)
+
+    assert all(len(parte) <= 1500 for parte in partes)
+    assert "".join(parte.split(' ', 1)[1] for parte in partes) == texto